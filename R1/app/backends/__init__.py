@@ -0,0 +1,32 @@
+"""
+Generation backends of the R1 LLM Service.
+
+The backend is selected with the R1_BACKEND environment variable:
+- "hf" (default): Nous-Hermes-2-Mistral-7B-DPO with Hugging Face transformers, 4-bit on GPU.
+- "cpu": the model with int8 dynamic quantization on CPU, for hosts without a GPU.
+- "simulated": deterministic fake LLM, fast and CPU-only, for benchmarks and load tests.
+
+Backends are imported lazily, so that the simulated backend does not need torch or a GPU.
+"""
+import importlib
+import os
+
+from .base import FINISH_REASONS, CancelToken, GenerationBackend, GenerationRequest, GenerationResult
+
+BACKENDS = {
+    "hf": (".hf", "HFMistralBackend"),
+    "cpu": (".cpu", "CPUBackend"),
+    "simulated": (".simulated", "SimulatedBackend"),
+}
+
+
+def load_backend(name=None):
+    """
+    Instantiate the backend called `name` (defaults to the R1_BACKEND environment variable).
+    """
+    name = name or os.getenv("R1_BACKEND", "hf")
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown R1 backend '{name}', expected one of {sorted(BACKENDS)}")
+    module_name, class_name = BACKENDS[name]
+    module = importlib.import_module(module_name, __package__)
+    return getattr(module, class_name)()
@@ -0,0 +1,185 @@
+"""
+Pre-quantized model artifacts for the Hugging Face backend.
+
+Loading the model from the hub checkpoint means reading 14 GB of float16 weights and
+quantizing them to 4-bit on every start. An artifact is built once instead: the
+quantized model saved as safetensors, with its tokenizer and a manifest
+(`r1_artifact.json`). safetensors files are memory-mapped when loaded, so a worker
+starting from an artifact reads ~4 GB straight into place and skips the quantization.
+
+Usage (from the R1 directory):
+    # once, on a machine with a GPU (bitsandbytes quantization needs CUDA)
+    python -m app.backends.artifacts build --output /models/hermes-4bit
+    # then start the workers with R1_MODEL_ARTIFACT=/models/hermes-4bit
+
+    # CPU check of the whole flow with a tiny model, e.g. to regression-test cold starts
+    python -m app.backends.artifacts build --model hf-internal-testing/tiny-random-MistralForCausalLM \
+        --quantize none --output /tmp/tiny-artifact
+    python -m app.backends.artifacts load /tmp/tiny-artifact --device cpu --max-seconds 5
+
+Load times are reported per phase (manifest, tokenizer, weights, warmup) in the logs and
+on /metrics (`r1_model_load_seconds`).
+"""
+import argparse
+import datetime
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+import transformers
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+
+from common.metrics import Gauge
+
+MANIFEST_NAME = "r1_artifact.json"
+QUANTIZATIONS = ("4bit", "8bit", "none")
+
+LOAD_SECONDS = Gauge("r1_model_load_seconds", "Time spent loading the model at startup, by phase.", ["phase"])
+
+
+class LoadTimer:
+    """Times the phases of a model load, and reports them."""
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+            LOAD_SECONDS.labels(phase=name).set(self.phases[name])
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def report(self, what):
+        details = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        print(f"[INFO] Loaded {what} in {self.total:.2f}s ({details})")
+
+
+def quantization_config(quantize):
+    if quantize not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantize}', expected one of {QUANTIZATIONS}")
+    if quantize == "4bit":
+        return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=torch.float16)
+    if quantize == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    return None
+
+
+def read_manifest(path):
+    """Manifest of the artifact in directory `path`. Raises FileNotFoundError if it is not one."""
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def build_artifact(model_name, output_dir, quantize="4bit", device_map="auto"):
+    """
+    Load `model_name`, quantize it, and save it to `output_dir` as safetensors with its
+    tokenizer and manifest.
+
+    Returns:
+    - dict: The manifest.
+    """
+    timer = LoadTimer()
+    with timer.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+    with timer.phase("weights"):
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16 if quantize != "none" else None,
+            device_map=device_map,
+            quantization_config=quantization_config(quantize),
+        )
+    timer.report(f"{model_name} for quantization")
+
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    tokenizer.save_pretrained(output_dir)
+    model.save_pretrained(output_dir, safe_serialization=True)
+    files = {
+        name: os.path.getsize(os.path.join(output_dir, name))
+        for name in sorted(os.listdir(output_dir))
+        if name.endswith(".safetensors")
+    }
+    manifest = {
+        "source_model": model_name,
+        "quantization": quantize,
+        "model_class": type(model).__name__,
+        "transformers_version": transformers.__version__,
+        "torch_version": torch.__version__,
+        "weight_files": files,
+        "weight_bytes": sum(files.values()),
+        "created_at": datetime.datetime.utcnow().isoformat(),
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"[INFO] Saved artifact to {output_dir} in {time.perf_counter() - start:.2f}s "
+          f"({manifest['weight_bytes'] / 1e9:.2f} GB of weights)")
+    return manifest
+
+
+def load_artifact(path, device_map="auto", warmup=True):
+    """
+    Load the tokenizer and model of an artifact. The weights are memory-mapped and
+    already quantized (the quantization settings are stored in its config.json).
+
+    Returns:
+    - tuple: (tokenizer, model, LoadTimer).
+    """
+    timer = LoadTimer()
+    with timer.phase("manifest"):
+        manifest = read_manifest(path)
+        if manifest["transformers_version"] != transformers.__version__:
+            print(f"[WARNING] Artifact {path} was built with transformers {manifest['transformers_version']}, "
+                  f"running {transformers.__version__}")
+    with timer.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(path)
+    with timer.phase("weights"):
+        model = AutoModelForCausalLM.from_pretrained(
+            path,
+            device_map=device_map,
+            low_cpu_mem_usage=True,
+            use_safetensors=True,
+        )
+        model.eval()
+    if warmup:
+        with timer.phase("warmup"), torch.inference_mode():
+            # First forward pass: CUDA context, kernels and dequantization buffers.
+            model(input_ids=torch.tensor([[tokenizer.bos_token_id or 0]], device=model.device))
+    timer.report(f"artifact {path} ({manifest['source_model']}, {manifest['quantization']})")
+    return tokenizer, model, timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or load pre-quantized R1 model artifacts.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="Quantize a model once and save it as safetensors.")
+    build.add_argument("--model", default="NousResearch/Nous-Hermes-2-Mistral-7B-DPO")
+    build.add_argument("--output", required=True, help="Directory of the artifact.")
+    build.add_argument("--quantize", choices=QUANTIZATIONS, default="4bit")
+    build.add_argument("--device", default="auto", help="device_map used to load the model.")
+    load = commands.add_parser("load", help="Load an artifact and report the time of each phase.")
+    load.add_argument("path")
+    load.add_argument("--device", default="auto", help="device_map used to load the model.")
+    load.add_argument("--max-seconds", type=float, help="Fail if the load takes longer (cold-start regression check).")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        build_artifact(args.model, args.output, quantize=args.quantize, device_map=args.device)
+        return
+    _, _, timer = load_artifact(args.path, device_map=args.device)
+    print(json.dumps({"total_s": round(timer.total, 3), **{f"{k}_s": round(v, 3) for k, v in timer.phases.items()}}))
+    if args.max_seconds is not None and timer.total > args.max_seconds:
+        print(f"[ERROR] Load took {timer.total:.2f}s, more than {args.max_seconds}s")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Interface shared by every generation backend of the R1 LLM Service.
+"""
+import threading
+from dataclasses import dataclass
+
+
+class CancelToken:
+    """
+    Set when nobody waits for an answer anymore (the client disconnected or gave up).
+    Backends check it at every decoding step and stop early.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        """Sleep up to `timeout` seconds; returns True as soon as the token is cancelled."""
+        return self._event.wait(timeout)
+
+
+@dataclass
+class GenerationRequest:
+    """
+    Everything a backend needs to produce one answer.
+
+    - prompt: the full ChatML prompt built from the session history.
+    - prompt_ids: the same prompt as token ids, when the caller already has them (the
+      backend then skips tokenization).
+    - user_message: the latest user message (already part of the prompt).
+    - grammar: optional `ChoiceArrayGrammar` restricting the answer (constrained decoding).
+    - cancel: optional `CancelToken`; generation stops at the next step once it is set.
+    - stop: optional stop strings; generation stops as soon as the answer contains one of
+      them, and the answer is cut before it.
+    - stop_token_ids: optional token id sequences, handled like `stop` on token ids.
+    """
+    session_id: str
+    prompt: str
+    user_message: str
+    max_new_tokens: int = 200
+    temperature: float = 0.7
+    repetition_penalty: float = 1.1
+    grammar: object = None
+    prompt_ids: list = None
+    cancel: CancelToken = None
+    stop: list = None
+    stop_token_ids: list = None
+
+
+# Why a generation ended (GenerationResult.finish_reason).
+FINISH_REASONS = (
+    "eos",  # the model ended its answer
+    "stop_sequence",  # a stop string or stop token sequence was generated
+    "grammar",  # the constrained structure was closed
+    "length",  # max_new_tokens reached
+    "cancelled",  # the cancel token was set
+)
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    prompt_tokens: int
+    generated_tokens: int
+    cancelled: bool = False
+    finish_reason: str = "eos"
+
+
+def find_stop(text, stops):
+    """
+    Earliest occurrence of any of the `stops` strings in `text`.
+
+    Returns:
+    - int or None: Position of the stop string, None if there is none.
+    """
+    positions = [text.find(stop) for stop in stops or () if stop]
+    positions = [position for position in positions if position >= 0]
+    return min(positions) if positions else None
+
+
+def find_stop_ids(token_ids, sequences):
+    """
+    Earliest occurrence of any of the token id `sequences` in `token_ids`.
+
+    Returns:
+    - int or None: Index of the first token of the sequence, None if there is none.
+    """
+    found = None
+    for sequence in sequences or ():
+        length = len(sequence)
+        if not length:
+            continue
+        for start in range(len(token_ids) - length + 1):
+            if found is not None and start >= found:
+                break
+            if token_ids[start:start + length] == list(sequence):
+                found = start
+                break
+    return found
+
+
+class GenerationBackend:
+    """
+    Base class of the generation backends.
+
+    A backend owns its tokenizer and model; the FastAPI layer only deals with
+    sessions, prompts and persistence.
+    """
+
+    name = "base"
+
+    def count_tokens(self, text):
+        """Number of tokens of `text` for this backend's tokenizer."""
+        raise NotImplementedError
+
+    def encode(self, text):
+        """Token ids of `text`, without special tokens added by the tokenizer."""
+        raise NotImplementedError
+
+    def bos_token_ids(self):
+        """Token ids the tokenizer puts at the start of a prompt."""
+        return []
+
+    def generate(self, request):
+        """Produce a `GenerationResult` for a `GenerationRequest`."""
+        raise NotImplementedError
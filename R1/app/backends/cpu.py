@@ -0,0 +1,130 @@
+"""
+CPU backend: the model with torch dynamic int8 quantization, for hosts without a GPU.
+
+The Linear layers' weights are stored as int8 and their activations quantized on the fly
+(`torch.ao.quantization.quantize_dynamic`), which roughly halves the memory of bfloat16
+weights and uses the int8 matrix kernels of the CPU (VNNI/AMX on recent x86). Decoding
+reuses the Hugging Face backend, so grammars, stop sequences, cancellation and the
+`/generate` contract are the same.
+
+Settings:
+- R1_CPU_MODEL: model name or path (defaults to the GPU model; a smaller model sharing its
+  tokenizer is much faster and usually enough for the short R4 and R5 prompts).
+- R1_CPU_QUANTIZE: "int8" (default) or "none" (float32).
+- R1_CPU_THREADS: threads of the matrix kernels (default: torch's choice, one per core);
+  R1_CPU_INTEROP_THREADS: threads running independent operators.
+- The number of generations run at the same time is R1_MAX_CONCURRENT_GENERATIONS, as
+  for the other backends; on CPU each one takes all the threads, so 1 is usually best.
+
+Benchmark (from the R1 directory), reporting decoding tokens/sec per thread count:
+    python -m app.backends.cpu --model HuggingFaceTB/SmolLM2-135M --threads 1,2,4 --max-new-tokens 64
+"""
+import argparse
+import os
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from .artifacts import LoadTimer
+from .base import GenerationRequest
+from .hf import MODEL_NAME, HFMistralBackend
+
+CPU_MODEL = os.getenv("R1_CPU_MODEL", MODEL_NAME)
+CPU_QUANTIZE = os.getenv("R1_CPU_QUANTIZE", "int8")
+CPU_THREADS = int(os.getenv("R1_CPU_THREADS", "0"))  # 0: torch's default
+CPU_INTEROP_THREADS = int(os.getenv("R1_CPU_INTEROP_THREADS", "0"))
+CPU_QUANTIZATIONS = ("int8", "none")
+
+BENCHMARK_PROMPT = (
+    "<|im_start|>system\nYou classify the user's message.<|im_end|>\n"
+    "<|im_start|>user\nI would like a refund for my last order, it arrived broken.<|im_end|>\n"
+    "<|im_start|>assistant\n"
+)
+
+
+def set_threads(threads=CPU_THREADS, interop_threads=CPU_INTEROP_THREADS):
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:  # only possible before the first parallel operator runs
+            print("[WARNING] R1_CPU_INTEROP_THREADS ignored: torch already started its thread pool")
+
+
+class CPUBackend(HFMistralBackend):
+    name = "cpu"
+
+    def __init__(self, model_name=CPU_MODEL, quantize=CPU_QUANTIZE, threads=CPU_THREADS,
+                 interop_threads=CPU_INTEROP_THREADS):
+        if quantize not in CPU_QUANTIZATIONS:
+            raise ValueError(f"Unknown CPU quantization '{quantize}', expected one of {CPU_QUANTIZATIONS}")
+        set_threads(threads, interop_threads)
+        print(f"[INFO] Loading {model_name} on CPU ({quantize}, {torch.get_num_threads()} threads)...")
+        timer = LoadTimer()
+        with timer.phase("tokenizer"):
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        with timer.phase("weights"):
+            self.model = AutoModelForCausalLM.from_pretrained(
+                model_name,
+                torch_dtype=torch.float32,
+                low_cpu_mem_usage=True,
+            ).eval()
+        if quantize == "int8":
+            with timer.phase("quantization"):
+                self.model = torch.ao.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+                )
+        timer.report(f"{model_name} on CPU")
+        self.init_runtime()
+
+
+def benchmark(backend, prompt=BENCHMARK_PROMPT, max_new_tokens=64, runs=3):
+    """
+    Time generations of up to `max_new_tokens` tokens (no stop sequences).
+
+    Returns:
+    - dict: Prompt tokens, and the median of the generation time and tokens/sec.
+    """
+    timings = []
+    for _ in range(runs):
+        request = GenerationRequest(
+            session_id="benchmark", prompt=prompt, user_message=prompt, max_new_tokens=max_new_tokens
+        )
+        start = time.perf_counter()
+        result = backend.generate(request)
+        elapsed = time.perf_counter() - start
+        timings.append((elapsed, result.generated_tokens / elapsed))
+    timings.sort()
+    elapsed, tokens_per_s = timings[len(timings) // 2]
+    return {
+        "prompt_tokens": result.prompt_tokens,
+        "generated_tokens": result.generated_tokens,
+        "seconds": round(elapsed, 3),
+        "tokens_per_s": round(tokens_per_s, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tokens/sec of the R1 CPU backend.")
+    parser.add_argument("--model", default=CPU_MODEL)
+    parser.add_argument("--quantize", choices=CPU_QUANTIZATIONS, default=CPU_QUANTIZE)
+    parser.add_argument("--threads", default=str(CPU_THREADS or torch.get_num_threads()),
+                        help="Comma-separated thread counts to compare.")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    thread_counts = [int(value) for value in args.threads.split(",")]
+    backend = CPUBackend(args.model, quantize=args.quantize, threads=thread_counts[0])
+    benchmark(backend, max_new_tokens=4, runs=1)  # warmup
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        stats = benchmark(backend, max_new_tokens=args.max_new_tokens, runs=args.runs)
+        print(f"[INFO] {args.quantize}, {threads} threads: {stats['tokens_per_s']} tokens/s "
+              f"({stats['generated_tokens']} tokens in {stats['seconds']}s, {stats['prompt_tokens']} prompt tokens)")
+
+
+if __name__ == "__main__":
+    main()
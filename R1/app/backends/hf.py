@@ -0,0 +1,322 @@
+"""
+Hugging Face transformers backend: Nous-Hermes-2-Mistral-7B-DPO quantized to 4-bit on GPU.
+
+With R1_MODEL_ARTIFACT set, the model is loaded from a pre-quantized artifact (see
+artifacts.py) instead of being quantized on load.
+
+With R1_DRAFT_MODEL set to a small model sharing the Mistral tokenizer, generations use
+speculative decoding (see speculative.py), proposing R1_SPECULATIVE_LOOKAHEAD tokens
+per verification pass.
+"""
+import os
+
+import torch
+from transformers import (
+    AutoModelForCausalLM,
+    LlamaTokenizer,
+    MistralForCausalLM,
+    LogitsProcessor,
+    LogitsProcessorList,
+    StoppingCriteria,
+    StoppingCriteriaList,
+)
+
+from ..constrained import VocabTrie, token_surface_strings
+from .artifacts import LoadTimer, load_artifact
+from .base import GenerationBackend, GenerationResult, find_stop, find_stop_ids
+from .speculative import DEFAULT_LOOKAHEAD, SpeculativeDecoder
+
+MODEL_NAME = "NousResearch/Nous-Hermes-2-Mistral-7B-DPO"
+# Directory of a pre-quantized artifact (see artifacts.py), loaded instead of MODEL_NAME.
+MODEL_ARTIFACT = os.getenv("R1_MODEL_ARTIFACT", "")
+DRAFT_MODEL = os.getenv("R1_DRAFT_MODEL", "")  # empty: no speculative decoding
+SPECULATIVE_LOOKAHEAD = int(os.getenv("R1_SPECULATIVE_LOOKAHEAD", str(DEFAULT_LOOKAHEAD)))
+
+
+class GrammarTracker:
+    """
+    Follows the automaton state of a single generation as tokens are appended.
+    Shared by the logits processor and the stopping criterion of the same call.
+    """
+
+    def __init__(self, grammar, token_strings, vocab_trie, prompt_len):
+        self.grammar = grammar
+        self.token_strings = token_strings
+        self.vocab_trie = vocab_trie
+        self.prompt_len = prompt_len
+        self.consumed = 0
+        self.state = grammar.initial_state()
+
+    def sync(self, input_ids):
+        new_ids = input_ids[0, self.prompt_len + self.consumed:].tolist()
+        for token_id in new_ids:
+            if self.state is None or self.grammar.is_complete(self.state):
+                break
+            self.state = self.grammar.advance(self.state, self.token_strings[token_id] or "")
+        self.consumed += len(new_ids)
+        return self.state
+
+
+class GrammarLogitsProcessor(LogitsProcessor):
+    """Masks every token that would leave the grammar; only EOS remains once the structure is closed."""
+
+    def __init__(self, tracker, eos_token_id):
+        self.tracker = tracker
+        self.eos_token_id = eos_token_id
+
+    def __call__(self, input_ids, scores):
+        state = self.tracker.sync(input_ids)
+        if state is None or self.tracker.grammar.is_complete(state):
+            allowed = [self.eos_token_id]
+        else:
+            allowed = self.tracker.grammar.allowed_token_ids(state, self.tracker.vocab_trie)
+        mask = torch.full_like(scores, float("-inf"))
+        mask[:, allowed] = 0
+        return scores + mask
+
+
+class GrammarConstraint:
+    """
+    The masking of GrammarLogitsProcessor with an explicit state, for speculative decoding,
+    where draft tokens are masked ahead of the accepted output and may be rolled back.
+    """
+
+    def __init__(self, grammar, token_strings, vocab_trie, eos_token_id):
+        self.grammar = grammar
+        self.token_strings = token_strings
+        self.vocab_trie = vocab_trie
+        self.eos_token_id = eos_token_id
+
+    def initial(self):
+        return self.grammar.initial_state()
+
+    def allowed(self, state):
+        if state is None or self.grammar.is_complete(state):
+            return [self.eos_token_id]
+        return self.grammar.allowed_token_ids(state, self.vocab_trie)
+
+    def advance(self, state, token_id):
+        if state is None or self.grammar.is_complete(state):
+            return state
+        return self.grammar.advance(state, self.token_strings[token_id] or "")
+
+
+class GrammarCompleteCriteria(StoppingCriteria):
+    """Stops generation as soon as the constrained structure has been closed."""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def __call__(self, input_ids, scores, **kwargs):
+        state = self.tracker.sync(input_ids)
+        return state is None or self.tracker.grammar.is_complete(state)
+
+
+class CancelCriteria(StoppingCriteria):
+    """Stops generation at the next decoding step once the request's cancel token is set."""
+
+    def __init__(self, cancel):
+        self.cancel = cancel
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.cancel.cancelled
+
+
+class StopSequenceCriteria(StoppingCriteria):
+    """
+    Stops generation once the generated tokens contain a stop token sequence, or their
+    text contains a stop string. Only the tail of the output is checked at each step
+    (enough tokens to hold the longest stop), which also catches stop strings spanning
+    several tokens.
+    """
+
+    def __init__(self, tokenizer, prompt_len, stops=None, stop_token_ids=None):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.stops = [stop for stop in stops or () if stop]
+        self.stop_token_ids = [list(sequence) for sequence in stop_token_ids or () if sequence]
+        # Every token holds at least one character, so this many tokens hold any stop string.
+        self.window = max(
+            [len(stop) for stop in self.stops] + [len(sequence) for sequence in self.stop_token_ids] + [1]
+        ) + 1
+        self.matched = False
+
+    def __call__(self, input_ids, scores, **kwargs):
+        tail = input_ids[0][max(self.prompt_len, input_ids.shape[-1] - self.window):].tolist()
+        for sequence in self.stop_token_ids:
+            if tail[-len(sequence):] == sequence:
+                self.matched = True
+        if self.stops and not self.matched:
+            text = self.tokenizer.decode(tail, skip_special_tokens=False)
+            self.matched = find_stop(text, self.stops) is not None
+        return self.matched
+
+
+class HFMistralBackend(GenerationBackend):
+    name = "hf"
+
+    def __init__(self, model_name=MODEL_NAME, draft_model_name=DRAFT_MODEL, lookahead=SPECULATIVE_LOOKAHEAD,
+                 artifact=MODEL_ARTIFACT):
+        import bitsandbytes  # 4-bit weights on GPU (not needed by the CPU backend)
+        import accelerate
+
+        if artifact:
+            print(f"[INFO] Loading the pre-quantized model artifact {artifact}...")
+            self.tokenizer, self.model, _ = load_artifact(artifact)
+        else:
+            print("[INFO] Loading the LlamaTokenizer and MistralForCausalLM...")
+            timer = LoadTimer()
+            with timer.phase("tokenizer"):
+                self.tokenizer = LlamaTokenizer.from_pretrained(
+                    model_name,
+                    trust_remote_code=True
+                )
+            with timer.phase("weights"):
+                self.model = MistralForCausalLM.from_pretrained(
+                    model_name,
+                    torch_dtype=torch.float16,
+                    device_map="auto",
+                    load_in_8bit=False,
+                    load_in_4bit=True,
+                )
+            timer.report(model_name)
+        print("[INFO] Model loaded successfully!")
+        speculative = None
+        if draft_model_name:
+            print(f"[INFO] Loading the draft model {draft_model_name} (lookahead {lookahead})...")
+            draft = AutoModelForCausalLM.from_pretrained(
+                draft_model_name,
+                torch_dtype=torch.float16,
+                device_map="auto",
+            )
+            speculative = SpeculativeDecoder(self.model, draft, lookahead=lookahead)
+        self.init_runtime(speculative)
+
+    def init_runtime(self, speculative=None):
+        """Per-backend state of the decoding code, once `self.tokenizer` and `self.model` are loaded."""
+        self.speculative = speculative
+        self._token_strings = None
+        self._vocab_trie = None
+
+    def get_token_strings(self):
+        """Surface text of every token id (computed once)."""
+        if self._token_strings is None:
+            self._token_strings = token_surface_strings(self.tokenizer)
+        return self._token_strings
+
+    def get_vocab_trie(self):
+        """Character trie over the vocabulary used for constrained decoding (built once)."""
+        if self._vocab_trie is None:
+            self._vocab_trie = VocabTrie(self.get_token_strings())
+        return self._vocab_trie
+
+    def count_tokens(self, text):
+        return len(self.encode(text))
+
+    def encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False).input_ids
+
+    def bos_token_ids(self):
+        # Not every tokenizer has add_bos_token (e.g. the smaller models of the CPU backend),
+        # and some have no BOS token at all.
+        add_bos = getattr(self.tokenizer, "add_bos_token", True)
+        bos_token_id = self.tokenizer.bos_token_id
+        return [bos_token_id] if add_bos and bos_token_id is not None else []
+
+    def generate(self, request):
+        if request.prompt_ids is not None:
+            input_ids = torch.tensor([request.prompt_ids], device=self.model.device)
+        else:
+            input_ids = self.tokenizer(request.prompt, return_tensors="pt").input_ids.to(self.model.device)
+        prompt_len = input_ids.shape[-1]
+
+        logits_processor = LogitsProcessorList()
+        stopping_criteria = StoppingCriteriaList()
+        constraint = None
+        if request.grammar is not None:
+            tracker = GrammarTracker(
+                request.grammar, self.get_token_strings(), self.get_vocab_trie(), prompt_len
+            )
+            logits_processor.append(GrammarLogitsProcessor(tracker, self.tokenizer.eos_token_id))
+            stopping_criteria.append(GrammarCompleteCriteria(tracker))
+            constraint = GrammarConstraint(
+                request.grammar, self.get_token_strings(), self.get_vocab_trie(), self.tokenizer.eos_token_id
+            )
+        if request.cancel is not None:
+            if request.cancel.cancelled:
+                return GenerationResult(
+                    text="", prompt_tokens=prompt_len, generated_tokens=0, cancelled=True, finish_reason="cancelled"
+                )
+            stopping_criteria.append(CancelCriteria(request.cancel))
+        stop_criteria = None
+        if request.stop or request.stop_token_ids:
+            stop_criteria = StopSequenceCriteria(self.tokenizer, prompt_len, request.stop, request.stop_token_ids)
+            stopping_criteria.append(stop_criteria)
+
+        if self.speculative is not None:
+            # The grammar is applied through `constraint`; the tracker follows the accepted tokens.
+            output_ids = self.speculative.generate(
+                input_ids,
+                request.max_new_tokens,
+                temperature=request.temperature,
+                repetition_penalty=request.repetition_penalty,
+                eos_token_id=self.tokenizer.eos_token_id,
+                stopping_criteria=stopping_criteria,
+                constraint=constraint,
+            )
+        else:
+            with torch.inference_mode():
+                generated_ids = self.model.generate(
+                    input_ids,
+                    max_new_tokens=request.max_new_tokens,
+                    temperature=request.temperature,
+                    repetition_penalty=request.repetition_penalty,
+                    do_sample=True,
+                    eos_token_id=self.tokenizer.eos_token_id,
+                    logits_processor=logits_processor,
+                    stopping_criteria=stopping_criteria,
+                )
+            output_ids = generated_ids[0][prompt_len:].tolist()
+
+        # Decode the newly generated tokens.
+        generated_tokens = len(output_ids)
+        cancelled = request.cancel is not None and request.cancel.cancelled
+        if cancelled:
+            finish_reason = "cancelled"
+        elif stop_criteria is not None and stop_criteria.matched:
+            finish_reason = "stop_sequence"
+        elif request.grammar is not None and tracker.state is not None and request.grammar.is_complete(tracker.state):
+            finish_reason = "grammar"
+        elif output_ids and output_ids[-1] == self.tokenizer.eos_token_id:
+            finish_reason = "eos"
+        else:
+            finish_reason = "length"
+
+        if finish_reason == "stop_sequence":
+            response_text = self.cut_at_stop(output_ids, request.stop, request.stop_token_ids)
+        else:
+            response_text = self.tokenizer.decode(
+                output_ids,
+                skip_special_tokens=True,
+                clean_up_tokenization_spaces=True,
+            )
+        return GenerationResult(
+            text=response_text,
+            prompt_tokens=prompt_len,
+            generated_tokens=generated_tokens,
+            cancelled=cancelled,
+            finish_reason=finish_reason,
+        )
+
+    def cut_at_stop(self, output_ids, stops, stop_token_ids):
+        """Text of the output up to (not including) its first stop sequence."""
+        index = find_stop_ids(output_ids, stop_token_ids)
+        if index is not None:
+            output_ids = output_ids[:index]
+        text = self.tokenizer.decode(output_ids, skip_special_tokens=False, clean_up_tokenization_spaces=True)
+        position = find_stop(text, stops)
+        if position is not None:
+            text = text[:position]
+        for special in self.tokenizer.all_special_tokens:
+            text = text.replace(special, "")
+        return text
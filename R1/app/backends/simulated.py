@@ -0,0 +1,195 @@
+"""
+Simulated generation backend: a deterministic fake LLM that runs on CPU in microseconds.
+
+It recognises the prompts sent by the other agents and answers with schema-correct
+contents, so that the pipeline behaves as with the real model:
+- R4 classification prompts get "true" or "false";
+- R5 scenario matching (constrained) gets the JSON structure requested by its grammar;
+- R6 explanations get a sentence mentioning the listed options;
+- summarization prompts (see summarization.py) get the first words of each user message;
+- anything else gets a canned chat reply.
+
+The time spent per call follows a configurable latency model (environment variables):
+- R1_SIM_BASE_MS: fixed cost per call (default 5).
+- R1_SIM_PREFILL_MS_PER_TOKEN: cost per prompt token (default 0.05).
+- R1_SIM_DECODE_MS_PER_TOKEN: cost per generated token (default 25, about 40 tokens/s).
+- R1_SIM_JITTER: relative jitter, drawn deterministically from the prompt (default 0).
+"""
+import hashlib
+import json
+import os
+import random
+import re
+import time
+import zlib
+
+from ..summarization import SUMMARY_INSTRUCTION
+from .base import GenerationBackend, GenerationResult, find_stop, find_stop_ids
+
+SERVICE_KEYWORDS = ["service request", "problem", "refund", "claim", "reimburse", "repair", "conflict"]
+
+CHAT_REPLIES = [
+    "I am doing well, thank you! How can I help you today?",
+    "That sounds great. Is there anything I can do for you?",
+    "Thank you for sharing. Let me know if you need help with one of our services.",
+]
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def _words(text):
+    return set(re.findall(r"[a-z]+", text.lower()))
+
+
+def pick_choices(choices, user_message, limit):
+    """
+    The choices sharing the most words with the user request of an R5 prompt (at least
+    one word), at most `limit`, in decreasing order of overlap.
+    """
+    request_words = _words(user_message.split("User Request:", 1)[-1])
+    scored = [(len(_words(choice) & request_words), index, choice) for index, choice in enumerate(choices)]
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [choice for overlap, _, choice in scored if overlap > 0][:limit]
+
+
+def answer_prompt(message):
+    """
+    Answer of the simulated model to an unconstrained prompt (R4 classification, R6
+    explanation, summarization or chat). Also used by the R1 stub of the benchmarks.
+    """
+    if "Reply ONLY with 'true'" in message:
+        user_part = message.split("User input:", 1)[-1].lower()
+        return "true" if any(keyword in user_part for keyword in SERVICE_KEYWORDS) else "false"
+    if "LIST OF OPTIONS:" in message:
+        options = re.findall(r"^- (.+)$", message.split("USER REQUEST:", 1)[0], re.MULTILINE)
+        return (
+            f"Based on your situation, the decision is: {', '.join(options)}. "
+            "We will process it as soon as possible."
+        )
+    if SUMMARY_INSTRUCTION in message:
+        user_lines = re.findall(r"^user: (.{1,80})", message, re.MULTILINE)
+        return "The user talked about: " + "; ".join(user_lines) + "."
+    digest = hashlib.sha1(message.encode()).digest()
+    return CHAT_REPLIES[digest[0] % len(CHAT_REPLIES)]
+
+
+class SimulatedBackend(GenerationBackend):
+    name = "simulated"
+
+    def __init__(self):
+        self.base_ms = float(os.getenv("R1_SIM_BASE_MS", "5"))
+        self.prefill_ms_per_token = float(os.getenv("R1_SIM_PREFILL_MS_PER_TOKEN", "0.05"))
+        self.decode_ms_per_token = float(os.getenv("R1_SIM_DECODE_MS_PER_TOKEN", "25"))
+        self.jitter = float(os.getenv("R1_SIM_JITTER", "0"))
+        print(
+            f"[INFO] Simulated backend: base {self.base_ms}ms, prefill {self.prefill_ms_per_token}ms/token, "
+            f"decode {self.decode_ms_per_token}ms/token, jitter {self.jitter:.0%}"
+        )
+
+    def tokenize(self, text):
+        return _TOKEN_PATTERN.findall(text)
+
+    def count_tokens(self, text):
+        return len(self.tokenize(text))
+
+    def encode(self, text):
+        return [zlib.crc32(token.encode()) & 0x7FFF for token in self.tokenize(text)]
+
+    def simulated_latency(self, prompt, prompt_tokens, generated_tokens):
+        """Seconds a real model would have spent on this call, under the configured latency model."""
+        ms = (
+            self.base_ms
+            + self.prefill_ms_per_token * prompt_tokens
+            + self.decode_ms_per_token * generated_tokens
+        )
+        if self.jitter:
+            seed = int.from_bytes(hashlib.sha1(prompt.encode()).digest()[:8], "big")
+            ms *= 1 + random.Random(seed).uniform(-self.jitter, self.jitter)
+        return max(ms, 0) / 1000.0
+
+    def constrained_answer(self, grammar, user_message):
+        """Pick the choices sharing words with the user request and write them in the grammar's structure."""
+        selected = pick_choices(grammar.choices, user_message, grammar.max_items)
+        text = grammar.opening + ", ".join(json.dumps(choice) for choice in selected) + "]" + grammar.closing
+        state = grammar.advance(grammar.initial_state(), text)
+        if state is None or not grammar.is_complete(state):
+            raise RuntimeError(f"Simulated answer rejected by grammar: {text}")
+        return text
+
+    def answer(self, request):
+        if request.grammar is not None:
+            return self.constrained_answer(request.grammar, request.user_message)
+        return answer_prompt(request.user_message)
+
+    @staticmethod
+    def _cut(text, token_count):
+        """First `token_count` tokens of `text`."""
+        cut = 0
+        for _ in range(token_count):
+            cut = _TOKEN_PATTERN.search(text, cut).end()
+        return text[:cut]
+
+    def apply_stops(self, text, request):
+        """
+        Cut `text` before its first stop sequence, as the real model would have stopped there.
+
+        Returns:
+        - tuple: (text, tokens generated including the stop sequence), or (text, None) if
+          no stop sequence occurs.
+        """
+        best = None  # (position in text, tokens generated)
+        token_ids = self.encode(text)
+        index = find_stop_ids(token_ids, request.stop_token_ids)
+        if index is not None:
+            sequence = next(s for s in request.stop_token_ids if token_ids[index:index + len(s)] == list(s))
+            cut_text = self._cut(text, index)
+            best = (len(cut_text), index + len(sequence))
+        position = find_stop(text, request.stop)
+        if position is not None and (best is None or position < best[0]):
+            stop = next(s for s in request.stop if s and text.startswith(s, position))
+            best = (position, self.count_tokens(text[:position + len(stop)]))
+        if best is None:
+            return text, None
+        return text[:best[0]], best[1]
+
+    def generate(self, request):
+        text = self.answer(request)
+        generated = self.count_tokens(text)
+        finish_reason = "grammar" if request.grammar is not None else "eos"
+        if request.stop or request.stop_token_ids:
+            text, stop_tokens = self.apply_stops(text, request)
+            if stop_tokens is not None:
+                generated = stop_tokens
+                finish_reason = "stop_sequence"
+        if generated > request.max_new_tokens and request.grammar is None:
+            # Cut the answer where the real model would have run out of tokens.
+            text = self._cut(text, min(request.max_new_tokens, self.count_tokens(text)))
+            generated = request.max_new_tokens
+            finish_reason = "length"
+        if request.prompt_ids is not None:
+            prompt_tokens = len(request.prompt_ids)
+        else:
+            prompt_tokens = self.count_tokens(request.prompt)
+        latency = self.simulated_latency(request.prompt, prompt_tokens, generated)
+        result = GenerationResult(
+            text=text, prompt_tokens=prompt_tokens, generated_tokens=generated, finish_reason=finish_reason
+        )
+        if request.cancel is None:
+            time.sleep(latency)
+            return result
+
+        start = time.perf_counter()
+        if not request.cancel.wait(latency):
+            return result
+        # Cancelled: keep the tokens the model would have decoded by now.
+        elapsed_ms = 1000 * (time.perf_counter() - start)
+        decode_ms = elapsed_ms - self.base_ms - self.prefill_ms_per_token * prompt_tokens
+        decoded = int(decode_ms // self.decode_ms_per_token) if self.decode_ms_per_token > 0 else generated
+        decoded = min(max(decoded, 0), generated)
+        return GenerationResult(
+            text=self._cut(text, min(decoded, self.count_tokens(text))),
+            prompt_tokens=prompt_tokens,
+            generated_tokens=decoded,
+            cancelled=True,
+            finish_reason="cancelled",
+        )
@@ -0,0 +1,285 @@
+"""
+Speculative decoding for the Hugging Face backend.
+
+A small draft model sharing the main model's tokenizer proposes `lookahead` tokens one
+by one; the main model then scores all of them in a single forward pass and keeps the
+longest prefix it agrees with, plus one token of its own. Predictable outputs (the JSON
+answers of R5, the templated explanations of R6) are thus produced several tokens per
+forward pass of the 7B model instead of one.
+
+The output follows the main model's distribution exactly:
+- greedy decoding (temperature 0) gives the same tokens as without a draft model;
+- sampling uses the speculative sampling acceptance rule (accept a draft token with
+  probability min(1, p/q), otherwise sample from the normalized max(0, p - q)).
+
+Both models see the same logits processing as `model.generate` in the backend:
+repetition penalty, temperature, top-k, and the grammar of constrained decoding,
+whose automaton state is followed per position so that rejected drafts leave no trace.
+
+Correctness can be checked on CPU with two small models sharing a tokenizer:
+    python -m app.backends.speculative --target HuggingFaceTB/SmolLM2-360M --draft HuggingFaceTB/SmolLM2-135M
+which compares greedy outputs with and without the draft model and prints the
+acceptance rate and the speed-up.
+"""
+import argparse
+import time
+
+import torch
+
+from common.metrics import Counter, Histogram
+
+DEFAULT_LOOKAHEAD = 4
+TOP_K = 50  # same default as `model.generate`
+
+DRAFT_TOKENS = Counter("r1_speculative_draft_tokens_total", "Tokens proposed by the draft model.")
+ACCEPTED_TOKENS = Counter("r1_speculative_accepted_tokens_total", "Draft tokens accepted by the main model.")
+ACCEPTANCE_RATE = Histogram(
+    "r1_speculative_acceptance_rate", "Share of the draft tokens accepted, per generation.",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+TOKENS_PER_PASS = Histogram(
+    "r1_speculative_tokens_per_pass", "Tokens produced per forward pass of the main model, per generation.",
+    buckets=(1, 1.5, 2, 2.5, 3, 3.5, 4, 5, 6, 8),
+)
+
+
+def _crop_cache(cache, length):
+    """Keep the first `length` positions of a key/value cache (DynamicCache or legacy tuples)."""
+    if cache is None:
+        return None
+    if hasattr(cache, "crop"):
+        cache.crop(length)
+        return cache
+    return tuple(tuple(tensor[..., :length, :] for tensor in layer) for layer in cache)
+
+
+class SpeculativeDecoder:
+    """
+    Draft-then-verify decoding with two causal LMs sharing a tokenizer.
+
+    Parameters:
+    - target: The main model (its distribution is the one followed).
+    - draft: The small model proposing tokens.
+    - lookahead (int): Tokens proposed by the draft model per verification pass.
+    """
+
+    def __init__(self, target, draft, lookahead=DEFAULT_LOOKAHEAD, top_k=TOP_K):
+        self.target = target
+        self.draft = draft
+        self.lookahead = lookahead
+        self.top_k = top_k
+        self.vocab_size = target.get_output_embeddings().weight.shape[0]
+
+    def _forward(self, model, tokens, cache):
+        input_ids = torch.tensor([tokens], device=model.device)
+        output = model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+        return output.logits[0].float(), output.past_key_values
+
+    def _probs(self, logits, seen, pending, state, temperature, repetition_penalty, constraint):
+        """
+        Next-token distribution after the known tokens followed by `pending` (draft tokens
+        not accepted yet), processed as by `model.generate`. `seen` marks the vocabulary
+        entries found in the known tokens (for the repetition penalty). In greedy mode
+        (temperature 0) only its argmax matters.
+        """
+        scores = logits.clone()
+        if scores.shape[-1] < self.vocab_size:  # draft vocabulary without the extra tokens of the main model
+            padding = torch.full((self.vocab_size - scores.shape[-1],), float("-inf"), device=scores.device)
+            scores = torch.cat([scores, padding])
+        scores = scores[: self.vocab_size]
+        if repetition_penalty != 1.0:
+            if pending:
+                seen = seen.clone()
+                seen[pending] = True
+            penalized = torch.where(scores < 0, scores * repetition_penalty, scores / repetition_penalty)
+            scores = torch.where(seen.to(scores.device), penalized, scores)
+        if constraint is not None:
+            mask = torch.full_like(scores, float("-inf"))
+            mask[constraint.allowed(state)] = 0
+            scores = scores + mask
+        if temperature <= 0:
+            return torch.softmax(scores, dim=-1)
+        scores = scores / temperature
+        if self.top_k:
+            kth = torch.topk(scores, min(self.top_k, scores.shape[-1])).values[-1]
+            scores = scores.masked_fill(scores < kth, float("-inf"))
+        return torch.softmax(scores, dim=-1)
+
+    @staticmethod
+    def _pick(probs, greedy):
+        if greedy:
+            return int(torch.argmax(probs))
+        return int(torch.multinomial(probs, 1))
+
+    @torch.inference_mode()
+    def generate(self, input_ids, max_new_tokens, temperature=0.7, repetition_penalty=1.1, eos_token_id=None,
+                 stopping_criteria=None, constraint=None):
+        """
+        Generate up to `max_new_tokens` tokens after `input_ids` (a 1 x n tensor).
+
+        Parameters:
+        - stopping_criteria (StoppingCriteriaList, optional): Checked after every token.
+        - constraint (optional): Object with `initial()`, `allowed(state)` and
+          `advance(state, token_id)`, restricting the tokens (constrained decoding).
+
+        Returns:
+        - list of int: The generated token ids.
+        """
+        greedy = temperature <= 0
+        ids = input_ids[0].tolist()
+        prompt_len = len(ids)
+        state = constraint.initial() if constraint is not None else None
+        # Updated as tokens are appended, so that no step reads the whole sequence again:
+        # the tokens seen so far (repetition penalty), and the sequence handed to the
+        # stopping criteria, filled in place (they only read it).
+        seen = torch.zeros(self.vocab_size, dtype=torch.bool, device=input_ids.device)
+        seen[input_ids[0]] = True
+        sequence = torch.empty((1, prompt_len + max_new_tokens), dtype=torch.long)
+        sequence[0, :prompt_len] = input_ids[0].cpu()
+        # Each model's cache covers all the tokens but the last one, fed at the next pass.
+        target_cache = draft_cache = None
+        target_cached = draft_cached = 0
+        if prompt_len > 1:
+            _, target_cache = self._forward(self.target, ids[:-1], None)
+            _, draft_cache = self._forward(self.draft, ids[:-1], None)
+            target_cached = draft_cached = prompt_len - 1
+        drafted = accepted_total = passes = 0
+
+        done = False
+        while not done and len(ids) - prompt_len < max_new_tokens:
+            # 1) The draft model proposes up to `lookahead` tokens.
+            budget = min(self.lookahead, max_new_tokens - (len(ids) - prompt_len) - 1)
+            draft_tokens, draft_probs = [], []
+            draft_state = state
+            feed = ids[draft_cached:]
+            for _ in range(budget):
+                logits, draft_cache = self._forward(self.draft, feed, draft_cache)
+                draft_cached += len(feed)
+                probs = self._probs(logits[-1], seen, draft_tokens, draft_state, temperature,
+                                    repetition_penalty, constraint)
+                token = self._pick(probs, greedy)
+                draft_tokens.append(token)
+                draft_probs.append(probs)
+                if token == eos_token_id:
+                    break
+                if constraint is not None:
+                    draft_state = constraint.advance(draft_state, token)
+                feed = [token]
+
+            # 2) The main model scores the pending token and every draft token at once.
+            logits, target_cache = self._forward(self.target, ids[target_cached:] + draft_tokens, target_cache)
+            offset = len(ids) - 1 - target_cached  # row of the distribution after the last known token
+            passes += 1
+            new_tokens = []
+            verify_state = state
+            for i in range(len(draft_tokens) + 1):
+                probs = self._probs(logits[offset + i], seen, new_tokens, verify_state, temperature,
+                                    repetition_penalty, constraint)
+                if i == len(draft_tokens):
+                    token = self._pick(probs, greedy)  # every draft token accepted: one more for free
+                else:
+                    token = draft_tokens[i]
+                    if greedy:
+                        keep = int(torch.argmax(probs)) == token
+                    else:
+                        keep = torch.rand(()) * draft_probs[i][token] <= probs[token]
+                    if keep:
+                        accepted_total += 1
+                    else:
+                        if greedy:
+                            token = int(torch.argmax(probs))
+                        else:
+                            residual = torch.clamp(probs - draft_probs[i], min=0)
+                            total = residual.sum()
+                            token = self._pick(residual / total if total > 0 else probs, greedy)
+                new_tokens.append(token)
+                if constraint is not None:
+                    verify_state = constraint.advance(verify_state, token)
+                if i == len(draft_tokens) or token != draft_tokens[i] or token == eos_token_id:
+                    break
+            drafted += len(draft_tokens)
+
+            # 3) Append the new tokens one by one, so that stops fall on the exact token.
+            for token in new_tokens:
+                ids.append(token)
+                seen[token] = True
+                sequence[0, len(ids) - 1] = token
+                if constraint is not None:
+                    state = constraint.advance(state, token)
+                if token == eos_token_id or len(ids) - prompt_len >= max_new_tokens:
+                    done = True
+                elif stopping_criteria is not None:
+                    done = bool(torch.as_tensor(stopping_criteria(sequence[:, :len(ids)], None)).any())
+                if done:
+                    break
+
+            # 4) Forget the rejected positions.
+            target_cached = len(ids) - 1
+            target_cache = _crop_cache(target_cache, target_cached)
+            draft_cached = min(draft_cached, len(ids) - 1)
+            draft_cache = _crop_cache(draft_cache, draft_cached)
+
+        generated = len(ids) - prompt_len
+        DRAFT_TOKENS.inc(drafted)
+        ACCEPTED_TOKENS.inc(accepted_total)
+        if drafted:
+            ACCEPTANCE_RATE.observe(accepted_total / drafted)
+        if passes:
+            TOKENS_PER_PASS.observe(generated / passes)
+        self.last_stats = {"drafted": drafted, "accepted": accepted_total, "passes": passes, "generated": generated}
+        return ids[prompt_len:]
+
+
+def main():
+    """Compare greedy outputs with and without a draft model (CPU is fine for small models)."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Check speculative decoding against plain greedy decoding.")
+    parser.add_argument("--target", required=True, help="Main model name or path.")
+    parser.add_argument("--draft", required=True, help="Draft model sharing the main model's tokenizer.")
+    parser.add_argument("--lookahead", type=int, default=DEFAULT_LOOKAHEAD)
+    parser.add_argument("--max-new-tokens", type=int, default=48)
+    parser.add_argument("--prompt", action="append", help="Prompt to test (repeatable).")
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.target)
+    target = AutoModelForCausalLM.from_pretrained(args.target).eval()
+    draft = AutoModelForCausalLM.from_pretrained(args.draft).eval()
+    decoder = SpeculativeDecoder(target, draft, lookahead=args.lookahead)
+    prompts = args.prompt or [
+        'Answer in JSON. The matched scenarios are: {"matched_scenarios": ["',
+        "The decision is: refund request. We will process it as soon as possible. The decision is:",
+        "def fibonacci(n):",
+    ]
+    failures = 0
+    for prompt in prompts:
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        start = time.perf_counter()
+        with torch.inference_mode():
+            reference = target.generate(
+                input_ids, max_new_tokens=args.max_new_tokens, do_sample=False, repetition_penalty=1.1,
+                eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.eos_token_id,
+            )[0][input_ids.shape[-1]:].tolist()
+        plain_s = time.perf_counter() - start
+        start = time.perf_counter()
+        output = decoder.generate(
+            input_ids, args.max_new_tokens, temperature=0, repetition_penalty=1.1,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+        speculative_s = time.perf_counter() - start
+        stats = decoder.last_stats
+        same = output == reference
+        failures += not same
+        print(
+            f"[{'OK' if same else 'MISMATCH'}] {prompt[:40]!r}: {stats['generated']} tokens, "
+            f"acceptance {stats['accepted'] / max(stats['drafted'], 1):.0%}, "
+            f"{stats['generated'] / max(stats['passes'], 1):.2f} tokens/pass, "
+            f"{plain_s:.2f}s -> {speculative_s:.2f}s"
+        )
+        if not same:
+            print(f"    reference:   {tokenizer.decode(reference)!r}\n    speculative: {tokenizer.decode(output)!r}")
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
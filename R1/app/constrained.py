@@ -0,0 +1,265 @@
+"""
+Grammar-constrained decoding helpers for the R1 LLM Service.
+
+A caller of `/generate` may pass an `output_schema` describing the only JSON
+structure it is willing to receive. The schema is compiled into a small
+character-level automaton (`ChoiceArrayGrammar`), and at every decoding step the
+model may only pick tokens whose text keeps the output a valid prefix of that
+structure. Generation stops as soon as the structure is closed.
+
+This module is pure Python on purpose: the torch-specific glue (logits processor
+and stopping criterion) lives next to the model code.
+"""
+import json
+import re
+
+# Whitespace the model may emit before the structure starts (it usually opens
+# its answer with a newline after "<|im_start|>assistant").
+MAX_LEADING_WHITESPACE = 2
+
+_END = object()
+
+# Automaton phases.
+_LEAD = 0        # before the structure, optional whitespace
+_LITERAL = 1     # inside a forced literal (object prefix + "[" or suffix)
+_FIRST_ITEM = 2  # right after "[": first item or "]"
+_NEXT_ITEM = 3   # right after ",": an item is mandatory
+_IN_STRING = 4   # inside a quoted choice
+_AFTER_ITEM = 5  # after a closing quote: "," or "]"
+_DONE = 6
+
+
+class ChoiceArrayGrammar:
+    """
+    Character-level automaton accepting a JSON array whose items are drawn from a
+    fixed list of strings, optionally wrapped in a single-key JSON object.
+
+    Parameters:
+    - choices (list of str): Allowed item values.
+    - unique_items (bool): Forbid the same choice from appearing twice.
+    - max_items (int or None): Maximum number of items in the array.
+    - wrapper_key (str or None): If set, the array is the value of this key in a JSON object.
+
+    States are hashable tuples, so the allowed-token computation can be cached per state.
+    """
+
+    def __init__(self, choices, unique_items=True, max_items=None, wrapper_key=None):
+        self.choices = list(dict.fromkeys(choices))
+        self.unique_items = unique_items
+        self.max_items = len(self.choices) if max_items is None else max_items
+        if unique_items:
+            self.max_items = min(self.max_items, len(self.choices))
+
+        if wrapper_key is None:
+            self.opening = "["
+            self.closing = ""
+        else:
+            self.opening = "{" + json.dumps(wrapper_key) + ": ["
+            self.closing = "}"
+
+        # Trie over the JSON-escaped choices (without the surrounding quotes).
+        # Each node remembers which choices live below it, so that the automaton never
+        # walks into a branch whose choices have all been used already.
+        self._trie = {"labels": set(), "children": {}}
+        for choice in self.choices:
+            node = self._trie
+            node["labels"].add(choice)
+            for ch in json.dumps(choice)[1:-1]:
+                node = node["children"].setdefault(ch, {"labels": set(), "children": {}})
+                node["labels"].add(choice)
+            node[_END] = choice
+
+        self._allowed_cache = {}
+
+    def initial_state(self):
+        return (_LEAD, 0, frozenset())
+
+    def is_complete(self, state):
+        return state[0] == _DONE
+
+    def max_length(self):
+        """Upper bound on the number of characters of any accepted output."""
+        items = sorted((len(json.dumps(c)) for c in self.choices), reverse=True)[: self.max_items]
+        separators = 2 * max(len(items) - 1, 0)
+        return MAX_LEADING_WHITESPACE + len(self.opening) + sum(items) + separators + 1 + len(self.closing)
+
+    def _available(self, node, used):
+        return bool(node["labels"] - used) if self.unique_items else bool(node["labels"])
+
+    def step(self, state, ch):
+        """Return the state reached by consuming `ch`, or None if `ch` is not allowed."""
+        phase, data, used = state
+
+        if phase == _LEAD:
+            if ch in " \n" and data < MAX_LEADING_WHITESPACE:
+                return (_LEAD, data + 1, used)
+            return self.step((_LITERAL, ("open", 0), used), ch)
+
+        if phase == _LITERAL:
+            which, pos = data
+            literal = self.opening if which == "open" else self.closing
+            if pos >= len(literal) or ch != literal[pos]:
+                return None
+            if pos + 1 < len(literal):
+                return (_LITERAL, (which, pos + 1), used)
+            if which == "open":
+                return (_FIRST_ITEM, None, used)
+            return (_DONE, None, used)
+
+        if phase in (_FIRST_ITEM, _NEXT_ITEM):
+            if ch == '"' and self._available(self._trie, used) and len(used) < self.max_items:
+                return (_IN_STRING, self._trie, used)
+            if phase == _NEXT_ITEM and ch == " " and data is None:
+                return (_NEXT_ITEM, "space", used)
+            if phase == _FIRST_ITEM and ch == "]":
+                return self._close(used)
+            return None
+
+        if phase == _IN_STRING:
+            node = data
+            if ch == '"':
+                label = node.get(_END)
+                if label is None or (self.unique_items and label in used):
+                    return None
+                return (_AFTER_ITEM, None, used | {label})
+            child = node["children"].get(ch)
+            if child is None or not self._available(child, used):
+                return None
+            return (_IN_STRING, child, used)
+
+        if phase == _AFTER_ITEM:
+            if ch == "," and len(used) < self.max_items and self._available(self._trie, used):
+                return (_NEXT_ITEM, None, used)
+            if ch == "]":
+                return self._close(used)
+            return None
+
+        return None
+
+    def _close(self, used):
+        if self.closing:
+            return (_LITERAL, ("close", 0), used)
+        return (_DONE, None, used)
+
+    def advance(self, state, text):
+        """Consume a whole string; returns None as soon as a character is rejected."""
+        for ch in text:
+            state = self.step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def allowed_token_ids(self, state, vocab_trie):
+        """
+        List the ids of every token whose text can be appended in `state`.
+
+        The vocabulary trie is walked alongside the automaton, so whole families of
+        tokens sharing a rejected prefix are pruned at once.
+        """
+        key = (state[0], id(state[1]) if state[0] == _IN_STRING else state[1], state[2])
+        cached = self._allowed_cache.get(key)
+        if cached is not None:
+            return cached
+
+        allowed = []
+        stack = [(vocab_trie.root, state)]
+        while stack:
+            node, current = stack.pop()
+            for ch, child in node.children.items():
+                nxt = self.step(current, ch)
+                if nxt is None:
+                    continue
+                allowed.extend(child.token_ids)
+                if child.children:
+                    stack.append((child, nxt))
+
+        self._allowed_cache[key] = allowed
+        return allowed
+
+
+def grammar_from_schema(schema):
+    """
+    Compile the supported subset of JSON Schema into a `ChoiceArrayGrammar`.
+
+    Supported shapes:
+    - {"type": "array", "items": {"enum": [...]}, "uniqueItems": bool, "maxItems": int}
+    - {"type": "object", "properties": {"<key>": <array schema above>}} with exactly one property
+
+    Raises ValueError for anything else.
+    """
+    if not isinstance(schema, dict):
+        raise ValueError("output_schema must be a JSON object.")
+
+    wrapper_key = None
+    if schema.get("type") == "object":
+        properties = schema.get("properties") or {}
+        if len(properties) != 1:
+            raise ValueError("Object schemas must declare exactly one property.")
+        wrapper_key, schema = next(iter(properties.items()))
+
+    if schema.get("type") != "array":
+        raise ValueError("Only array schemas (optionally wrapped in an object) are supported.")
+    items = schema.get("items") or {}
+    choices = items.get("enum")
+    if not isinstance(choices, list) or not all(isinstance(c, str) for c in choices):
+        raise ValueError("Array items must be given as an 'enum' of strings.")
+
+    return ChoiceArrayGrammar(
+        choices,
+        unique_items=schema.get("uniqueItems", True),
+        max_items=schema.get("maxItems"),
+        wrapper_key=wrapper_key,
+    )
+
+
+# ---------------------------
+# Vocabulary trie
+# ---------------------------
+class _VocabNode:
+    __slots__ = ("children", "token_ids")
+
+    def __init__(self):
+        self.children = {}
+        self.token_ids = []
+
+
+class VocabTrie:
+    """Character trie over the surface text of every (non-special) token of a tokenizer."""
+
+    def __init__(self, token_strings):
+        self.root = _VocabNode()
+        for token_id, text in enumerate(token_strings):
+            if not text:
+                continue
+            node = self.root
+            for ch in text:
+                child = node.children.get(ch)
+                if child is None:
+                    child = node.children[ch] = _VocabNode()
+                node = child
+            node.token_ids.append(token_id)
+
+
+_BYTE_TOKEN = re.compile(r"<0x([0-9A-Fa-f]{2})>")
+
+
+def token_surface_strings(tokenizer):
+    """
+    Return, for each token id, the text the token contributes to the output, or None
+    for special tokens and tokens that cannot appear in a constrained answer
+    (non-ASCII byte fallbacks, ChatML control tokens).
+    """
+    pieces = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    special_ids = set(tokenizer.all_special_ids)
+    result = []
+    for token_id, piece in enumerate(pieces):
+        if piece is None or token_id in special_ids or (piece.startswith("<|") and piece.endswith("|>")):
+            result.append(None)
+            continue
+        byte_match = _BYTE_TOKEN.fullmatch(piece)
+        if byte_match:
+            value = int(byte_match.group(1), 16)
+            result.append(chr(value) if value < 0x80 else None)
+            continue
+        result.append(piece.replace("▁", " "))
+    return result
@@ -1,16 +1,25 @@
 import os
+import time
+import asyncio
 import datetime
+import threading
 
 import uvicorn
-from fastapi import FastAPI, Body, Depends
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from fastapi import FastAPI, Body, Depends, HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, inspect, text, and_, or_, func, Column, Index, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 
-import torch
-from transformers import LlamaTokenizer, MistralForCausalLM
-import bitsandbytes
-import accelerate
+from common import deadline, transport
+from common.metrics import Counter, Histogram, TOKEN_BUCKETS, install_metrics
+from common.tracing import install_tracing, span
+
+from .backends import CancelToken, GenerationRequest, load_backend
+from .constrained import grammar_from_schema
+from .prompting import DEFAULT_STOP, PromptBuilder
+from .scheduler import GenerationScheduler, Overloaded, QueueTimeout
+from .summarization import SUMMARY_ENABLED, ActivityTracker, RollingSummarizer
 
 # ---------------------------
 # Database Setup (PostgreSQL)
@@ -24,15 +33,56 @@ Base = declarative_base()
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Serves "newest messages of a session" without reading the rest of the session.
+        Index("ix_messages_session_id_created_at", "session_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String, index=True)
+    session_id = Column(String)
     role = Column(String)  # 'user' or 'assistant'
     text = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    token_count = Column(Integer, nullable=True)  # tokens of the message's ChatML segment
 
 
-# Create tables if they don't exist
-Base.metadata.create_all(bind=engine)
+class SessionSummary(Base):
+    """
+    Rolling summary of the older messages of a session: the messages up to
+    `summarized_until_id` are only represented by the summary in prompts (see
+    summarization.py), and the compaction job deletes them eventually.
+    """
+    __tablename__ = "session_summaries"
+    session_id = Column(String, primary_key=True)
+    summary = Column(String, default="")
+    token_count = Column(Integer, nullable=True)  # tokens of the summary's ChatML segment
+    summarized_until_id = Column(Integer, nullable=True)  # id of the newest message covered
+    summarized_messages = Column(Integer, default=0)
+    archived_messages = Column(Integer, default=0)
+    archived_until = Column(DateTime, nullable=True)  # created_at of the newest archived message
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
+def ensure_schema():
+    """
+    Create the tables if they don't exist, and add the columns and indexes missing from
+    databases created by older versions.
+    """
+    Base.metadata.create_all(bind=engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as connection:
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+    indexes = {index["name"] for index in inspector.get_indexes(Message.__tablename__)}
+    for index in Message.__table__.indexes:
+        if index.name not in indexes:
+            index.create(bind=engine)
+
+
+ensure_schema()
 
 
 # Dependency to get a database session
@@ -44,15 +94,175 @@ def get_db():
         db.close()
 
 
-def get_session_history(db: Session, session_id: str):
-    """Retrieve the conversation history for the given session_id."""
-    messages = (
-        db.query(Message)
+# At most this many messages are loaded per request, read newest first by pages.
+HISTORY_MAX_MESSAGES = int(os.getenv("R1_HISTORY_MAX_MESSAGES", "200"))
+HISTORY_PAGE_SIZE = 32
+
+
+def get_session_history(
+    db: Session, session_id: str, token_budget=None, max_messages=HISTORY_MAX_MESSAGES, after_id=None
+):
+    """
+    Retrieve the newest messages of a session (Message rows, oldest first).
+
+    Messages are read newest first, by pages, on the (session_id, created_at) index, and
+    reading stops once `token_budget` tokens are gathered or `max_messages` are read. The
+    cost therefore depends on the budget, not on the length of the session.
+
+    Parameters:
+    - db (Session): Database session.
+    - session_id (str): The conversation.
+    - token_budget (int, optional): Stop once the messages read hold this many tokens.
+    - max_messages (int): Maximum number of messages to read.
+    - after_id (int, optional): Only read messages with a greater id (the older ones are
+      covered by the session summary).
+
+    Returns:
+    - list of Message: The newest messages, in chronological order.
+    """
+    query = db.query(Message).filter(Message.session_id == session_id)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+    query = query.order_by(Message.created_at.desc(), Message.id.desc())
+    messages = []
+    tokens = 0
+    while len(messages) < max_messages:
+        page_query = query
+        if messages:
+            # Keyset pagination: continue after the oldest message read so far.
+            oldest = messages[-1]
+            page_query = query.filter(
+                or_(
+                    Message.created_at < oldest.created_at,
+                    and_(Message.created_at == oldest.created_at, Message.id < oldest.id),
+                )
+            )
+        page = page_query.limit(min(HISTORY_PAGE_SIZE, max_messages - len(messages))).all()
+        messages.extend(page)
+        tokens += sum(message.token_count or 0 for message in page)
+        if len(page) < HISTORY_PAGE_SIZE or (token_budget is not None and tokens >= token_budget):
+            break
+    messages.reverse()
+    return messages
+
+
+# ---------------------------
+# Retention (compaction of long sessions)
+# ---------------------------
+# Sessions longer than RETENTION_MAX_MESSAGES are cut down to their newest
+# RETENTION_KEEP_MESSAGES messages; the older ones are folded into the session summary.
+RETENTION_MAX_MESSAGES = int(os.getenv("R1_RETENTION_MAX_MESSAGES", "400"))
+RETENTION_KEEP_MESSAGES = int(os.getenv("R1_RETENTION_KEEP_MESSAGES", "100"))
+COMPACTION_INTERVAL_S = float(os.getenv("R1_COMPACTION_INTERVAL_S", "600"))
+COMPACTION_BATCH_SIZE = 1000
+SUMMARY_MAX_CHARS = 2000
+
+
+def extractive_summary(previous_summary, messages):
+    """
+    Fold archived messages into a summary: the previous summary followed by the messages,
+    of which only the last SUMMARY_MAX_CHARS characters are kept.
+    """
+    lines = [previous_summary] if previous_summary else []
+    lines.extend(f"{message.role}: {message.text}" for message in messages)
+    return "\n".join(lines)[-SUMMARY_MAX_CHARS:]
+
+
+def compact_session(db: Session, session_id: str, keep=RETENTION_KEEP_MESSAGES, summarize=extractive_summary):
+    """
+    Archive all but the newest `keep` messages of a session, by batches. Messages already
+    covered by the rolling summary are just deleted; the others are folded into it with
+    `summarize` first.
+
+    Parameters:
+    - db (Session): Database session.
+    - session_id (str): The session to compact.
+    - keep (int): Number of recent messages left untouched.
+    - summarize (callable): (previous summary, archived messages) -> new summary.
+
+    Returns:
+    - int: Number of messages archived.
+    """
+    newest_first = (
+        db.query(Message.created_at, Message.id)
         .filter(Message.session_id == session_id)
-        .order_by(Message.created_at)
-        .all()
+        .order_by(Message.created_at.desc(), Message.id.desc())
     )
-    return [(msg.role, msg.text) for msg in messages]
+    boundary = newest_first.offset(keep - 1).limit(1).first() if keep > 0 else None
+    if keep > 0 and boundary is None:
+        return 0
+    archivable = db.query(Message).filter(Message.session_id == session_id)
+    if boundary is not None:
+        archivable = archivable.filter(
+            or_(
+                Message.created_at < boundary.created_at,
+                and_(Message.created_at == boundary.created_at, Message.id < boundary.id),
+            )
+        )
+    archivable = archivable.order_by(Message.created_at, Message.id)
+
+    archived = 0
+    while True:
+        with summarizer.lock:
+            batch = archivable.limit(COMPACTION_BATCH_SIZE).all()
+            if not batch:
+                return archived
+            summary = db.get(SessionSummary, session_id)
+            if summary is None:
+                summary = SessionSummary(session_id=session_id, summary="", archived_messages=0)
+                db.add(summary)
+            covered_until = summary.summarized_until_id or 0
+            uncovered = [message for message in batch if message.id > covered_until]
+            if uncovered:
+                summary.summary = summarize(summary.summary, uncovered)
+                summary.summarized_until_id = max(covered_until, batch[-1].id)
+                summary.summarized_messages = (summary.summarized_messages or 0) + len(uncovered)
+                summary.token_count = None
+                summary.updated_at = datetime.datetime.utcnow()
+            summary.archived_messages = (summary.archived_messages or 0) + len(batch)
+            summary.archived_until = batch[-1].created_at
+            db.query(Message).filter(Message.id.in_([message.id for message in batch])).delete(
+                synchronize_session=False
+            )
+            db.commit()
+        archived += len(batch)
+
+
+def compact_sessions(max_messages=RETENTION_MAX_MESSAGES, keep=RETENTION_KEEP_MESSAGES):
+    """
+    Compact every session longer than `max_messages` messages.
+
+    Returns:
+    - dict: {session_id: number of messages archived}
+    """
+    db = SessionLocal()
+    try:
+        long_sessions = (
+            db.query(Message.session_id)
+            .group_by(Message.session_id)
+            .having(func.count(Message.id) > max_messages)
+            .all()
+        )
+        return {row.session_id: compact_session(db, row.session_id, keep) for row in long_sessions}
+    finally:
+        db.close()
+
+
+def compaction_worker(interval=COMPACTION_INTERVAL_S):
+    while True:
+        time.sleep(interval)
+        try:
+            archived = compact_sessions()
+            if archived:
+                print(f"[INFO] Compaction archived {sum(archived.values())} messages from {len(archived)} sessions")
+        except Exception as e:
+            print(f"[ERROR] Compaction failed: {e}")
+
+
+def start_compaction_worker():
+    """Run the compaction job every R1_COMPACTION_INTERVAL_S seconds (0 disables it)."""
+    if COMPACTION_INTERVAL_S > 0:
+        threading.Thread(target=compaction_worker, name="compaction", daemon=True).start()
 
 
 # ---------------------------
@@ -67,75 +277,94 @@ a PostgreSQL database for session management.
 """,
     version="1.0.0",
 )
-
-print("[INFO] Loading the LlamaTokenizer and MistralForCausalLM...")
-MODEL_NAME = "NousResearch/Nous-Hermes-2-Mistral-7B-DPO"
-
-tokenizer = LlamaTokenizer.from_pretrained(
-    MODEL_NAME,
-    trust_remote_code=True
+install_tracing(app, "R1")
+install_metrics(app, "R1")
+deadline.install_deadline(app)
+
+# Generation backend ("hf" on GPU by default, "simulated" for CPU-only load tests).
+backend = load_backend()
+# Prompts are built as token ids within R1_PROMPT_TOKEN_BUDGET tokens (see prompting.py).
+prompt_builder = PromptBuilder(backend)
+# Generation slots granted by priority class, shortest job first (see scheduler.py).
+scheduler = GenerationScheduler()
+# Rolling session summaries, written by the LLM while no user turn is running.
+activity = ActivityTracker()
+summarizer = RollingSummarizer(SessionLocal, Message, SessionSummary, backend, activity, scheduler)
+
+
+@app.on_event("startup")
+def start_background_jobs():
+    start_compaction_worker()
+    if SUMMARY_ENABLED:
+        summarizer.start()
+
+
+# Generation metrics, exposed on /metrics next to the per-route HTTP metrics.
+PROMPT_TOKENS = Histogram("r1_prompt_tokens", "Prompt length of generation requests, in tokens.", buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS = Histogram("r1_generated_tokens", "Tokens generated per request.", buckets=TOKEN_BUCKETS)
+TOKENS_TOTAL = Counter("r1_tokens_total", "Tokens processed, by kind (prompt or generated).", ["kind"])
+TOKENS_PER_SECOND = Histogram(
+    "r1_generation_tokens_per_second", "Generated tokens per second of generation time.",
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500),
 )
-
-model = MistralForCausalLM.from_pretrained(
-    MODEL_NAME,
-    torch_dtype=torch.float16,
-    device_map="auto",
-    load_in_8bit=False,
-    load_in_4bit=True,
+GENERATION_SECONDS = Histogram("r1_generation_seconds", "Time spent in the generation backend.", ["backend"])
+FINISHED_GENERATIONS = Counter(
+    "r1_generations_finished_total", "Generations by the reason they ended (eos, stop_sequence, ...).", ["reason"]
+)
+CANCELLED_GENERATIONS = Counter(
+    "r1_generations_cancelled_total", "Generations stopped because their caller went away, by reason.", ["reason"]
+)
+TOKENS_SAVED = Counter(
+    "r1_cancelled_tokens_saved_total", "Tokens not generated thanks to cancellations (max_new_tokens left)."
 )
 
-print("[INFO] Model loaded successfully!")
+# Time kept after the generation, before the caller's deadline, to store and send the answer.
+DEADLINE_MARGIN_S = float(os.getenv("R1_DEADLINE_MARGIN_S", "0.2"))
 
 
-def build_prompt(session_history, summary_threshold=10, recent_exchange_count=2):
+class DecodeRate:
+    """
+    Generation time per token, smoothed over the recent generations (prefill included,
+    so it errs on the slow side). Used to fit `max_new_tokens` in the caller's deadline.
     """
-    Build a prompt that includes a summary of older conversation history if it grows too long,
-    while retaining the most recent exchanges.
 
-    Parameters:
-    - session_history (list of (role, text)): Full conversation history.
-    - summary_threshold (int): Minimum number of messages before summarization is applied.
-    - recent_exchange_count (int): Number of recent exchanges (user and assistant pairs) to include fully.
+    def __init__(self, seconds_per_token=0.05, smoothing=0.2):
+        self.seconds_per_token = seconds_per_token
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
 
-    Returns:
-    - str: The prompt string formatted for the Mistral-based chat model.
-    """
-    system_prompt = (
-        "<|im_start|>system\n"
-        "You are a sentient, superintelligent artificial general intelligence, here to assist.\n"
-        "<|im_end|>\n"
-    )
+    def observe(self, generated_tokens, elapsed):
+        if generated_tokens <= 0:
+            return
+        with self._lock:
+            self.seconds_per_token += self.smoothing * (elapsed / generated_tokens - self.seconds_per_token)
 
-    # If the conversation is short, include the entire history.
-    if len(session_history) <= summary_threshold:
-        prompt_text = system_prompt
-        for role, text in session_history:
-            prompt_text += f"<|im_start|>{role}\n{text}\n<|im_end|>\n"
-        prompt_text += "<|im_start|>assistant"
-        return prompt_text
-
-    # Otherwise, split the history into older messages and recent exchanges.
-    messages_per_exchange = 2 
-    num_recent_messages = recent_exchange_count * messages_per_exchange
-
-    older_messages = session_history[:-num_recent_messages]
-    recent_messages = session_history[-num_recent_messages:]
-
-    # Summarize older messages.
-    summary_lines = []
-    for role, text in older_messages:
-        summary_lines.append(f"{role}: {text}")
-    summary_text = "\n".join(summary_lines)
-    summary_text = summary_text[:1000]
-
-    prompt_text = system_prompt
-    prompt_text += (
-        f"<|im_start|>assistant\nSummary of previous conversation:\n{summary_text}\n<|im_end|>\n"
-    )
-    for role, text in recent_messages:
-        prompt_text += f"<|im_start|>{role}\n{text}\n<|im_end|>\n"
-    prompt_text += "<|im_start|>assistant"
-    return prompt_text
+    def tokens_within(self, seconds):
+        return int(seconds / self.seconds_per_token)
+
+
+decode_rate = DecodeRate(float(os.getenv("R1_INITIAL_SECONDS_PER_TOKEN", "0.05")))
+
+# Status code of the requests whose client went away (nginx convention, never seen by the client).
+CLIENT_CLOSED_REQUEST = 499
+# Cancellation reason of the generations that overrun the caller's deadline.
+DEADLINE_EXCEEDED = "deadline exceeded"
+# Limits on the stop sequences of a request.
+MAX_STOP_SEQUENCES = 8
+MAX_STOP_LENGTH = 64
+# How often the /generate endpoint checks that its client is still connected.
+DISCONNECT_POLL_S = 0.1
+
+
+def record_generation_metrics(result, elapsed):
+    PROMPT_TOKENS.observe(result.prompt_tokens)
+    GENERATED_TOKENS.observe(result.generated_tokens)
+    TOKENS_TOTAL.labels(kind="prompt").inc(result.prompt_tokens)
+    TOKENS_TOTAL.labels(kind="generated").inc(result.generated_tokens)
+    GENERATION_SECONDS.labels(backend=backend.name).observe(elapsed)
+    FINISHED_GENERATIONS.labels(reason=result.finish_reason).inc()
+    if elapsed > 0 and result.generated_tokens:
+        TOKENS_PER_SECOND.observe(result.generated_tokens / elapsed)
 
 
 @app.get("/health", summary="Check Health of the Service")
@@ -144,13 +373,53 @@ def health_check():
     return {"status": "OK"}
 
 
+@app.get("/load", summary="Current load of the generation scheduler")
+def load():
+    """
+    Generation slots, running and queued generations of this worker. Polled by the
+    replica router (router.py) to balance the load between workers.
+    """
+    return scheduler.stats()
+
+
+async def cancel_on_disconnect(request: Request, cancel: CancelToken):
+    """Cancel `cancel` as soon as the client of `request` disconnects."""
+    while not cancel.cancelled:
+        if await request.is_disconnected():
+            cancel.cancel("client disconnected")
+            return
+        await asyncio.sleep(DISCONNECT_POLL_S)
+
+
 @app.post("/generate", summary="Generate a response from the LLM")
-def generate_text(
+async def generate_text(
+    request: Request,
     session_id: str = Body(..., description="Unique identifier for the conversation session."),
     user_message: str = Body(..., description="User's current message."),
     max_new_tokens: int = Body(200, description="Max tokens to generate in response."),
     temperature: float = Body(0.7, description="Sampling temperature for generation."),
     repetition_penalty: float = Body(1.1, description="Penalty to reduce repeated phrases."),
+    output_schema: dict | None = Body(
+        None,
+        description=(
+            "Optional JSON schema the answer must follow (constrained decoding). Supported: an array "
+            "whose items are an 'enum' of strings, optionally wrapped in a single-key object."
+        ),
+    ),
+    priority: str | None = Body(
+        None,
+        description=(
+            "Scheduling class: 'critical' (short classification/matching prompts), 'interactive' "
+            "(default, chat replies) or 'bulk' (long answers)."
+        ),
+    ),
+    stop: list[str] | None = Body(
+        None,
+        description="Stop strings: generation ends at the first one, which is not included in the response.",
+    ),
+    stop_token_ids: list[list[int]] | None = Body(
+        None, description="Stop sequences of token ids, handled like 'stop'."
+    ),
     db: Session = Depends(get_db)
 ):
     """
@@ -160,51 +429,292 @@ def generate_text(
     - session_id: string, unique identifier
     - user_message: user's input
     - optional generation parameters
+    - optional output_schema: when given, decoding is restricted to outputs matching
+      the schema and stops as soon as the JSON structure is closed
+    - optional stop / stop_token_ids: stop sequences, in addition to the end of the
+      ChatML turn (`<|im_end|>`)
 
-    Returns the LLM-generated response as JSON.
-    """
-    # Save the user's message to the database.
-    user_msg = Message(session_id=session_id, role="user", text=user_message)
-    db.add(user_msg)
-    db.commit()
-    db.refresh(user_msg)
-
-    # Retrieve session history from the database.
-    session_history = get_session_history(db, session_id)
+    Returns the LLM-generated response as JSON, with the reason the generation ended
+    (finish_reason: "eos", "stop_sequence", "grammar" or "length").
 
-    prompt_str = build_prompt(session_history)
-    input_ids = tokenizer(prompt_str, return_tensors="pt").input_ids.to("cuda")
+    The user message and the answer are stored together once the answer is generated. If
+    the client disconnects (or times out) before the answer is ready, the generation is
+    stopped at the next token, nothing is stored, and the request ends with status 499.
 
-    with torch.inference_mode():
-        generated_ids = model.generate(
-            input_ids,
+    Requests wait for the model by priority class, then shortest first. When too many
+    requests are waiting, the request is refused with status 429 (too many of its class)
+    or 503 (queue full), with a Retry-After header.
+    """
+    cancel = CancelToken()
+    watcher = asyncio.create_task(cancel_on_disconnect(request, cancel))
+    try:
+        return await run_in_threadpool(
+            run_generation,
+            db,
+            session_id,
+            user_message,
             max_new_tokens=max_new_tokens,
             temperature=temperature,
             repetition_penalty=repetition_penalty,
-            do_sample=True,
-            eos_token_id=tokenizer.eos_token_id,
+            output_schema=output_schema,
+            priority=priority,
+            stop=stop,
+            stop_token_ids=stop_token_ids,
+            cancel=cancel,
         )
+    finally:
+        watcher.cancel()
+
+
+def record_cancellation(reason, max_new_tokens, generated_tokens=0):
+    CANCELLED_GENERATIONS.labels(reason=reason).inc()
+    TOKENS_SAVED.inc(max(max_new_tokens - generated_tokens, 0))
+
+
+def cancelled_error(cancel):
+    """HTTPException ending a cancelled generation: 504 past the deadline, 499 otherwise."""
+    status_code = 504 if cancel.reason == DEADLINE_EXCEEDED else CLIENT_CLOSED_REQUEST
+    return HTTPException(status_code=status_code, detail=f"Generation cancelled: {cancel.reason}")
+
 
-    # Decode the newly generated tokens.
-    prompt_len = input_ids.shape[-1]
-    output_ids = generated_ids[0][prompt_len:]
-    response_text = tokenizer.decode(
-        output_ids,
-        skip_special_tokens=True,
-        clean_up_tokenization_spaces=True,
+def overloaded_error(error):
+    """HTTPException for a request shed by the scheduler (429 or 503)."""
+    return HTTPException(
+        status_code=error.status_code, detail=str(error), headers={"Retry-After": str(error.retry_after)}
     )
 
-    # Save the assistant's response in the database.
-    assistant_msg = Message(session_id=session_id, role="assistant", text=response_text)
+
+def fit_to_deadline(max_new_tokens):
+    """
+    Cap `max_new_tokens` to what can be generated before the caller's deadline
+    (X-Deadline-Ms header), if any. Raises a 504 if not even one token fits.
+    """
+    left = deadline.remaining()
+    if left is None:
+        return max_new_tokens
+    fitting = decode_rate.tokens_within(left - DEADLINE_MARGIN_S)
+    if fitting < 1:
+        record_cancellation(DEADLINE_EXCEEDED, max_new_tokens)
+        raise HTTPException(status_code=504, detail="Not enough time left before the deadline to generate")
+    return min(max_new_tokens, fitting)
+
+
+def run_generation(
+    db: Session,
+    session_id: str,
+    user_message: str,
+    max_new_tokens=200,
+    temperature=0.7,
+    repetition_penalty=1.1,
+    output_schema=None,
+    priority=None,
+    stop=None,
+    stop_token_ids=None,
+    cancel=None,
+):
+    """
+    Generate the answer, then store the user message and the answer (the body of POST
+    /generate). Nothing is stored for a request that fails, is cancelled or is shed, so a
+    retry does not leave the user message twice in the session.
+
+    Parameters:
+    - priority (str, optional): Scheduling class of the request (see scheduler.py).
+    - stop (list of str, optional), stop_token_ids (list of lists of int, optional): Stop
+      sequences of the caller.
+    - cancel (CancelToken, optional): Stops the generation when cancelled. A cancelled
+      generation raises an HTTPException with status 499.
+
+    Under a deadline (X-Deadline-Ms header), `max_new_tokens` is capped to what the model
+    can generate in time, and the generation is cancelled (status 504) if it overruns.
+
+    Returns:
+    - dict: The /generate response.
+    """
+    grammar = None
+    if output_schema is not None:
+        try:
+            grammar = grammar_from_schema(output_schema)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=f"Unsupported output_schema: {e}")
+        # No accepted answer is longer than this many characters, hence tokens.
+        max_new_tokens = min(max_new_tokens, grammar.max_length())
+    stop, stop_token_ids = stop_sequences(stop, stop_token_ids, constrained=grammar is not None)
+    max_new_tokens = fit_to_deadline(max_new_tokens)
+    # Refuse the request now rather than after building its prompt, if it would be shed.
+    try:
+        scheduler.admit(priority)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Overloaded as e:
+        raise overloaded_error(e)
+
+    # The user's message, with its token count: only stored with the answer.
+    user_ids = prompt_builder.encode_message("user", user_message)
+    user_msg = Message(session_id=session_id, role="user", text=user_message, token_count=len(user_ids))
+
+    # Retrieve session history from the database.
+    with span("db history", session_id=session_id) as history_span:
+        session_summary = db.get(SessionSummary, session_id)
+        session_history = get_session_history(
+            db,
+            session_id,
+            token_budget=prompt_builder.token_budget,
+            after_id=session_summary.summarized_until_id if session_summary is not None else None,
+        )
+        history_span.attributes["messages"] = len(session_history)
+
+    prompt = prompt_builder.build(session_history + [user_msg], summary=session_summary, latest_ids=user_ids)
+    # Persist the token counts computed for messages stored without one.
+    db.commit()
+    # Stop the generation if it overruns the caller's deadline.
+    if cancel is None:
+        cancel = CancelToken()
+    left = deadline.remaining()
+    deadline_timer = None
+    if left is not None:
+        deadline_timer = threading.Timer(left, cancel.cancel, (DEADLINE_EXCEEDED,))
+        deadline_timer.daemon = True
+        deadline_timer.start()
+    try:
+        with scheduler.slot(priority, max_new_tokens, cancel=cancel, timeout=deadline.remaining()):
+            # Less time may be left after waiting for the slot.
+            max_new_tokens = fit_to_deadline(max_new_tokens)
+            result = generate_answer(session_id, user_message, prompt, max_new_tokens, temperature,
+                                     repetition_penalty, grammar, cancel, stop=stop, stop_token_ids=stop_token_ids)
+    except Overloaded as e:  # evicted from the queue by higher-priority requests
+        raise overloaded_error(e)
+    except QueueTimeout as e:
+        record_cancellation(DEADLINE_EXCEEDED, max_new_tokens)
+        raise HTTPException(status_code=504, detail=str(e))
+    finally:
+        if deadline_timer is not None:
+            deadline_timer.cancel()
+    response_text = result.text
+
+    # Save the user's message and the assistant's response in the database, in one commit.
+    assistant_ids = prompt_builder.encode_message("assistant", response_text)
+    assistant_msg = Message(
+        session_id=session_id, role="assistant", text=response_text, token_count=len(assistant_ids)
+    )
+    db.add(user_msg)
     db.add(assistant_msg)
     db.commit()
+    db.refresh(user_msg)
     db.refresh(assistant_msg)
+    prompt_builder.remember(user_msg.id, user_ids)
+    prompt_builder.remember(assistant_msg.id, assistant_ids)
+    summarizer.notify(session_id)
 
     return {
         "response": response_text,
-        "session_id": session_id
+        "session_id": session_id,
+        "finish_reason": result.finish_reason,
     }
 
 
+def stop_sequences(stop, stop_token_ids, constrained=False):
+    """
+    Validate the caller's stop sequences and add the end of the ChatML turn to them
+    (not needed under constrained decoding, which stops when the structure is closed).
+
+    Returns:
+    - tuple: (stop strings, stop token id sequences). Raises a 422 for invalid ones.
+    """
+    stop = list(stop or [])
+    stop_token_ids = [list(sequence) for sequence in stop_token_ids or []]
+    if len(stop) + len(stop_token_ids) > MAX_STOP_SEQUENCES:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_STOP_SEQUENCES} stop sequences are supported")
+    if any(not s or len(s) > MAX_STOP_LENGTH for s in stop) or any(
+        not s or len(s) > MAX_STOP_LENGTH for s in stop_token_ids
+    ):
+        raise HTTPException(
+            status_code=422, detail=f"Stop sequences must hold between 1 and {MAX_STOP_LENGTH} characters or tokens"
+        )
+    if not constrained:
+        stop += [s for s in DEFAULT_STOP if s not in stop]
+    return stop, stop_token_ids
+
+
+def generate_answer(session_id, user_message, prompt, max_new_tokens, temperature, repetition_penalty,
+                    grammar, cancel, stop=None, stop_token_ids=None):
+    """
+    Run the backend on a built prompt.
+
+    Returns:
+    - GenerationResult: The backend's result. Raises an HTTPException if the generation
+      is cancelled, before or while it runs.
+    """
+    if cancel.cancelled:
+        # The client left while the request was waiting: don't start the generation at all.
+        record_cancellation(cancel.reason, max_new_tokens)
+        raise cancelled_error(cancel)
+    with span("generate", backend=backend.name, max_new_tokens=max_new_tokens) as generate_span:
+        generate_span.attributes["history_messages"] = prompt.messages
+        generate_span.attributes["dropped_messages"] = prompt.dropped
+        started = time.perf_counter()
+        with activity.busy():
+            result = backend.generate(
+                GenerationRequest(
+                    session_id=session_id,
+                    prompt=prompt.text,
+                    prompt_ids=prompt.token_ids,
+                    user_message=user_message,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    repetition_penalty=repetition_penalty,
+                    grammar=grammar,
+                    cancel=cancel,
+                    stop=stop,
+                    stop_token_ids=stop_token_ids,
+                )
+            )
+        generate_span.attributes["prompt_tokens"] = result.prompt_tokens
+        generate_span.attributes["generated_tokens"] = result.generated_tokens
+        generate_span.attributes["finish_reason"] = result.finish_reason
+        elapsed = time.perf_counter() - started
+        record_generation_metrics(result, elapsed)
+    if result.cancelled:
+        record_cancellation(cancel.reason, max_new_tokens, result.generated_tokens)
+        print(f"[INFO] Generation for session {session_id} cancelled after "
+              f"{result.generated_tokens} tokens ({cancel.reason})")
+        raise cancelled_error(cancel)
+    decode_rate.observe(result.generated_tokens, elapsed)
+    return result
+
+
+def generate_local(data):
+    """
+    In-process version of POST /generate, used when R1 runs co-located with the agents
+    (see common/transport.py).
+
+    Parameters:
+    - data (dict): The JSON body of a /generate request.
+
+    Returns:
+    - dict: The /generate response.
+    """
+    if "session_id" not in data or "user_message" not in data:
+        raise HTTPException(status_code=422, detail="session_id and user_message are required")
+    db = SessionLocal()
+    try:
+        return run_generation(
+            db,
+            data["session_id"],
+            data["user_message"],
+            max_new_tokens=data.get("max_new_tokens", 200),
+            temperature=data.get("temperature", 0.7),
+            repetition_penalty=data.get("repetition_penalty", 1.1),
+            output_schema=data.get("output_schema"),
+            priority=data.get("priority"),
+            stop=data.get("stop"),
+            stop_token_ids=data.get("stop_token_ids"),
+        )
+    finally:
+        db.close()
+
+
+transport.register_local("R1", "POST", "/generate", generate_local)
+
+
 if __name__ == "__main__":
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000, reload=False)
@@ -0,0 +1,174 @@
+"""
+Token-budget-aware prompt assembly for the R1 LLM Service.
+
+Every message is encoded once, as its ChatML segment:
+- its token count is stored with the message in the database (`Message.token_count`);
+- its token ids are kept in an LRU cache keyed by message id.
+
+A prompt is then filled with the session summary (messages archived by the compaction
+job, see main.py) and the most recent messages that fit in the token budget, using the
+stored counts, and handed to the backend as token ids: the conversation is never
+re-tokenized, and the prefill cost is bounded by the budget instead of growing with the
+length of the conversation.
+
+Each segment starts with a special token (`<|im_start|>`), so encoding the segments
+separately gives the same ids as encoding the whole prompt at once.
+"""
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+SYSTEM_PROMPT = (
+    "<|im_start|>system\n"
+    "You are a sentient, superintelligent artificial general intelligence, here to assist.\n"
+    "<|im_end|>\n"
+)
+ASSISTANT_PREFIX = "<|im_start|>assistant"
+# Generation always stops at the end of the assistant's turn, or if the model starts a new one.
+DEFAULT_STOP = ["<|im_end|>", "<|im_start|>"]
+
+# Maximum number of prompt tokens (system prompt and history included).
+PROMPT_TOKEN_BUDGET = int(os.getenv("R1_PROMPT_TOKEN_BUDGET", "2048"))
+# Number of messages whose token ids are kept in memory.
+TOKEN_CACHE_SIZE = int(os.getenv("R1_TOKEN_CACHE_SIZE", "4096"))
+
+
+def format_message(role, text):
+    """ChatML segment of one message."""
+    return f"<|im_start|>{role}\n{text}\n<|im_end|>\n"
+
+
+def format_summary(summary_text):
+    """ChatML segment of a session summary."""
+    return format_message("assistant", f"Summary of previous conversation:\n{summary_text}")
+
+
+@dataclass
+class BuiltPrompt:
+    token_ids: list
+    text: str
+    messages: int  # history messages included
+    dropped: int  # older messages left out of the budget
+    summary: bool = False  # whether the session summary is included
+
+
+class PromptBuilder:
+    """
+    Builds prompts for one backend (token ids depend on its tokenizer).
+
+    Messages are objects with `id`, `role`, `text` and `token_count` attributes (the
+    `Message` rows of the database).
+    """
+
+    def __init__(self, backend, token_budget=PROMPT_TOKEN_BUDGET, cache_size=TOKEN_CACHE_SIZE):
+        self.backend = backend
+        self.token_budget = token_budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # {message id or summary key: token ids}
+        self._lock = threading.Lock()
+        self.system_ids = backend.bos_token_ids() + backend.encode(SYSTEM_PROMPT)
+        self.assistant_ids = backend.encode(ASSISTANT_PREFIX)
+
+    def encode_message(self, role, text):
+        """Token ids of the ChatML segment of a message (not cached)."""
+        return self.backend.encode(format_message(role, text))
+
+    def remember(self, message_id, token_ids):
+        """Cache the token ids of a message that was just encoded."""
+        with self._lock:
+            self._cache[message_id] = token_ids
+            self._cache.move_to_end(message_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def message_ids(self, message):
+        """
+        Token ids of a message, from the cache or encoded on a miss. Fills in
+        `message.token_count` when it is missing (rows stored before it existed).
+        """
+        with self._lock:
+            token_ids = self._cache.get(message.id)
+            if token_ids is not None:
+                self._cache.move_to_end(message.id)
+        if token_ids is None:
+            token_ids = self.encode_message(message.role, message.text)
+            if message.id is not None:
+                self.remember(message.id, token_ids)
+        if message.token_count is None:
+            message.token_count = len(token_ids)
+        return token_ids
+
+    def token_count(self, message):
+        if message.token_count is None:
+            self.message_ids(message)
+        return message.token_count
+
+    def summary_ids(self, summary):
+        """
+        Token ids of a session summary (a `SessionSummary` row), cached until the summary
+        changes. Fills in `summary.token_count` when it is missing.
+        """
+        key = ("summary", summary.session_id, summary.updated_at)
+        with self._lock:
+            token_ids = self._cache.get(key)
+        if token_ids is None:
+            token_ids = self.backend.encode(format_summary(summary.summary))
+            self.remember(key, token_ids)
+        if summary.token_count is None:
+            summary.token_count = len(token_ids)
+        return token_ids
+
+    def build(self, history, summary=None, latest_ids=None):
+        """
+        Build the prompt for a conversation.
+
+        Parameters:
+        - history (list of messages): Conversation in chronological order, ending with the
+          latest user message.
+        - summary (SessionSummary, optional): Summary of the messages archived out of the session.
+        - latest_ids (list of int, optional): Token ids of the latest message, when the caller
+          already encoded it (e.g. a message not stored yet, which has no id to cache them by).
+
+        Returns:
+        - BuiltPrompt: The prompt token ids and text. The latest message is always included.
+          The summary comes next if it takes at most a quarter of the budget, then older
+          messages are added from the most recent backwards while they fit in the budget.
+        """
+        used = len(self.system_ids) + len(self.assistant_ids)
+        summary_ids = None
+        if summary is not None and summary.summary:
+            summary_ids = self.summary_ids(summary)
+            if len(summary_ids) <= self.token_budget // 4:
+                used += len(summary_ids)
+            else:
+                summary_ids = None
+        selected = []
+        for message in reversed(history):
+            count = self.token_count(message)
+            if selected and used + count > self.token_budget:
+                break
+            selected.append(message)
+            used += count
+        selected.reverse()
+
+        token_ids = list(self.system_ids)
+        parts = [SYSTEM_PROMPT]
+        if summary_ids is not None:
+            token_ids.extend(summary_ids)
+            parts.append(format_summary(summary.summary))
+        for message in selected:
+            if latest_ids is not None and message is history[-1]:
+                token_ids.extend(latest_ids)
+            else:
+                token_ids.extend(self.message_ids(message))
+            parts.append(format_message(message.role, message.text))
+        token_ids.extend(self.assistant_ids)
+        parts.append(ASSISTANT_PREFIX)
+        return BuiltPrompt(
+            token_ids=token_ids,
+            text="".join(parts),
+            messages=len(selected),
+            dropped=len(history) - len(selected),
+            summary=summary_ids is not None,
+        )
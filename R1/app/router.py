@@ -0,0 +1,305 @@
+"""
+Replica router of the R1 LLM Service: one /generate facade in front of several R1
+workers (processes or hosts, each running app.main with its own model).
+
+- Load balancing: a new session goes to the healthy worker with the lowest load, i.e.
+  running and queued generations per slot, as reported on the workers' GET /load
+  (polled every HEALTH_INTERVAL_S) or counted by the router itself if higher.
+- Session affinity: a session then stays on the same worker, which holds its cached
+  prompt token ids (see prompting.py), unless that worker becomes unhealthy, is
+  drained, or is more than AFFINITY_SLACK requests busier than the least loaded one.
+  Every worker shares the same database, so any worker can serve any session.
+- Health checks: a worker that fails HEALTH_FAILURES polls in a row (or a forwarded
+  request, at connection time) is taken out of the rotation until it answers again.
+- Draining: POST /workers/{index}/drain stops sending requests to a worker; once its
+  in-flight requests are done it is reported as "drained" and can be stopped safely.
+  POST /workers/{index}/resume puts it back.
+
+Usage (from the R1 directory):
+    python -m app.router --workers http://gpu1:8000,http://gpu2:8000 --port 8000
+    python -m app.router --spawn 3 --backend simulated   # local workers on ports 8100-8102
+"""
+import argparse
+import atexit
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+import uvicorn
+from fastapi import FastAPI, HTTPException, Response
+
+from common import deadline
+from common.deadline import install_deadline
+from common.metrics import Counter, Gauge, install_metrics
+from common.tracing import install_tracing, outgoing_headers, span
+
+HEALTH_INTERVAL_S = float(os.getenv("R1_ROUTER_HEALTH_INTERVAL_S", "2"))
+HEALTH_FAILURES = 2
+# A pinned session moves to another worker when its worker has this many more
+# requests per slot than the least loaded one.
+AFFINITY_SLACK = float(os.getenv("R1_ROUTER_AFFINITY_SLACK", "2"))
+MAX_PINNED_SESSIONS = 100_000
+
+ROUTED_REQUESTS = Counter(
+    "r1_router_requests_total", "Requests forwarded by the router, by worker and affinity outcome.",
+    ["worker", "affinity"],
+)
+WORKER_LOAD = Gauge("r1_router_worker_load", "Load of each worker (requests per slot).", ["worker"])
+WORKER_HEALTHY = Gauge("r1_router_worker_healthy", "1 if the worker is in the rotation.", ["worker"])
+
+
+class Worker:
+    """An R1 worker, as seen by the router."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.state = "active"  # "active", "draining" or "drained"
+        self.healthy = True
+        self.failures = 0
+        self.slots = 1
+        self.reported = 0  # running + queued generations at the last poll
+        self.in_flight = 0  # requests forwarded by this router and not answered yet
+
+    @property
+    def available(self):
+        return self.healthy and self.state == "active"
+
+    def load(self):
+        return max(self.in_flight, self.reported) / max(self.slots, 1)
+
+    def describe(self):
+        return {
+            "url": self.url,
+            "state": self.state,
+            "healthy": self.healthy,
+            "slots": self.slots,
+            "in_flight": self.in_flight,
+            "load": round(self.load(), 2),
+        }
+
+
+class ReplicaRouter:
+    """
+    Picks a worker for each request (least loaded, sticky per session) and keeps the
+    workers' health and load up to date.
+
+    Parameters:
+    - urls (list of str): Base URLs of the R1 workers.
+    """
+
+    def __init__(self, urls, affinity_slack=AFFINITY_SLACK):
+        if not urls:
+            raise ValueError("the router needs at least one worker")
+        self.workers = [Worker(url) for url in urls]
+        self.affinity_slack = affinity_slack
+        self._sessions = OrderedDict()  # {session_id: Worker}
+        self._lock = threading.Lock()
+
+    def pick(self, session_id):
+        """
+        Choose the worker of a request and count it as in flight.
+
+        Returns:
+        - tuple: (Worker, affinity outcome: "new", "pinned" or "moved").
+        Raises LookupError if no worker is available.
+        """
+        with self._lock:
+            candidates = [worker for worker in self.workers if worker.available]
+            if not candidates:
+                raise LookupError("no R1 worker available")
+            least = min(candidates, key=Worker.load)
+            pinned = self._sessions.get(session_id)
+            if pinned is None:
+                worker, outcome = least, "new"
+            elif pinned.available and pinned.load() <= least.load() + self.affinity_slack:
+                worker, outcome = pinned, "pinned"
+            else:
+                worker, outcome = least, "moved"
+            self._sessions[session_id] = worker
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > MAX_PINNED_SESSIONS:
+                self._sessions.popitem(last=False)
+            worker.in_flight += 1
+            return worker, outcome
+
+    def release(self, worker):
+        with self._lock:
+            worker.in_flight -= 1
+            if worker.state == "draining" and worker.in_flight == 0:
+                worker.state = "drained"
+                print(f"[INFO] Worker {worker.url} drained")
+
+    def mark_failed(self, worker):
+        with self._lock:
+            worker.failures = HEALTH_FAILURES
+            worker.healthy = False
+        WORKER_HEALTHY.labels(worker=worker.url).set(0)
+
+    def drain(self, worker):
+        with self._lock:
+            if worker.state == "active":
+                worker.state = "drained" if worker.in_flight == 0 else "draining"
+
+    def resume(self, worker):
+        with self._lock:
+            worker.state = "active"
+
+    def check(self, worker):
+        """Poll the load of a worker, and update its health."""
+        try:
+            response = requests.get(f"{worker.url}/load", timeout=1)
+            response.raise_for_status()
+            stats = response.json()
+        except Exception as e:
+            with self._lock:
+                worker.failures += 1
+                if worker.healthy and worker.failures >= HEALTH_FAILURES:
+                    worker.healthy = False
+                    print(f"[WARNING] Worker {worker.url} is unhealthy: {e}")
+        else:
+            with self._lock:
+                if not worker.healthy:
+                    print(f"[INFO] Worker {worker.url} is healthy again")
+                worker.failures = 0
+                worker.healthy = True
+                worker.slots = stats.get("slots", 1)
+                worker.reported = stats.get("running", 0) + stats.get("queued", 0)
+        WORKER_HEALTHY.labels(worker=worker.url).set(1 if worker.available else 0)
+        WORKER_LOAD.labels(worker=worker.url).set(worker.load())
+
+    def run_health_checks(self, interval=HEALTH_INTERVAL_S):
+        while True:
+            for worker in self.workers:
+                self.check(worker)
+            time.sleep(interval)
+
+    def start(self):
+        threading.Thread(target=self.run_health_checks, name="health-checks", daemon=True).start()
+
+
+def create_app(router):
+    app = FastAPI(title="R1 LLM Service - replica router")
+    install_tracing(app, "R1-router")
+    install_metrics(app, "R1-router")
+    install_deadline(app)
+
+    @app.on_event("startup")
+    def start_health_checks():
+        router.start()
+
+    @app.get("/health")
+    def health_check():
+        available = sum(worker.available for worker in router.workers)
+        return {"status": "OK" if available else "UNAVAILABLE", "workers_available": available}
+
+    @app.get("/workers")
+    def list_workers():
+        return [worker.describe() for worker in router.workers]
+
+    def get_worker(index):
+        if not 0 <= index < len(router.workers):
+            raise HTTPException(status_code=404, detail=f"No worker #{index}")
+        return router.workers[index]
+
+    @app.post("/workers/{index}/drain")
+    def drain_worker(index: int):
+        worker = get_worker(index)
+        router.drain(worker)
+        return worker.describe()
+
+    @app.post("/workers/{index}/resume")
+    def resume_worker(index: int):
+        worker = get_worker(index)
+        router.resume(worker)
+        return worker.describe()
+
+    @app.post("/generate")
+    def generate(body: dict):
+        """Forward a /generate request to the worker of its session (same body and response)."""
+        session_id = body.get("session_id")
+        if session_id is None:
+            raise HTTPException(status_code=422, detail="session_id is required")
+        # Retry once on another worker if the first one cannot be reached (nothing was sent).
+        for attempt in range(2):
+            try:
+                worker, outcome = router.pick(session_id)
+            except LookupError as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+            ROUTED_REQUESTS.labels(worker=worker.url, affinity=outcome).inc()
+            try:
+                with span("forward", worker=worker.url, affinity=outcome):
+                    upstream = requests.post(
+                        f"{worker.url}/generate",
+                        json=body,
+                        headers=deadline.outgoing_headers(outgoing_headers()),
+                        timeout=deadline.timeout(),
+                    )
+            except requests.ConnectionError as e:
+                print(f"[WARNING] Worker {worker.url} unreachable: {e}")
+                router.mark_failed(worker)
+                continue
+            except (requests.Timeout, deadline.DeadlineExceeded) as e:
+                # The worker answers 504 when the deadline is reached: so does the router.
+                raise HTTPException(status_code=504, detail=f"Deadline exceeded forwarding to {worker.url}: {e}")
+            finally:
+                router.release(worker)
+            headers = {"X-R1-Worker": worker.url}
+            if "Retry-After" in upstream.headers:
+                headers["Retry-After"] = upstream.headers["Retry-After"]
+            return Response(
+                content=upstream.content,
+                status_code=upstream.status_code,
+                media_type="application/json",
+                headers=headers,
+            )
+        raise HTTPException(status_code=503, detail="no R1 worker reachable", headers={"Retry-After": "1"})
+
+    return app
+
+
+def spawn_workers(count, backend, base_port):
+    """
+    Start `count` local workers (uvicorn app.main:app) on consecutive ports, stopped
+    when the router exits. Meant for testing the routing with the simulated backend.
+
+    Returns:
+    - list of str: The workers' URLs.
+    """
+    r1_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, R1_BACKEND=backend)
+    processes = []
+    for i in range(count):
+        port = base_port + i
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+            cwd=r1_dir,
+            env=env,
+        ))
+        print(f"[INFO] Started {backend} worker on port {port}")
+    atexit.register(lambda: [process.terminate() for process in processes])
+    return [f"http://127.0.0.1:{base_port + i}" for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route /generate requests across several R1 workers.")
+    parser.add_argument("--workers", default=os.getenv("R1_WORKERS", ""),
+                        help="Comma-separated base URLs of the workers.")
+    parser.add_argument("--spawn", type=int, default=0, help="Start this many local workers.")
+    parser.add_argument("--backend", default="simulated", help="Backend of the spawned workers.")
+    parser.add_argument("--base-port", type=int, default=8100, help="Port of the first spawned worker.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    urls = [url for url in args.workers.split(",") if url]
+    if args.spawn:
+        urls += spawn_workers(args.spawn, args.backend, args.base_port)
+    uvicorn.run(create_app(ReplicaRouter(urls)), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
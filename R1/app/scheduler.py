@@ -0,0 +1,246 @@
+"""
+Priority-aware admission control for the generations of the R1 LLM Service.
+
+The model runs at most `slots` generations at a time. Requests beyond that wait in a
+queue ordered by priority class, then shortest job first (smallest `max_new_tokens`),
+so that short, latency-critical calls never wait behind long explanations:
+- "critical": classification and matching prompts of R4 and R5 (a few tokens each);
+- "interactive": casual chat replies relayed by the broker;
+- "bulk": long answers, e.g. the solution explanations of R6.
+
+Each class may also be limited to fewer concurrent generations than `slots`, so that
+bulk work never takes every slot. Waiting requests slowly gain precedence within their
+class (`aging_tokens_per_s`), so a long job is not starved by a stream of short ones.
+
+Load is shed instead of queued without bound:
+- 429 when the class already has `max_queue` requests waiting;
+- 503 when the whole queue is full and no lower-priority request can be evicted to make
+  room (evicted requests get the 503 instead).
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from common.metrics import Counter, Gauge, Histogram
+
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("R1_MAX_CONCURRENT_GENERATIONS", "1"))
+MAX_QUEUE = int(os.getenv("R1_MAX_QUEUE", "64"))
+DEFAULT_PRIORITY = "interactive"
+
+QUEUE_DEPTH = Gauge("r1_scheduler_queue_depth", "Generations waiting for a slot, by priority class.", ["priority"])
+RUNNING = Gauge("r1_scheduler_running", "Generations running, by priority class.", ["priority"])
+QUEUE_WAIT_SECONDS = Histogram(
+    "r1_scheduler_queue_wait_seconds", "Time spent waiting for a generation slot, by priority class.", ["priority"]
+)
+SHED_REQUESTS = Counter(
+    "r1_scheduler_shed_total", "Generations refused or evicted to shed load, by priority class and status.",
+    ["priority", "status"],
+)
+
+
+@dataclass
+class PriorityClass:
+    name: str
+    rank: int  # lower runs first
+    max_concurrent: int | None = None  # None: every slot
+    max_queue: int = 32
+
+
+def default_classes(slots=MAX_CONCURRENT_GENERATIONS):
+    return {
+        "critical": PriorityClass("critical", 0),
+        "interactive": PriorityClass("interactive", 1),
+        "bulk": PriorityClass("bulk", 2, max_concurrent=max(1, slots // 2), max_queue=16),
+    }
+
+
+class Overloaded(Exception):
+    """The request was shed: `status_code` is 429 (class queue full) or 503 (server full)."""
+
+    def __init__(self, status_code, message, retry_after=1):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    """No slot became free before the caller's deadline."""
+
+
+class _Waiter:
+    __slots__ = ("cls", "cost", "enqueued", "event", "error")
+
+    def __init__(self, cls, cost):
+        self.cls = cls
+        self.cost = cost
+        self.enqueued = time.monotonic()
+        self.event = threading.Event()  # set when granted a slot or evicted
+        self.error = None  # Overloaded if evicted
+
+
+class GenerationScheduler:
+    """
+    Grants generation slots by priority class, then shortest job first.
+
+    Parameters:
+    - slots (int): Generations the model may run at the same time.
+    - classes (dict): {name: PriorityClass}.
+    - max_queue (int): Requests that may wait, all classes together.
+    - aging_tokens_per_s (float): How much a waiting request's cost decreases per second
+      of waiting, when ordering requests of the same class.
+    """
+
+    def __init__(self, slots=MAX_CONCURRENT_GENERATIONS, classes=None, max_queue=MAX_QUEUE,
+                 aging_tokens_per_s=20.0):
+        self.slots = slots
+        self.classes = classes or default_classes(slots)
+        self.max_queue = max_queue
+        self.aging_tokens_per_s = aging_tokens_per_s
+        self._lock = threading.Lock()
+        self._queue = []  # waiting _Waiter objects
+        self._running = {name: 0 for name in self.classes}
+
+    def priority_class(self, priority):
+        """PriorityClass of a priority name (None for the default). Raises ValueError if unknown."""
+        cls = self.classes.get(priority or DEFAULT_PRIORITY)
+        if cls is None:
+            raise ValueError(f"unknown priority {priority!r}, expected one of {sorted(self.classes)}")
+        return cls
+
+    def stats(self):
+        """Slots, running and waiting generations (reported to the replica router)."""
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "running": sum(self._running.values()),
+                "queued": len(self._queue),
+            }
+
+    def _queued(self, cls):
+        return sum(1 for waiter in self._queue if waiter.cls is cls)
+
+    def _can_run(self, cls):
+        running = sum(self._running.values())
+        limit = self.slots if cls.max_concurrent is None else min(cls.max_concurrent, self.slots)
+        return running < self.slots and self._running[cls.name] < limit
+
+    def _shed(self, cls, status_code, message):
+        SHED_REQUESTS.labels(priority=cls.name, status=str(status_code)).inc()
+        return Overloaded(status_code, message)
+
+    def _make_room(self, cls):
+        """
+        Check that a request of `cls` may join the queue, evicting a lower-priority waiter
+        if the queue is full. Returns the Overloaded error to raise, or None.
+        """
+        if self._queued(cls) >= cls.max_queue:
+            return self._shed(cls, 429, f"Too many '{cls.name}' generations waiting")
+        if len(self._queue) < self.max_queue:
+            return None
+        victim = max(self._queue, key=lambda waiter: (waiter.cls.rank, waiter.cost))
+        if victim.cls.rank <= cls.rank:
+            return self._shed(cls, 503, "Generation queue full")
+        self._queue.remove(victim)
+        QUEUE_DEPTH.labels(priority=victim.cls.name).dec()
+        victim.error = self._shed(victim.cls, 503, "Evicted from the generation queue by higher-priority work")
+        victim.event.set()
+        return None
+
+    def admit(self, priority):
+        """
+        Early admission check, before any work is done for the request: raises Overloaded
+        if the request would be shed (nothing is evicted yet).
+        """
+        cls = self.priority_class(priority)
+        with self._lock:
+            if self._can_run(cls) and not self._queue:
+                return
+            if self._queued(cls) >= cls.max_queue:
+                raise self._shed(cls, 429, f"Too many '{cls.name}' generations waiting")
+            if len(self._queue) >= self.max_queue and all(w.cls.rank <= cls.rank for w in self._queue):
+                raise self._shed(cls, 503, "Generation queue full")
+
+    def _dispatch(self):
+        """Grant free slots to the best waiters (caller holds the lock)."""
+        now = time.monotonic()
+        while self._queue:
+            runnable = [waiter for waiter in self._queue if self._can_run(waiter.cls)]
+            if not runnable:
+                return
+            best = min(
+                runnable,
+                key=lambda w: (w.cls.rank, w.cost - self.aging_tokens_per_s * (now - w.enqueued), w.enqueued),
+            )
+            self._queue.remove(best)
+            QUEUE_DEPTH.labels(priority=best.cls.name).dec()
+            self._start(best.cls)
+            best.event.set()
+
+    def _start(self, cls):
+        self._running[cls.name] += 1
+        RUNNING.labels(priority=cls.name).inc()
+
+    def _finish(self, cls):
+        with self._lock:
+            self._running[cls.name] -= 1
+            RUNNING.labels(priority=cls.name).dec()
+            self._dispatch()
+
+    def _acquire(self, cls, cost, cancel=None, timeout=None):
+        with self._lock:
+            if self._can_run(cls) and not self._queue:
+                self._start(cls)
+                QUEUE_WAIT_SECONDS.labels(priority=cls.name).observe(0.0)
+                return True
+            error = self._make_room(cls)
+            if error is not None:
+                raise error
+            waiter = _Waiter(cls, cost)
+            self._queue.append(waiter)
+            QUEUE_DEPTH.labels(priority=cls.name).inc()
+            self._dispatch()
+
+        give_up = None if timeout is None else waiter.enqueued + timeout
+        while not waiter.event.wait(0.1):
+            expired = give_up is not None and time.monotonic() >= give_up
+            if expired or (cancel is not None and cancel.cancelled):
+                with self._lock:
+                    if waiter in self._queue:
+                        self._queue.remove(waiter)
+                        QUEUE_DEPTH.labels(priority=cls.name).dec()
+                        if expired:
+                            raise QueueTimeout("No generation slot became free before the deadline")
+                        return False
+                # Granted (or evicted) meanwhile: fall through.
+                break
+        if waiter.error is not None:
+            raise waiter.error
+        QUEUE_WAIT_SECONDS.labels(priority=cls.name).observe(time.monotonic() - waiter.enqueued)
+        return True
+
+    @contextmanager
+    def slot(self, priority, cost, cancel=None, timeout=None):
+        """
+        Wait for a generation slot, then hold it for the duration of the block.
+
+        Parameters:
+        - priority (str): Name of the priority class (None for the default one).
+        - cost (int): Expected length of the generation (`max_new_tokens`).
+        - cancel (CancelToken, optional): Stops waiting when cancelled.
+        - timeout (float, optional): Maximum wait, in seconds.
+
+        Yields:
+        - bool: False if `cancel` was cancelled before a slot was granted (the block should
+          not generate), True otherwise. Raises Overloaded if the request is shed and
+          QueueTimeout if no slot is granted in time.
+        """
+        cls = self.priority_class(priority)
+        if not self._acquire(cls, cost, cancel=cancel, timeout=timeout):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self._finish(cls)
@@ -0,0 +1,259 @@
+"""
+Rolling conversation summaries for the R1 LLM Service.
+
+Each session keeps its newest messages verbatim (the recent window). When enough
+messages have aged out of that window, a background worker asks the LLM to fold them
+into the session's summary (`SessionSummary` row), and records the id of the last
+message covered. Prompts are then built from the summary and the messages after it,
+so the request path only reads the stored summary and never waits for a summarization.
+
+The worker only runs while the service is idle (no generation in progress for
+`idle_seconds`), so summaries never compete with user turns for the model; a user
+turn arriving during a summarization cancels it, and the session is summarized later.
+Summaries also hold a "bulk" generation slot of the scheduler, so they count in the
+concurrency limit and in the load reported to the router.
+"""
+import datetime
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .backends import CancelToken, GenerationRequest
+from .prompting import DEFAULT_STOP, format_message
+from .scheduler import Overloaded
+
+SUMMARY_ENABLED = os.getenv("R1_SUMMARY_ENABLED", "1") == "1"
+# Newest messages of a session always kept verbatim in prompts.
+SUMMARY_RECENT_MESSAGES = int(os.getenv("R1_SUMMARY_RECENT_MESSAGES", "12"))
+# Messages that must have aged out of the recent window before the summary is updated.
+SUMMARY_MIN_BATCH = int(os.getenv("R1_SUMMARY_MIN_BATCH", "6"))
+SUMMARY_MAX_BATCH = 40
+SUMMARY_IDLE_S = float(os.getenv("R1_SUMMARY_IDLE_S", "2"))
+SUMMARY_MAX_TOKENS = int(os.getenv("R1_SUMMARY_MAX_TOKENS", "200"))
+# Longer messages are cut before being sent to the summarizer.
+SUMMARY_MESSAGE_MAX_CHARS = 1000
+
+SUMMARY_INSTRUCTION = (
+    "Write an updated summary of the whole conversation in a few sentences. Keep the facts, "
+    "names, requests, decisions and open questions; leave out greetings and small talk. "
+    "Answer with the summary only."
+)
+
+
+def build_summary_prompt(previous_summary, messages):
+    """
+    Prompt asking the LLM to fold `messages` into `previous_summary`.
+
+    Returns:
+    - str: The ChatML prompt.
+    """
+    lines = []
+    if previous_summary:
+        lines.append(f"Summary of the conversation so far:\n{previous_summary}\n")
+    lines.append("Next messages of the conversation:")
+    for message in messages:
+        text = message.text
+        if len(text) > SUMMARY_MESSAGE_MAX_CHARS:
+            text = text[:SUMMARY_MESSAGE_MAX_CHARS] + " [...]"
+        lines.append(f"{message.role}: {text}")
+    lines.append(f"\n{SUMMARY_INSTRUCTION}")
+    return (
+        format_message("system", "You summarize conversations between a user and an assistant.")
+        + format_message("user", "\n".join(lines))
+        + "<|im_start|>assistant\n"
+    )
+
+
+class ActivityTracker:
+    """
+    Counts the generations in progress, to tell when the service is idle. A user
+    generation cancels the background generations in progress (they are retried later).
+    """
+
+    def __init__(self):
+        self._active = 0
+        self._last_activity = time.monotonic()
+        self._background = set()  # cancel tokens of background generations
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def background(self, idle_for=0.0):
+        """
+        Yields the cancel token of a background generation, or None if the service was
+        not idle for `idle_for` seconds (the background generation must not run). The
+        check and the registration of the token are done together, so a user generation
+        starting afterwards always cancels it.
+        """
+        token = CancelToken()
+        with self._lock:
+            idle = self._is_idle(idle_for)
+            if idle:
+                self._background.add(token)
+        if not idle:
+            yield None
+            return
+        try:
+            yield token
+        finally:
+            with self._lock:
+                self._background.discard(token)
+
+    @contextmanager
+    def busy(self):
+        with self._lock:
+            self._active += 1
+            for token in self._background:
+                token.cancel("preempted by a user request")
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._last_activity = time.monotonic()
+
+    def _is_idle(self, for_seconds):
+        return self._active == 0 and time.monotonic() - self._last_activity >= for_seconds
+
+    def is_idle(self, for_seconds):
+        with self._lock:
+            return self._is_idle(for_seconds)
+
+
+class RollingSummarizer:
+    """
+    Background worker keeping the summary of each active session up to date.
+
+    Parameters:
+    - session_factory (callable): Creates a database session.
+    - message_model, summary_model: The `Message` and `SessionSummary` models.
+    - backend (GenerationBackend): Model used to write the summaries.
+    - activity (ActivityTracker): Tells when no user generation is running.
+    - scheduler (GenerationScheduler): Grants the generation slots.
+    """
+
+    def __init__(self, session_factory, message_model, summary_model, backend, activity, scheduler,
+                 recent_messages=SUMMARY_RECENT_MESSAGES, min_batch=SUMMARY_MIN_BATCH,
+                 idle_seconds=SUMMARY_IDLE_S, max_new_tokens=SUMMARY_MAX_TOKENS):
+        self.session_factory = session_factory
+        self.Message = message_model
+        self.SessionSummary = summary_model
+        self.backend = backend
+        self.activity = activity
+        self.scheduler = scheduler
+        self.recent_messages = recent_messages
+        self.min_batch = min_batch
+        self.idle_seconds = idle_seconds
+        self.max_new_tokens = max_new_tokens
+        # Serializes the updates of SessionSummary rows (with the compaction job).
+        self.lock = threading.Lock()
+        self._pending = set()  # sessions that got new messages since they were last checked
+        self._pending_lock = threading.Lock()
+
+    def notify(self, session_id):
+        """Called after a turn: the session may have messages to fold into its summary."""
+        with self._pending_lock:
+            self._pending.add(session_id)
+
+    def _next_session(self):
+        with self._pending_lock:
+            return self._pending.pop() if self._pending else None
+
+    def messages_to_fold(self, db, session_id):
+        """Oldest messages that aged out of the recent window and are not covered by the summary yet."""
+        Message = self.Message
+        summary = db.get(self.SessionSummary, session_id)
+        covered_until = summary.summarized_until_id if summary is not None and summary.summarized_until_id else 0
+        uncovered = db.query(Message).filter(Message.session_id == session_id, Message.id > covered_until)
+        aged_out = uncovered.count() - self.recent_messages
+        if aged_out < self.min_batch:
+            return summary, []
+        batch = uncovered.order_by(Message.created_at, Message.id).limit(min(aged_out, SUMMARY_MAX_BATCH)).all()
+        return summary, batch
+
+    def generate_summary(self, session_id, prompt):
+        """
+        Run the summary generation in a "bulk" slot, if the service is still idle.
+
+        Returns:
+        - GenerationResult: The result, or None if the generation did not run to completion
+          (a user turn arrived, or the slot was refused).
+        """
+        with self.activity.background(self.idle_seconds) as cancel:
+            if cancel is None:
+                return None
+            try:
+                with self.scheduler.slot("bulk", self.max_new_tokens, cancel=cancel) as granted:
+                    if not granted:
+                        return None
+                    result = self.backend.generate(
+                        GenerationRequest(
+                            session_id=f"summary:{session_id}",
+                            prompt=prompt,
+                            user_message=prompt,
+                            max_new_tokens=self.max_new_tokens,
+                            temperature=0.3,
+                            cancel=cancel,
+                            stop=DEFAULT_STOP,
+                        )
+                    )
+            except Overloaded:
+                return None
+        return None if result.cancelled else result
+
+    def summarize_session(self, session_id):
+        """
+        Fold the messages of a session that left the recent window into its summary.
+
+        Returns:
+        - int: Number of messages folded.
+        """
+        db = self.session_factory()
+        try:
+            with self.lock:
+                summary, batch = self.messages_to_fold(db, session_id)
+                if not batch:
+                    return 0
+                previous = summary.summary if summary is not None else ""
+            result = self.generate_summary(session_id, build_summary_prompt(previous, batch))
+            if result is None:
+                self.notify(session_id)  # retried at the next idle period
+                return 0
+            with self.lock:
+                db.expire_all()  # reload what the compaction job may have committed meanwhile
+                summary = db.get(self.SessionSummary, session_id)
+                if summary is None:
+                    summary = self.SessionSummary(session_id=session_id, summary="", archived_messages=0)
+                    db.add(summary)
+                if summary.summarized_until_id and summary.summarized_until_id >= batch[-1].id:
+                    return 0  # covered meanwhile by the compaction job
+                summary.summary = result.text.strip()
+                summary.summarized_until_id = batch[-1].id
+                summary.summarized_messages = (summary.summarized_messages or 0) + len(batch)
+                summary.token_count = None
+                summary.updated_at = datetime.datetime.utcnow()
+                db.commit()
+            return len(batch)
+        finally:
+            db.close()
+
+    def run(self, poll_interval=0.5):
+        while True:
+            time.sleep(poll_interval)
+            if not self.activity.is_idle(self.idle_seconds):
+                continue
+            session_id = self._next_session()
+            if session_id is None:
+                continue
+            try:
+                folded = self.summarize_session(session_id)
+            except Exception as e:
+                print(f"[ERROR] Summarization of session {session_id} failed: {e}")
+                continue
+            if folded:
+                print(f"[INFO] Summary of session {session_id} updated with {folded} messages")
+                # More messages may be waiting (batches are capped), check again later.
+                self.notify(session_id)
+
+    def start(self):
+        threading.Thread(target=self.run, name="summarizer", daemon=True).start()
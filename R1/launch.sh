@@ -1,5 +1,8 @@
 #!/bin/bash
 
+# The shared "common" package (tracing, instrumentation) lives at the repository root.
+export PYTHONPATH="$(cd "$(dirname "$0")/.." && pwd):$PYTHONPATH"
+
 echo "[INFO] Starting PostgreSQL with Docker Compose..."
 docker-compose up -d
 
@@ -1,12 +1,21 @@
-from typing_extensions import TypedDict, Literal
-import requests
+from typing_extensions import TypedDict, Literal, Callable, TypeVar, ParamSpec
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+import json
+import os
 
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import nltk
 
+from common import transport
+from common.deadline import DeadlineExceeded, deadline, install_deadline
+from common.metrics import Histogram, install_metrics
+from common.tracing import install_tracing, outgoing_headers, span
+
 PORT_R1  = 8000
 PORT_R2  = 8002
 PORT_R4  = 8004
@@ -15,6 +24,10 @@ PORT_R6  = 8006
 PORT_R8  = 8008
 PORT_R10 = 8010
 
+# Time budget of a /pipeline turn, forwarded to every agent called during the turn
+# (X-Deadline-Ms header). The GUI may send a shorter one.
+TURN_BUDGET_S = float(os.getenv("AOSE_TURN_BUDGET_S", "30"))
+
 # Copy-pasted from R2
 
 ProjectID = str
@@ -80,6 +93,15 @@ class PayloadFor_SentenceMatcher(BaseModel):
 	alpha      : float                  | None
 	epsilon    : float                  | None
 
+class PayloadFor_TopKMatcher(BaseModel):
+	user_input : str
+	k          : int                           = 1
+	model      : ModelQueryKey          | None = None
+	mean_mode  : MeanMode_Literal       | None = None
+	dist_mode  : WNDistanceMode_Literal | None = None
+	alpha      : float                  | None = None
+	epsilon    : float                  | None = None
+
 class PayloadFor_rAIsonAdapter(BaseModel):  # corresponds to MatchRequest in R6
 	project_id: str
 	user_input: list[str]
@@ -94,35 +116,100 @@ class RawUserInput(BaseModel):
 
 
 
+###############
+# Hop timings #
+###############
+
+HopTiming = tuple[str, float]  # (hop name, duration in seconds)
+
+# Durations of the downstream calls made while handling the current /pipeline request.
+# They are sent back in the X-Pipeline-Timings header so that load tests can tell
+# which hop a turn spent its time in. Each hop is also recorded as a tracing span.
+HOP_TIMINGS : ContextVar[list[HopTiming] | None] = ContextVar("HOP_TIMINGS", default = None)
+
+# Same durations, aggregated over all requests and exposed on /metrics.
+OUTBOUND_CALL_SECONDS = Histogram(
+	"r10_outbound_call_seconds",
+	"Duration of the calls made by the broker to the other agents.",
+	["hop", "function"],
+)
+TURN_SECONDS = Histogram(
+	"r10_turn_seconds",
+	"Duration of /pipeline turns, by the status the session ended the turn in.",
+	["status"],
+)
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+def timed_hop(hop : str) -> Callable[[Callable[P, T]], Callable[P, T]]:
+	"""
+	Decorator recording the duration of a call to a downstream agent under the given hop name.
+	"""
+	def decorator(fn : Callable[P, T]) -> Callable[P, T]:
+		@wraps(fn)
+		def wrapper(*args : P.args, **kwargs : P.kwargs) -> T:
+			start = perf_counter()
+			try:
+				with span(f"call {hop}", function = fn.__name__):
+					return fn(*args, **kwargs)
+			finally:
+				elapsed = perf_counter() - start
+				OUTBOUND_CALL_SECONDS.labels(hop = hop, function = fn.__name__).observe(elapsed)
+				timings = HOP_TIMINGS.get()
+				if timings is not None:
+					timings.append((hop, elapsed))
+		return wrapper
+	return decorator
+
+
+
+@timed_hop("R2")
 def call_R2_for_ad(user_input : str) -> PayloadFor_AdAgent:
 	route = "match_for_ad"
-	headers = {"Content-Type": "application/json"}
+	headers = outgoing_headers({"Content-Type": "application/json"})
 	body = {"user_input": user_input}
-	response = requests.post(f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
+	response = transport.post("R2", f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	result = PayloadFor_AdAgent(**response.json())
 	return result
 
+@timed_hop("R2")
+def call_R2_for_top_k_matches(
+	user_input : str,
+	k          : int = 1,
+) -> ScoresDict:
+	route = "match_top_k"
+	headers = outgoing_headers({"Content-Type": "application/json"})
+	body_obj = PayloadFor_TopKMatcher(user_input = user_input, k = k)
+	body = body_obj.model_dump(exclude_none = True)
+	response = transport.post("R2", f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
+	response.raise_for_status()
+	result = response.json()
+	return result
+
+@timed_hop("R2")
 def call_R2_for_scenario_matching_all_matches(
 	user_input : str,
 	threshold  : float = 0.5,
 ) -> list[PayloadFor_ScenarioMatchingAgent]:
 	route = "match_for_scenario"
-	headers = {"Content-Type": "application/json"}
+	headers = outgoing_headers({"Content-Type": "application/json"})
 	body_obj = RawUserInput(user_input = user_input, threshold = threshold)
 	body = body_obj.model_dump()
-	response = requests.post(f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
+	response = transport.post("R2", f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	result = [PayloadFor_ScenarioMatchingAgent(**match_data) for match_data in response.json()]
 	return result
 
+@timed_hop("R2")
 def call_R2_for_scenario_matching_best_match(user_input : str) -> PayloadFor_ScenarioMatchingAgent:
 	route = "match_for_scenario"
-	headers = {"Content-Type": "application/json"}
+	headers = outgoing_headers({"Content-Type": "application/json"})
 	body_obj = RawUserInput(user_input = user_input)
 	body_obj.get_max = True
 	body = body_obj.model_dump()
-	response = requests.post(f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
+	response = transport.post("R2", f"http://localhost:{PORT_R2}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	best_match = response.json()[0]
 	result = PayloadFor_ScenarioMatchingAgent(**best_match)
@@ -130,44 +217,48 @@ def call_R2_for_scenario_matching_best_match(user_input : str) -> PayloadFor_Sce
 
 def call_R2_for_project_data() -> ProjectsDict:
 	route = "project_data"
-	headers = {"Content-Type": "application/json"}
-	response = requests.get(f"http://localhost:{PORT_R2}/{route}", headers = headers)
+	headers = outgoing_headers({"Content-Type": "application/json"})
+	response = transport.get("R2", f"http://localhost:{PORT_R2}/{route}", headers = headers)
 	response.raise_for_status()
 	result = response.json()
 	return result
 
+@timed_hop("R4")
 def call_R4_check_query(session_id : str, user_input : str) -> bool:
 	route = "classify_input"
-	headers = {"Content-Type": "application/json"}
+	headers = outgoing_headers({"Content-Type": "application/json"})
 	body = {"session_id": session_id, "user_message": user_input}
-	response = requests.post(f"http://localhost:{PORT_R4}/{route}", headers = headers, json = body)
+	response = transport.post("R4", f"http://localhost:{PORT_R4}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	result = response.json()
 	return result
 
+@timed_hop("R1")
 def call_R1_simple(session_id : str, user_input : str) -> str:
 	route = "generate"
-	headers = {"Content-Type": "application/json"}
-	body = {"session_id": session_id, "user_message": user_input}
-	response = requests.post(f"http://localhost:{PORT_R1}/{route}", headers = headers, json = body)
+	headers = outgoing_headers({"Content-Type": "application/json"})
+	body = {"session_id": session_id, "user_message": user_input, "priority": "interactive"}
+	response = transport.post("R1", f"http://localhost:{PORT_R1}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	result = response.json()["response"]
 	return result
 
+@timed_hop("R5")
 def call_R5_for_scenario_matching(payload : PayloadFor_ScenarioMatchingAgent) -> PayloadFor_rAIsonAdapter:
 	route = "match"
-	headers = {"Content-Type": "application/json"}
+	headers = outgoing_headers({"Content-Type": "application/json"})
 	body = payload.model_dump()
-	response = requests.post(f"http://localhost:{PORT_R5}/{route}", headers = headers, json = body)
+	response = transport.post("R5", f"http://localhost:{PORT_R5}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	result = PayloadFor_rAIsonAdapter(**response.json())
 	return result
 
+@timed_hop("R6")
 def call_R6_for_raison(payload: PayloadFor_rAIsonAdapter) -> str:
 	route = "find_solution"
-	headers = {"Content-Type": "application/json"}
+	headers = outgoing_headers({"Content-Type": "application/json"})
 	body = payload.model_dump()
-	response = requests.post(f"http://localhost:{PORT_R6}/{route}", headers = headers, json = body)
+	response = transport.post("R6", f"http://localhost:{PORT_R6}/{route}", headers = headers, json = body)
 	response.raise_for_status()
 	result = response.json()["text"]
 	return result
@@ -192,11 +283,21 @@ SessionStatus = Literal[
 	"query_chat_return_raison_response",
 ]
 
+PROJECTS_DATA    : ProjectsDict = {}
+ONGOING_STATUSES : dict[SessionID, tuple[SessionStatus, ProjectID | None]] = {}
+
+def startup() -> None:
+	"""
+	Loads the project descriptions from R2. Must run before serving, whether the broker
+	runs on its own or co-located with the other agents.
+	"""
+	PROJECTS_DATA.update(call_R2_for_project_data())
+
 
 def middleware_pipeline(
 	session_id : SessionID,
 	user_input : str,
-)-> str:
+)-> tuple[str, SessionStatus]:
 	"""
 	Orchestrates the entire pipeline:
 	- if in the "check_casual_or_query" mode, calls R4 to see whther the user is
@@ -213,6 +314,8 @@ def middleware_pipeline(
 	    input with scenarios
 	- if in the "query_chat_call_raison_adapter" mode, calls R6 to get run the scenario choice on rAIson
 	- if in the "query_chat_return_raison_response" mode, returns the R6 response to GUI
+
+	Returns the response text and the status the session ended the turn in.
 	"""
 	if session_id not in ONGOING_STATUSES:
 		ONGOING_STATUSES[session_id] = ("check_casual_or_query", None)
@@ -246,9 +349,7 @@ def middleware_pipeline(
 			# ranked_matched_services = call_R2_for_ad(user_input)
 			# current_status = "query_chat_call_ad_agent"
 			# ad_text = call_R8_for_ad(session_id, ranked_matched_services)
-			matches = call_R2_for_scenario_matching_all_matches(user_input, threshold = 0.0)
-			matches = [matches[0]]
-			project_id = matches[0].project_id
+			matches = call_R2_for_top_k_matches(user_input, k = 1)
 			print(f"R2: Found {len(matches)} matches for ads: {matches}")
 			if len(matches) == 0:
 				result = (
@@ -257,8 +358,8 @@ def middleware_pipeline(
 				)
 				current_status = "check_casual_or_query"
 			else:
-				project_id = matches[0].project_id
-				projects_desc = [PROJECTS_DATA[match.project_id]["description"] for match in matches]
+				project_id = next(iter(matches))
+				projects_desc = [PROJECTS_DATA[match_id]["description"] for match_id in matches]
 				ad_text = "Hm, I think you might be interested in some of our services !\n" + "\n".join(projects_desc)
 				result = (
 					ad_text + "\n\nPlease let me know if any of these might interest you, and "
@@ -285,7 +386,7 @@ def middleware_pipeline(
 	else:
 		raise ValueError(f"Invalid current status: {current_status}")
 	ONGOING_STATUSES[session_id] = (current_status, project_id)
-	return result
+	return result, current_status
 
 
 
@@ -302,24 +403,43 @@ app.add_middleware(
     allow_credentials = True,
     allow_methods     = ["POST"],
     allow_headers     = ["*"],
+    expose_headers    = ["X-Pipeline-Status", "X-Pipeline-Timings", "X-Trace-Id"],
 )
+install_tracing(app, "R10")
+install_metrics(app, "R10")
+install_deadline(app)
 
 class BrokerPayload(BaseModel):
 	session_id: SessionID
 	user_input: str
 
 @app.post("/pipeline", response_model=str)
-def pipeline_endpoint(request: BrokerPayload):
+def pipeline_endpoint(request: BrokerPayload, response: Response):
 	"""
 	Receives a session ID and a user input, and returns the response generated by the pipeline.
+	The final session status and the duration of each downstream call are reported in the
+	X-Pipeline-Status and X-Pipeline-Timings headers.
+	The turn must complete within TURN_BUDGET_S seconds, otherwise it fails with a 504.
 	"""
 	session_id = request.session_id
 	user_input = request.user_input
-	response = middleware_pipeline(session_id, user_input)
-	return response
+	timings : list[HopTiming] = []
+	token = HOP_TIMINGS.set(timings)
+	start = perf_counter()
+	try:
+		with deadline(TURN_BUDGET_S):
+			result, status = middleware_pipeline(session_id, user_input)
+	except DeadlineExceeded as e:
+		TURN_SECONDS.labels(status = "deadline_exceeded").observe(perf_counter() - start)
+		raise HTTPException(status_code = 504, detail = str(e))
+	finally:
+		HOP_TIMINGS.reset(token)
+	TURN_SECONDS.labels(status = status).observe(perf_counter() - start)
+	response.headers["X-Pipeline-Status"]  = status
+	response.headers["X-Pipeline-Timings"] = json.dumps(timings)
+	return result
 
 
 if __name__ == "__main__":
-	PROJECTS_DATA : ProjectsDict = call_R2_for_project_data()
-	ONGOING_STATUSES : dict[SessionID, tuple[SessionStatus, ProjectID | None]] = {}
+	startup()
 	uvicorn.run(app, host="0.0.0.0", port=PORT_R10)
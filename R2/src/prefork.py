@@ -0,0 +1,393 @@
+"""
+Pre-fork serving of R2: the parent process loads the models and the catalogue
+indexes once, then forks workers that all accept connections on the same listening
+socket. The workers share the parent's memory copy-on-write: a page is only copied
+when a worker writes to it. The model weights and embeddings are only read, and
+`gc.freeze` keeps the garbage collector from writing to the objects loaded before
+the fork, so the memory of the models is not multiplied by the number of workers.
+
+Shared state that changes (the catalogue) is only refreshed by the parent, which then
+replaces the workers with new ones forked from the new state: all the workers serve
+the same version. A worker asks the parent for a refresh with `request_refresh`.
+
+Metrics are aggregated over the processes: each one writes a snapshot of its metrics
+to a directory shared by all of them, every R2_METRICS_SYNC_INTERVAL_S seconds. GET
+/metrics, answered by any worker, sums the counters and histograms of every process
+(those of the workers that stopped are kept in an archive) and the gauges of the
+running ones, so the values do not depend on the worker that answers the scrape.
+
+Needs `fork`, and `/proc/<pid>/smaps_rollup` (Linux) for the memory reports.
+"""
+from __future__ import annotations
+from typing_extensions import TypedDict, Callable
+from os import environ
+from time import monotonic, sleep
+import gc
+import json
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+
+from uvicorn import Config, Server
+
+from common.metrics import REGISTRY, Gauge, merge_snapshots
+
+
+
+#######################################################################
+#
+# Typing and constants
+#
+#######################################################################
+
+ProcessMemory = TypedDict(
+	"ProcessMemory",
+	{
+		"rss" : int,  # resident set size, shared pages included
+		"pss" : int,  # proportional set size: shared pages divided between the processes sharing them
+		"uss" : int,  # unique set size: pages of this process only
+	}
+)
+WorkerHook  = Callable[[int], None]
+RefreshHook = Callable[[], bool]  # returns whether the shared state changed
+
+MEMORY_REPORT_INTERVAL_S = float(environ.get("R2_MEMORY_REPORT_INTERVAL_S", "60"))  # 0: no reports
+METRICS_SYNC_INTERVAL_S  = float(environ.get("R2_METRICS_SYNC_INTERVAL_S", "2"))
+LISTEN_BACKLOG           = 2048
+REFRESH_SIGNAL           = signal.SIGHUP  # sent by a worker to ask the parent for a refresh
+
+PARENT_PID  : int | None = None  # set in the workers
+METRICS_DIR : str | None = None  # snapshots of the metrics of every process, set by serve_prefork
+METRICS_ARCHIVE          = "archive.json"
+
+WORKER_MEMORY = Gauge("r2_worker_memory_bytes", "Memory of each R2 worker process, by kind (rss, pss, uss).", ["worker", "kind"])
+
+
+
+#######################################################################
+#
+# Memory reports
+#
+#######################################################################
+
+def process_memory(pid : int | str = "self") -> ProcessMemory | None:
+	"""
+	RSS, PSS and USS of a process in bytes, or None if they are not available.
+	"""
+	try:
+		with open(f"/proc/{pid}/smaps_rollup") as f:
+			lines = f.readlines()
+	except OSError:
+		return None
+	fields : dict[str, int] = {}
+	for line in lines:
+		parts = line.split()
+		if len(parts) == 3 and parts[2] == "kB":
+			fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+	result : ProcessMemory = {
+		"rss" : fields.get("Rss", 0),
+		"pss" : fields.get("Pss", 0),
+		"uss" : fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+	}
+	return result
+
+def format_memory_report(processes : dict[str, int]) -> str:
+	"""
+	One line with the RSS and USS of each process (by name), and the memory they
+	actually use together (the sum of their PSS).
+	"""
+	mb     = lambda x: f"{x / 2**20:.0f}"
+	parts  = []
+	totals = {"rss": 0, "pss": 0}
+	for name, pid in processes.items():
+		memory = process_memory(pid)
+		if memory is None:
+			continue
+		parts.append(f"{name} {mb(memory['rss'])}/{mb(memory['uss'])}")
+		totals["rss"] += memory["rss"]
+		totals["pss"] += memory["pss"]
+	if not parts:
+		return "INFO: Memory report not available on this system"
+	result = (
+		f"INFO: Memory (MB, rss/uss): {', '.join(parts)}; "
+		f"{mb(totals['pss'])} in total (sum of rss: {mb(totals['rss'])})"
+	)
+	return result
+
+def start_memory_gauge(worker : int, interval_s : float = MEMORY_REPORT_INTERVAL_S) -> None:
+	"""
+	Exports the memory of this worker process on /metrics, updated every `interval_s` seconds.
+	"""
+	def run():
+		while True:
+			memory = process_memory()
+			if memory is None:
+				return
+			for kind, value in memory.items():
+				WORKER_MEMORY.labels(worker = str(worker), kind = kind).set(value)
+			sleep(interval_s)
+	if interval_s > 0:
+		threading.Thread(target = run, name = "memory-gauge", daemon = True).start()
+
+
+
+#######################################################################
+#
+# Metrics of all the processes
+#
+#######################################################################
+
+def read_json(path : str) -> dict | None:
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def write_json(path : str, content : dict) -> None:
+	tmp_path = os.path.join(os.path.dirname(path), f".{os.getpid()}.{threading.get_ident()}.tmp")
+	with open(tmp_path, "w") as f:
+		json.dump(content, f)
+	os.replace(tmp_path, path)
+
+def is_running(pid : int) -> bool:
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	return True
+
+def without_gauges(snapshot : dict) -> dict:
+	return {name: metric for name, metric in snapshot.items() if metric["kind"] != "gauge"}
+
+def write_metrics() -> None:
+	"""
+	Writes the snapshot of the metrics of this process to METRICS_DIR.
+	"""
+	if METRICS_DIR is not None:
+		write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), REGISTRY.snapshot())
+
+def archive_metrics(pid : int) -> None:
+	"""
+	In the parent, moves the counters and histograms of a stopped worker to the archive,
+	so that they are still counted.
+	"""
+	path     = os.path.join(METRICS_DIR, f"{pid}.json")
+	snapshot = read_json(path)
+	if snapshot is None:
+		return
+	archive_path = os.path.join(METRICS_DIR, METRICS_ARCHIVE)
+	archive      = read_json(archive_path) or {"snapshot": {}}
+	merged       = merge_snapshots([archive["snapshot"], without_gauges(snapshot)])
+	# Readers skip the file of `pid` while the archive counts it and the file still exists.
+	write_json(archive_path, {"pid": pid, "snapshot": merged})
+	os.remove(path)
+	write_json(archive_path, {"pid": None, "snapshot": merged})  # `pid` may be reused
+
+def collect_metrics() -> dict:
+	"""
+	Snapshot of the metrics of all the processes (see the module docstring).
+	"""
+	write_metrics()
+	for _ in range(3):
+		names     = os.listdir(METRICS_DIR)
+		archive   = read_json(os.path.join(METRICS_DIR, METRICS_ARCHIVE)) or {"pid": None, "snapshot": {}}
+		snapshots = [archive["snapshot"]]
+		complete  = True
+		for name in names:
+			if name == METRICS_ARCHIVE or not name.endswith(".json"):
+				continue
+			pid = int(name.removesuffix(".json"))
+			if pid == archive["pid"]:
+				continue
+			snapshot = read_json(os.path.join(METRICS_DIR, name))
+			if snapshot is None:
+				complete = False  # archived meanwhile: read the archive again
+				break
+			snapshots.append(snapshot if is_running(pid) else without_gauges(snapshot))
+		if complete:
+			break
+	return merge_snapshots(snapshots)
+
+def start_metrics_sync(interval_s : float = METRICS_SYNC_INTERVAL_S) -> None:
+	"""
+	Writes the metrics of this worker every `interval_s` seconds, and makes its /metrics
+	report those of all the processes.
+	"""
+	def run():
+		while True:
+			sleep(interval_s)
+			write_metrics()
+	REGISTRY.reset()  # the parent reports the values recorded before the fork
+	REGISTRY.set_collector(collect_metrics)
+	write_metrics()
+	threading.Thread(target = run, name = "metrics-sync", daemon = True).start()
+
+
+
+#######################################################################
+#
+# Serving
+#
+#######################################################################
+
+def listen(host : str, port : int) -> socket.socket:
+	sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	sock.bind((host, port))
+	sock.listen(LISTEN_BACKLOG)
+	sock.set_inheritable(True)
+	return sock
+
+def run_worker(
+	app             : object,
+	sock            : socket.socket,
+	worker          : int,
+	threads         : int,
+	on_worker_start : WorkerHook | None,
+) -> None:
+	"""
+	Body of a forked worker: serves `app` on the inherited socket until it is stopped.
+	"""
+	global PARENT_PID
+	PARENT_PID = os.getppid()
+	signal.signal(signal.SIGINT,  signal.SIG_DFL)
+	signal.signal(signal.SIGTERM, signal.SIG_DFL)
+	signal.signal(REFRESH_SIGNAL, signal.SIG_DFL)
+	try:
+		import torch
+		torch.set_num_threads(threads)
+	except ImportError:
+		pass
+	if on_worker_start is not None:
+		on_worker_start(worker)
+	start_metrics_sync()
+	start_memory_gauge(worker)
+	server = Server(Config(app, log_level = "info"))
+	server.run(sockets = [sock])
+	write_metrics()
+
+def request_refresh() -> bool:
+	"""
+	In a pre-forked worker, asks the parent to refresh the shared state (and to replace
+	the workers if it changed), and returns True. Returns False in any other process.
+	"""
+	if PARENT_PID is None:
+		return False
+	os.kill(PARENT_PID, REFRESH_SIGNAL)
+	return True
+
+def serve_prefork(
+	app                : object,
+	host               : str,
+	port               : int,
+	workers            : int,
+	threads            : int | None         = None,
+	on_worker_start    : WorkerHook | None  = None,
+	refresh            : RefreshHook | None = None,
+	refresh_interval_s : float              = 0,
+) -> None:
+	"""
+	Forks `workers` processes serving `app` on `host:port`, restarts those that die,
+	and prints a memory report of all the processes every R2_MEMORY_REPORT_INTERVAL_S
+	seconds. Everything loaded before the call is shared by the workers.
+
+	- threads: torch threads of each worker (defaults to the cores divided between the workers).
+	- on_worker_start: called in each worker (with its number) before it serves, e.g. to
+	  start the background threads, which do not survive the fork.
+	- refresh: called in the parent every `refresh_interval_s` seconds (if positive) and
+	  when a worker calls `request_refresh`. When it returns True, new workers are forked
+	  from the refreshed state, and the previous ones finish their requests and stop.
+	"""
+	global METRICS_DIR
+	METRICS_DIR  = tempfile.mkdtemp(prefix = "r2-metrics-")
+	sock         = listen(host, port)
+	safe_threads = threads if threads is not None else max(1, (os.cpu_count() or 1) // workers)
+	children     : dict[int, int] = {}  # worker number by pid (of the current generation)
+
+	def spawn(worker : int) -> None:
+		pid = os.fork()
+		if pid == 0:
+			status = 1
+			try:
+				run_worker(app, sock, worker, safe_threads, on_worker_start)
+				status = 0
+			finally:
+				os._exit(status)
+		children[pid] = worker
+
+	def spawn_all() -> None:
+		write_metrics()
+		# Objects loaded so far are never collected: the collector must not write to their pages.
+		gc.collect()
+		gc.freeze()
+		for worker in range(workers):
+			spawn(worker)
+
+	stopping          = False
+	refresh_requested = False
+	def stop(signum, frame):
+		nonlocal stopping
+		stopping = True
+	def request(signum, frame):
+		nonlocal refresh_requested
+		refresh_requested = True
+
+	signal.signal(signal.SIGINT,  stop)
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(REFRESH_SIGNAL, request)  # before forking: workers may ask right away
+	spawn_all()
+	print(f"SUCCESS: Serving on {host}:{port} with {workers} workers ({safe_threads} torch threads each)")
+
+	next_report       = monotonic() + min(MEMORY_REPORT_INTERVAL_S, 10)
+	next_refresh      = monotonic() + refresh_interval_s
+	next_metrics_sync = monotonic() + METRICS_SYNC_INTERVAL_S
+	while not stopping:
+		try:
+			pid, status = os.waitpid(-1, os.WNOHANG)
+		except ChildProcessError:
+			pid = 0
+		if pid:
+			archive_metrics(pid)
+		if pid in children:
+			worker = children.pop(pid)
+			print(f"WARNING: Worker {worker} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+			spawn(worker)
+		if refresh is not None and (refresh_requested or (refresh_interval_s > 0 and monotonic() >= next_refresh)):
+			refresh_requested = False
+			next_refresh      = monotonic() + refresh_interval_s
+			try:
+				changed = refresh()
+			except Exception as e:
+				print(f"ERROR: Refresh failed: {e}")
+				changed = False
+			if changed:
+				# Forked from the new state; the previous workers stop once their requests are done.
+				previous = list(children)
+				children.clear()
+				spawn_all()
+				for pid in previous:
+					os.kill(pid, signal.SIGTERM)
+				print("INFO: Replaced the workers after a refresh")
+		if MEMORY_REPORT_INTERVAL_S > 0 and monotonic() >= next_report:
+			processes = {"parent": os.getpid()} | {f"worker {worker}": pid for pid, worker in sorted(children.items(), key=lambda x: x[1])}
+			print(format_memory_report(processes))
+			next_report = monotonic() + MEMORY_REPORT_INTERVAL_S
+		if monotonic() >= next_metrics_sync:
+			write_metrics()  # values recorded by the parent, e.g. the catalogue refreshes
+			next_metrics_sync = monotonic() + METRICS_SYNC_INTERVAL_S
+		sleep(0.5)
+
+	print("INFO: Stopping the workers")
+	for pid in children:
+		os.kill(pid, signal.SIGTERM)
+	while True:  # the current workers, and the previous ones still finishing their requests
+		try:
+			os.waitpid(-1, 0)
+		except ChildProcessError:
+			break
+	sock.close()
+	shutil.rmtree(METRICS_DIR, ignore_errors = True)
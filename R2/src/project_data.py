@@ -1,10 +1,20 @@
 from __future__ import annotations
-from typing_extensions import TypedDict, TYPE_CHECKING
-from os import environ
+from typing_extensions import TypedDict, TYPE_CHECKING, Callable, cast
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace as replace_fields
+from datetime import datetime, timezone
+from os import environ, getpid, path, replace
+from time import perf_counter, sleep
+import hashlib
+import json
+import threading
 import requests
 
 from dotenv import load_dotenv
 
+from common.metrics import Counter, Gauge, Histogram
+from common.tracing import span
+
 if TYPE_CHECKING:
 	from .sentence_matcher import DocumentDict
 
@@ -24,7 +34,8 @@ ProjectData = TypedDict(
 )
 ProjectsDict = dict[ProjectID, ProjectData]
 
-# The elements and options fields should be filled by pinging rAIson
+# The elements and options fields should be filled by pinging rAIson (see CatalogueStore);
+# this dict itself is never modified.
 RAISON_PROJECTS : ProjectsDict = {
 	"PRJ17225": {
 		"author"      : "Tristan Duquesne",
@@ -126,28 +137,292 @@ RAISON_PROJECTS : ProjectsDict = {
 
 load_dotenv('.env')
 RAISON_API_KEY = environ.get('RAISON_API_KEY')
+RAISON_API_URL = environ.get('RAISON_API_URL', "https://api.ai-raison.com")
 
 RAISON_API_HEADERS = {
 	"x-api-key": RAISON_API_KEY,
 	"Content-Type": "application/json"
 }
 
+# Concurrent fetching of the catalogue from rAIson.
+RAISON_FETCH_WORKERS   = int  (environ.get("R2_RAISON_FETCH_WORKERS",   "8"))
+RAISON_FETCH_TIMEOUT_S = float(environ.get("R2_RAISON_FETCH_TIMEOUT_S", "5"))
+# Snapshot of the last catalogue fetched, served at startup while it is refreshed.
+CATALOGUE_SNAPSHOT_PATH = environ.get(
+	"R2_CATALOGUE_SNAPSHOT",
+	path.join(path.dirname(path.dirname(path.abspath(__file__))), "catalogue_snapshot.json"),
+)
+CATALOGUE_REFRESH_INTERVAL_S = float(environ.get("R2_CATALOGUE_REFRESH_INTERVAL_S", "0"))  # 0: only at startup
+SNAPSHOT_FORMAT = 1
+
+RAISON_FETCHES            = Counter  ("r2_raison_fetch_total",        "Project fetches from rAIson, by status.", ["status"])
+CATALOGUE_REFRESH_SECONDS = Histogram("r2_catalogue_refresh_seconds", "Time spent refreshing the whole catalogue.")
+CATALOGUE_VERSION_GAUGE   = Gauge    ("r2_catalogue_version",         "Version of the catalogue being served.")
+
+CatalogueStatus = TypedDict(
+	"CatalogueStatus",
+	{
+		"version"      : int,
+		"fingerprint"  : str,
+		"source"       : str,         # "builtin", "snapshot" or "raison"
+		"updated_at"   : str | None,  # when this version was fetched from rAIson
+		"refreshed_at" : str | None,  # last refresh attempt, even without change
+		"failed"       : list[str],   # projects whose last fetch failed (previous data kept)
+		"indexes"      : list[str],   # precomputed structures of this version (e.g. embeddings)
+	},
+)
+
 def build_project_url(project_id: ProjectID) -> str:
-	return f"https://api.ai-raison.com/executions/{project_id}/latest"
+	return f"{RAISON_API_URL}/executions/{project_id}/latest"
 
-def get_project_data(id: ProjectID) -> tuple[list[str], list[str]]:
+def get_project_data(id: ProjectID, timeout: float = RAISON_FETCH_TIMEOUT_S) -> tuple[list[str], list[str]]:
 	url      = build_project_url(id)
-	response = requests.get(url, headers = RAISON_API_HEADERS)
+	with span("rAIson GET", url = url):
+		response = requests.get(url, headers = RAISON_API_HEADERS, timeout = timeout)
+	response.raise_for_status()
 	data     = response.json()
 	elements = [e["label"] for e in data.get("elements", [])]
 	options  = [o["label"] for o in data.get("options",  [])]
 	return elements, options
 
-def update_raison_projects_data():
-	for project_id in RAISON_PROJECTS:
-		elements, options = get_project_data(project_id)
-		RAISON_PROJECTS[project_id]["elements"] = elements
-		RAISON_PROJECTS[project_id]["options"]  = options
+def fetch_catalogue(
+	project_ids : list[ProjectID],
+	workers     : int   = RAISON_FETCH_WORKERS,
+	timeout     : float = RAISON_FETCH_TIMEOUT_S,
+) -> tuple[dict[ProjectID, tuple[list[str], list[str]]], dict[ProjectID, str]]:
+	"""
+	Fetches the elements and options of the given projects from rAIson, at most
+	`workers` at a time, each with its own timeout.
+	Returns the data of the projects that answered, and the error of the others.
+	"""
+	fetched : dict[ProjectID, tuple[list[str], list[str]]] = {}
+	errors  : dict[ProjectID, str]                         = {}
+	if not project_ids:
+		return fetched, errors
+	with ThreadPoolExecutor(max_workers = max(1, min(workers, len(project_ids))), thread_name_prefix = "raison-fetch") as pool:
+		futures = {project_id: pool.submit(get_project_data, project_id, timeout) for project_id in project_ids}
+		for project_id, future in futures.items():
+			try:
+				fetched[project_id] = future.result()
+				RAISON_FETCHES.labels(status = "ok").inc()
+			except Exception as e:
+				errors[project_id] = f"{type(e).__name__}: {e}"
+				RAISON_FETCHES.labels(status = "timeout" if isinstance(e, requests.Timeout) else "error").inc()
+	return fetched, errors
+
+def catalogue_fingerprint(projects: ProjectsDict) -> str:
+	content = {project_id: [project["elements"], project["options"]] for project_id, project in sorted(projects.items())}
+	return hashlib.sha256(json.dumps(content, sort_keys = True).encode()).hexdigest()[:16]
+
+def _now() -> str:
+	return datetime.now(timezone.utc).isoformat()
+
+def merge_project_data(
+	base    : ProjectsDict,
+	data    : dict[ProjectID, tuple[list[str], list[str]]],
+) -> ProjectsDict:
+	"""
+	Returns a new projects dict: the projects of `base` (copied), with the elements and
+	options of `data` where there are some.
+	"""
+	result : ProjectsDict = {}
+	for project_id, project in base.items():
+		elements, options = data.get(project_id, (project["elements"], project["options"]))
+		result[project_id] = cast(ProjectData, {**project, "elements": list(elements), "options": list(options)})
+	return result
+
+@dataclass(frozen = True)
+class Catalogue:
+	"""
+	One version of the project catalogue, with the structures derived from it
+	(`indexes`, e.g. the tokens and the sentence embeddings of the documents).
+	A Catalogue is never modified once served: a refresh builds a new one and swaps it
+	in, and a request reads `CatalogueStore.current` once and uses that version throughout.
+	"""
+	version     : int
+	fingerprint : str
+	source      : str
+	updated_at  : str | None
+	projects    : ProjectsDict
+	documents   : DocumentDict
+	indexes     : dict[str, object] = field(default_factory = dict)
+
+	@staticmethod
+	def build(
+		version    : int,
+		source     : str,
+		updated_at : str | None,
+		projects   : ProjectsDict,
+	) -> Catalogue:
+		return Catalogue(
+			version     = version,
+			fingerprint = catalogue_fingerprint(projects),
+			source      = source,
+			updated_at  = updated_at,
+			projects    = projects,
+			documents   = document_dict_from_project_dict(projects),
+		)
+
+IndexBuilder = Callable[["DocumentDict"], dict[str, object]]
+
+class CatalogueStore:
+	"""
+	Holds the catalogue being served, and replaces it without downtime: refreshes fetch
+	the projects from rAIson, build the new catalogue and its indexes off the request
+	path, then swap it in with a single assignment. Refreshes are serialized.
+
+	- base_projects: the hardcoded projects (metadata not provided by rAIson).
+	- snapshot_path: where the last catalogue is saved, to be served at the next startup.
+	- index_builder: computes the indexes of a new catalogue from its documents.
+	"""
+
+	def __init__(
+		self,
+		base_projects : ProjectsDict,
+		snapshot_path : str | None          = CATALOGUE_SNAPSHOT_PATH,
+		index_builder : IndexBuilder | None = None,
+	):
+		self.snapshot_path = snapshot_path
+		self.index_builder = index_builder
+		self.refreshed_at  : str | None = None
+		self.failed        : list[str]  = []
+		self._current      = Catalogue.build(0, "builtin", None, merge_project_data(base_projects, {}))
+		self._refresh_lock = threading.Lock()
+
+	@property
+	def current(self) -> Catalogue:
+		return self._current
+
+	def _swap(self, catalogue: Catalogue) -> None:
+		self._current = catalogue
+		CATALOGUE_VERSION_GAUGE.set(catalogue.version)
+
+	def status(self) -> CatalogueStatus:
+		catalogue = self._current
+		return {
+			"version"      : catalogue.version,
+			"fingerprint"  : catalogue.fingerprint,
+			"source"       : catalogue.source,
+			"updated_at"   : catalogue.updated_at,
+			"refreshed_at" : self.refreshed_at,
+			"failed"       : list(self.failed),
+			"indexes"      : sorted(catalogue.indexes),
+		}
+
+	def _with_indexes(self, catalogue: Catalogue) -> Catalogue:
+		if self.index_builder is None:
+			return catalogue
+		start   = perf_counter()
+		indexes = self.index_builder(catalogue.documents)
+		print(f"INFO: Built catalogue indexes {sorted(indexes)} in {perf_counter() - start:.2f}s")
+		return replace_fields(catalogue, indexes = indexes)
+
+	def build_indexes(self) -> None:
+		"""
+		Builds the indexes of the current catalogue now if it has none (e.g. in the
+		parent process before forking workers, so that they share them).
+		"""
+		with self._refresh_lock:
+			if self.index_builder is not None and not self._current.indexes:
+				self._swap(self._with_indexes(self._current))
+
+	def save_snapshot(self) -> None:
+		"""
+		Writes the current catalogue and its version to the snapshot file (atomically,
+		so that a crash never leaves a truncated snapshot).
+		"""
+		if not self.snapshot_path:
+			return
+		catalogue = self._current
+		snapshot = {
+			"format"      : SNAPSHOT_FORMAT,
+			"version"     : catalogue.version,
+			"fingerprint" : catalogue.fingerprint,
+			"updated_at"  : catalogue.updated_at,
+			"projects"    : {
+				project_id: {"elements": project["elements"], "options": project["options"]}
+				for project_id, project in catalogue.projects.items()
+			},
+		}
+		tmp_path = f"{self.snapshot_path}.{getpid()}.tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(snapshot, f, indent = 1)
+		replace(tmp_path, self.snapshot_path)
+
+	def load_snapshot(self) -> bool:
+		"""
+		Serves the catalogue of the snapshot file (its indexes are built by the next
+		refresh). Returns False if there is no usable snapshot.
+		"""
+		if not self.snapshot_path:
+			return False
+		try:
+			with open(self.snapshot_path) as f:
+				snapshot = json.load(f)
+		except FileNotFoundError:
+			return False
+		except (OSError, ValueError) as e:
+			print(f"WARNING: Ignoring unreadable catalogue snapshot {self.snapshot_path}: {e}")
+			return False
+		if snapshot.get("format") != SNAPSHOT_FORMAT:
+			print(f"WARNING: Ignoring catalogue snapshot {self.snapshot_path} of format {snapshot.get('format')}")
+			return False
+		data = {
+			project_id: (project["elements"], project["options"])
+			for project_id, project in snapshot["projects"].items()
+		}
+		projects = merge_project_data(self._current.projects, data)
+		self._swap(Catalogue.build(snapshot["version"], "snapshot", snapshot.get("updated_at"), projects))
+		return True
+
+	def refresh(self) -> bool:
+		"""
+		Fetches the catalogue from rAIson and swaps in a new version if it changed.
+		Projects that fail keep their previous data. Returns whether the version changed.
+		"""
+		with self._refresh_lock, CATALOGUE_REFRESH_SECONDS.time():
+			start    = perf_counter()
+			previous = self._current
+			fetched, errors = fetch_catalogue(list(previous.projects))
+			for project_id, error in errors.items():
+				print(f"WARNING: rAIson project {project_id} not refreshed: {error}")
+			self.refreshed_at = _now()
+			self.failed       = sorted(errors)
+			projects = merge_project_data(previous.projects, fetched)
+			changed  = bool(fetched) and catalogue_fingerprint(projects) != previous.fingerprint
+			if changed:
+				new = self._with_indexes(Catalogue.build(previous.version + 1, "raison", self.refreshed_at, projects))
+				self._swap(new)
+				try:
+					self.save_snapshot()
+				except OSError as e:
+					print(f"WARNING: Could not write the catalogue snapshot {self.snapshot_path}: {e}")
+			elif self.index_builder is not None and not previous.indexes:
+				# Same content, e.g. loaded from the snapshot: only the indexes are missing.
+				self._swap(self._with_indexes(previous))
+			print(
+				f"INFO: Catalogue refreshed in {perf_counter() - start:.2f}s: {len(fetched)} projects fetched, "
+				f"{len(errors)} failed, version {self._current.version}{' (changed)' if changed else ''}"
+			)
+			return changed
+
+	def start_refresh(self, interval_s: float = CATALOGUE_REFRESH_INTERVAL_S) -> threading.Thread:
+		"""
+		Refreshes the catalogue in a background thread: once now, then every
+		`interval_s` seconds if it is positive.
+		"""
+		def run():
+			while True:
+				try:
+					self.refresh()
+				except Exception as e:
+					print(f"ERROR: Catalogue refresh failed: {e}")
+				if interval_s <= 0:
+					return
+				sleep(interval_s)
+		thread = threading.Thread(target = run, name = "catalogue-refresh", daemon = True)
+		thread.start()
+		return thread
 
 def document_dict_from_project_dict(projects: ProjectsDict) -> DocumentDict:
 	result = {
@@ -159,6 +434,10 @@ def document_dict_from_project_dict(projects: ProjectsDict) -> DocumentDict:
 
 
 
+CATALOGUE = CatalogueStore(RAISON_PROJECTS)
+
+
+
 if __name__ == "__main__":
-	update_raison_projects_data()
-	print(RAISON_PROJECTS)
+	CATALOGUE.refresh()
+	print(CATALOGUE.current.projects)
@@ -1,28 +1,55 @@
+from time                    import perf_counter
+_import_start = perf_counter()
 
+from os                      import environ, cpu_count
+from functools               import partial
+import json
+from typing_extensions       import cast
 from uvicorn                 import run as uvc_run
 from pydantic                import BaseModel
-from fastapi                 import FastAPI
+from fastapi                 import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses       import StreamingResponse
 from nltk                    import sent_tokenize
 
+from common                  import deadline, transport
+from common.metrics          import Gauge, install_metrics
+from common.tracing          import install_tracing
+
 
 from .project_data     import (
 	ProjectID,
-	RAISON_PROJECTS,
-	update_raison_projects_data,
-	document_dict_from_project_dict,
+	CATALOGUE,
+	Catalogue,
+	CatalogueStatus,
 	ProjectsDict,
+	CATALOGUE_REFRESH_INTERVAL_S,
 )
+from .prefork          import request_refresh, serve_prefork
 from .sentence_matcher import (
 	DocumentDict,
 	ScoresDict,
 	ModelQueryKey,
+	SentenceIndex,
+	TokenIndex,
 	MeanMode_Literal,
 	WNDistanceMode_Literal,
-	load_all_models,
+	DEFAULT_MODEL_SENTENCE,
+	TOKEN_INDEX_KEY,
+	build_document_indexes,
+	create_model_registry,
 	get_sentence_matching_scores,
+	get_top_k_matching_scores,
+	iter_batch_matching_scores,
 )
 
+IMPORT_SECONDS = perf_counter() - _import_start
+
+# Worker processes of `python -m src.role2_service` (0: one per core), sharing the models.
+SERVE_WORKERS = int(environ.get("R2_WORKERS", "1")) or cpu_count() or 1
+
+STARTUP_SECONDS = Gauge("r2_startup_seconds", "Time spent in each startup phase of R2.", ["phase"])
+
 
 
 class PayloadFor_AdAgent(BaseModel):
@@ -42,6 +69,24 @@ class PayloadFor_SentenceMatcher(BaseModel):
 	alpha      : float                  | None
 	epsilon    : float                  | None
 
+class PayloadFor_BatchMatcher(BaseModel):
+	user_inputs : list[str]
+	documents   : DocumentDict           | None = None
+	model       : ModelQueryKey          | None = None
+	mean_mode   : MeanMode_Literal       | None = None
+	dist_mode   : WNDistanceMode_Literal | None = None
+	alpha       : float                  | None = None
+	epsilon     : float                  | None = None
+
+class PayloadFor_TopKMatcher(BaseModel):
+	user_input : str
+	k          : int                           = 1
+	model      : ModelQueryKey          | None = None
+	mean_mode  : MeanMode_Literal       | None = None
+	dist_mode  : WNDistanceMode_Literal | None = None
+	alpha      : float                  | None = None
+	epsilon    : float                  | None = None
+
 class RawUserInput(BaseModel):
 	user_input : str
 	get_max    : bool  = False
@@ -59,6 +104,33 @@ app.add_middleware(
     allow_methods     = ["GET", "POST"],
     allow_headers     = ["*"],
 )
+install_tracing(app, "R2")
+install_metrics(app, "R2")
+deadline.install_deadline(app)
+
+
+def check_deadline() -> None:
+	"""
+	Answers 504 if the caller's deadline (X-Deadline-Ms header) has passed: the scores
+	would come too late to be used.
+	"""
+	try:
+		deadline.check("scoring")
+	except deadline.DeadlineExceeded as e:
+		raise HTTPException(status_code = 504, detail = str(e))
+
+def catalogue_index(catalogue: Catalogue, model_key: ModelQueryKey | None) -> SentenceIndex | None:
+	"""
+	Precomputed embeddings of the catalogue's documents for the model, if there are some.
+	"""
+	index = catalogue.indexes.get(model_key if model_key is not None else DEFAULT_MODEL_SENTENCE)
+	return cast(SentenceIndex | None, index)
+
+def catalogue_tokens(catalogue: Catalogue) -> TokenIndex | None:
+	"""
+	Precomputed tokens of the catalogue's documents, if there are some.
+	"""
+	return cast(TokenIndex | None, catalogue.indexes.get(TOKEN_INDEX_KEY))
 
 
 @app.post("/match", response_model=ScoresDict)
@@ -67,11 +139,16 @@ def match_endpoint(request: PayloadFor_SentenceMatcher):
 	Receives a configuration body for the sentence matcher, processes the matching
 	using the chosen algorithm, and returns the matching scores as a dictionary.
 	"""
-	safe_documents = (
-		document_dict_from_project_dict(RAISON_PROJECTS)
-		if request.documents is None else
-		request.documents
-	)
+	check_deadline()
+	catalogue = CATALOGUE.current
+	if request.documents is None:
+		safe_documents = catalogue.documents
+		index          = catalogue_index(catalogue, request.model)
+		tokens         = catalogue_tokens(catalogue)
+	else:
+		safe_documents = request.documents
+		index          = None
+		tokens         = None
 	scores = get_sentence_matching_scores(
 		MODELS,
 		safe_documents,
@@ -81,6 +158,8 @@ def match_endpoint(request: PayloadFor_SentenceMatcher):
 		request.dist_mode,
 		request.alpha,
 		request.epsilon,
+		index,
+		tokens,
 	)
 	return scores
 
@@ -91,10 +170,14 @@ def match_ad_endpoint(request: RawUserInput):
 	Receives a user input and returns the similarities between the user input
 	and the descriptions of the projects.
 	"""
+	check_deadline()
+	catalogue = CATALOGUE.current
 	scores = get_sentence_matching_scores(
 		MODELS,
-		document_dict_from_project_dict(RAISON_PROJECTS),
+		catalogue.documents,
 		[request.user_input],
+		index  = catalogue_index(catalogue, None),
+		tokens = catalogue_tokens(catalogue),
 	)
 	result = PayloadFor_AdAgent(user_input=request.user_input, similarities=scores)
 	return result
@@ -106,14 +189,20 @@ def match_scenario_endpoint(request: RawUserInput):
 	Receives a user input and returns the matched scenarios.
 	"""
 	input_sentences = sent_tokenize(request.user_input)
-	scores = get_sentence_matching_scores(
+	check_deadline()
+	catalogue = CATALOGUE.current
+	# Only the best project is needed with get_max: the others are not all scored.
+	match_fn  = partial(get_top_k_matching_scores, k = 1) if request.get_max else get_sentence_matching_scores
+	scores = match_fn(
 		MODELS,
-		document_dict_from_project_dict(RAISON_PROJECTS),
+		catalogue.documents,
 		input_sentences,
 		model_key = "sbert",
+		index     = catalogue_index(catalogue, "sbert"),
+		tokens    = catalogue_tokens(catalogue),
 	)
 	if request.get_max:
-		matched_projects = [list(scores.items())[0][0]]
+		matched_projects = list(scores)[:1]  # none if the input has no sentence
 	else:
 		matched_projects = [
 			project_id
@@ -130,17 +219,158 @@ def match_scenario_endpoint(request: RawUserInput):
 	print(scores)
 	return result
 
+@app.post("/match_top_k", response_model=ScoresDict)
+def match_top_k_endpoint(request: PayloadFor_TopKMatcher):
+	"""
+	Receives a user input and returns the k projects that match it best with their
+	scores, best first. Projects that cannot enter the top k are not fully scored.
+	"""
+	check_deadline()
+	catalogue = CATALOGUE.current
+	scores = get_top_k_matching_scores(
+		MODELS,
+		catalogue.documents,
+		[request.user_input],
+		request.k,
+		request.model,
+		request.mean_mode,
+		request.dist_mode,
+		request.alpha,
+		request.epsilon,
+		catalogue_index(catalogue, request.model),
+		catalogue_tokens(catalogue),
+	)
+	return scores
+
+
+@app.post("/match_batch")
+def match_batch_endpoint(request: PayloadFor_BatchMatcher):
+	"""
+	Receives many user inputs with the configuration of the sentence matcher, and
+	streams their matching scores as NDJSON, one line per input in the order of the
+	inputs: {"index": ..., "user_input": ..., "scores": {...}}. The inputs are encoded
+	in batches and scored with one similarity computation per batch.
+	"""
+	check_deadline()
+	catalogue = CATALOGUE.current
+	if request.documents is None:
+		safe_documents = catalogue.documents
+		index          = catalogue_index(catalogue, request.model)
+		tokens         = catalogue_tokens(catalogue)
+	else:
+		safe_documents = request.documents
+		index          = None
+		tokens         = None
+	all_scores = iter_batch_matching_scores(
+		MODELS,
+		safe_documents,
+		request.user_inputs,
+		request.model,
+		request.mean_mode,
+		request.dist_mode,
+		request.alpha,
+		request.epsilon,
+		index,
+		tokens,
+	)
+	lines = (
+		json.dumps({"index": i, "user_input": user_input, "scores": scores}) + "\n"
+		for i, (user_input, scores) in enumerate(zip(request.user_inputs, all_scores))
+	)
+	return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
 @app.get("/project_data", response_model=ProjectsDict)
-def get_project_data():
+def get_project_data(response: Response):
 	"""
-	Returns the data of all projects.
+	Returns the data of all projects. The version of the catalogue is given in the
+	X-Catalogue-Version header (and its content fingerprint as the ETag).
 	"""
-	return RAISON_PROJECTS
+	catalogue = CATALOGUE.current
+	response.headers["X-Catalogue-Version"] = str(catalogue.version)
+	response.headers["ETag"]                = f'"{catalogue.fingerprint}"'
+	return catalogue.projects
 
-if __name__ == "__main__":
-	PORT   = 8002
-	MODELS = load_all_models()
+@app.get("/catalogue_status", response_model=CatalogueStatus)
+def get_catalogue_status():
+	"""
+	Returns the version of the project catalogue being served, and where it comes from.
+	"""
+	return CATALOGUE.status()
+
+@app.post("/catalogue/refresh", response_model=CatalogueStatus)
+def refresh_catalogue(response: Response):
+	"""
+	Fetches the catalogue from rAIson now, and swaps in the new version if it changed
+	(requests in progress finish with the version they started with).
+	When serving pre-forked, the parent refreshes the catalogue for all the workers and
+	replaces them if it changed: the status returned (202) is the one before the refresh.
+	"""
+	if request_refresh():
+		response.status_code = 202
+	else:
+		CATALOGUE.refresh()
+	return CATALOGUE.status()
+
+# In-process versions of the routes called by the broker (co-located deployment)
+transport.register_endpoint("R2", "POST", "/match",              match_endpoint,          PayloadFor_SentenceMatcher)
+transport.register_endpoint("R2", "POST", "/match_for_ad",       match_ad_endpoint,       RawUserInput)
+transport.register_endpoint("R2", "POST", "/match_for_scenario", match_scenario_endpoint, RawUserInput)
+transport.register_endpoint("R2", "POST", "/match_top_k",        match_top_k_endpoint,    PayloadFor_TopKMatcher)
+transport.register_local("R2", "GET",  "/project_data", lambda data: CATALOGUE.current.projects)
+
+
+def startup(background_refresh: bool = True) -> None:
+	"""
+	Loads the preloaded models (the others are loaded on first use) and the project
+	catalogue snapshot, then refreshes the catalogue and builds its embeddings in the
+	background (and periodically if R2_CATALOGUE_REFRESH_INTERVAL_S is set).
+	Without `background_refresh`, the catalogue is refreshed and its embeddings built
+	right away, and the next refreshes are left to the caller (the parent process, when
+	serving pre-forked, so that the workers share them).
+	Must run before serving, whether R2 runs on its own or co-located with the other
+	agents. The time of each phase is printed and exported on /metrics.
+	"""
+	global MODELS
+	phases = {"imports": IMPORT_SECONDS}
+	start = perf_counter()
+	MODELS = create_model_registry()
+	phases["models"] = perf_counter() - start
 	print("SUCCESS: Loaded models")
-	update_raison_projects_data()
-	print(RAISON_PROJECTS)
-	uvc_run(app, port=PORT, host="0.0.0.0")
+	start = perf_counter()
+	# Tokens and embeddings of each new catalogue version, built before it is swapped in.
+	CATALOGUE.index_builder = lambda documents: build_document_indexes(MODELS, documents)
+	if CATALOGUE.load_snapshot():
+		print(f"SUCCESS: Loaded catalogue snapshot version {CATALOGUE.current.version}")
+	else:
+		print("WARNING: No catalogue snapshot, serving the project descriptions until rAIson answers")
+	if background_refresh:
+		CATALOGUE.start_refresh()
+	else:
+		try:
+			CATALOGUE.refresh()
+		except Exception as e:
+			print(f"ERROR: Catalogue refresh failed: {e}")
+		CATALOGUE.build_indexes()
+	phases["project_data"] = perf_counter() - start
+	for phase, seconds in phases.items():
+		STARTUP_SECONDS.labels(phase = phase).set(seconds)
+	loaded = ", ".join(f"{key} {seconds:.2f}s" for key, seconds in MODELS.load_seconds.items())
+	details = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in phases.items())
+	print(f"INFO: R2 startup in {sum(phases.values()):.2f}s ({details}; models loaded: {loaded or 'none'})")
+
+
+if __name__ == "__main__":
+	PORT = 8002
+	if SERVE_WORKERS > 1:
+		# Models, catalogue and indexes are loaded once, then shared by the forked workers;
+		# the parent refreshes the catalogue and replaces the workers when it changes.
+		startup(background_refresh = False)
+		serve_prefork(
+			app, "0.0.0.0", PORT, SERVE_WORKERS,
+			refresh            = CATALOGUE.refresh,
+			refresh_interval_s = CATALOGUE_REFRESH_INTERVAL_S,
+		)
+	else:
+		startup()
+		uvc_run(app, port=PORT, host="0.0.0.0")
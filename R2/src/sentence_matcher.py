@@ -1,21 +1,36 @@
+"""
+Sentence matcher of R2: scores documents against a user input with sentence
+embeddings (SBERT), word embeddings (word2vec, GloVe) or WordNet distances.
+
+The heavy dependencies (torch, sentence_transformers, gensim, scikit-learn) are only
+imported by the functions that need them, and each model is loaded on first use or
+by an explicit preload (see `ModelRegistry`), so importing this module is cheap.
+"""
 from __future__ import annotations
-from typing_extensions import TypedDict, Literal, Callable, Union, cast
+from typing_extensions import Literal, Callable, Iterator, Union, TypedDict, TYPE_CHECKING, cast
+from itertools import islice
 from math import inf
+from os import environ
+from time import perf_counter
+import heapq
+import threading
 
 
-import torch
 import nltk
 from nltk.corpus import wordnet
 from nltk.corpus import brown
-import tensorflow_hub as hub
-from gensim.models import KeyedVectors
-import gensim.downloader as gensim_api
-from sentence_transformers import SentenceTransformer, util
-from sklearn.feature_extraction.text import TfidfVectorizer
 
+from common.metrics import Gauge, Histogram, SIZE_BUCKETS
 
 from .project_data import ProjectID, ProjectsDict
 
+if TYPE_CHECKING:
+	import torch
+	import tensorflow_hub as hub
+	from gensim.models import KeyedVectors
+	from sentence_transformers import SentenceTransformer
+	from sklearn.feature_extraction.text import TfidfVectorizer
+
 
 
 #######################################################################
@@ -42,24 +57,78 @@ LexiconModel_Literal  = Literal[
 	"word2vec",
 	"glove",
 ]
-SentenceModel       = Union[SentenceTransformer, hub.KerasLayer]
-LexiconModel        = Union[KeyedVectors]
-ModelsDict_Sentence = dict[SentenceModel_Literal, SentenceModel]
-ModelsDict_Lexicon  = dict[LexiconModel_Literal,  LexiconModel]
-ModelsDict_Both     = TypedDict(
-	"ModelsDict_Both",
+SentenceModel       = Union["SentenceTransformer", "hub.KerasLayer"]
+LexiconModel        = Union["KeyedVectors"]
+ModelKind_Literal   = Literal[
+	"sentence",
+	"lexicon",
+]
+ModelQueryKey = SentenceModel_Literal | LexiconModel_Literal
+TokenizedText = TypedDict(
+	"TokenizedText",
 	{
-		"sentence" : ModelsDict_Sentence,
-		"lexicon"  : ModelsDict_Lexicon,
+		"sentences" : list[str],  # sentences, as split by nltk
+		"words"     : list[str],  # distinct lowercase words, in order of appearance
 	}
 )
-ModelQueryKey = SentenceModel_Literal | LexiconModel_Literal
+TokenIndex    = dict[DocumentID, TokenizedText]
+SentenceIndex = dict[DocumentID, "torch.Tensor"]  # sentence embeddings of each document, for one model
+
+ENCODE_BATCH_SIZE  = Histogram("r2_encode_batch_size",      "Number of strings per encoder call.", buckets = SIZE_BUCKETS)
+ENCODE_SECONDS     = Histogram("r2_encode_seconds",         "Time spent in encoder calls.")
+TOP_K_SCORED       = Histogram("r2_top_k_scored_documents", "Documents scored per top-k request (the others are cut off).", buckets = SIZE_BUCKETS)
+TOKENIZE_SECONDS   = Histogram("r2_tokenize_seconds",       "Time spent splitting texts into sentences and words.")
+MODEL_LOAD_SECONDS = Gauge    ("r2_model_load_seconds",     "Time spent importing and loading each model.", ["model"])
 
 DEFAULT_MODEL_SENTENCE = cast(SentenceModel_Literal, "sbert")
 DEFAULT_MODEL_LEXICON  = cast(LexiconModel_Literal,  "glove")
 SBERT_MODEL_STR        = "all-MiniLM-L6-v2"  ## https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2
 GUSE_MODEL_STR_LITE    = "https://tfhub.dev/google/universal-sentence-encoder-lite/2"
 GUSE_MODEL_STR_LARGE   = "https://tfhub.dev/google/universal-sentence-encoder/4"
+TOKEN_INDEX_KEY        = "tokens"  # key of the tokenized documents among the catalogue indexes
+
+# Models loaded at startup (comma-separated keys); the others are loaded on first use.
+PRELOAD_MODELS = [key for key in environ.get("R2_PRELOAD_MODELS", "sbert").split(",") if key]
+# Number of user inputs whose sentences are encoded in one batch by bulk scoring.
+BATCH_CHUNK_SIZE = int(environ.get("R2_BATCH_CHUNK_SIZE", "256"))
+
+
+
+#######################################################################
+#
+# Tokenization
+#
+#######################################################################
+
+def tokenize_text(texts : list[str]) -> TokenizedText:
+	"""
+	Split texts into sentences, and the sentences into distinct lowercase words, in a
+	single pass: each sentence is split into words without being split into sentences again.
+	"""
+	with TOKENIZE_SECONDS.time():
+		sentences = [sentence for text in texts for sentence in nltk.sent_tokenize(text)]
+		words     = dict.fromkeys(
+			word
+			for sentence in sentences
+			for word in nltk.word_tokenize(sentence.lower(), preserve_line = True)
+		)
+	result : TokenizedText = {"sentences": sentences, "words": list(words)}
+	return result
+
+def tokenize_documents(
+	documents : DocumentDict,
+	tokens    : TokenIndex   | None = None,
+) -> TokenIndex:
+	"""
+	Tokenize each document, reusing the tokens already computed for it in `tokens`
+	(e.g. those of the catalogue, computed once per catalogue version).
+	"""
+	known  = tokens if tokens is not None else {}
+	result = {
+		doc_id: known[doc_id] if doc_id in known else tokenize_text(doc_content)
+		for doc_id, doc_content in documents.items()
+	}
+	return result
 
 
 
@@ -104,6 +173,7 @@ def score_mean(
 	Pros: Smooth and comparable across prompts.
 	Cons: Too forgiving — a lot of weak matches can look better than a few very strong ones.
 	"""
+	import torch
 	get_extreme = torch.min if sim_mode == "distance" else torch.max
 	ext_scores  = get_extreme(similarity_matrix, dim=1).values
 	ext_scores  = ext_scores[torch.isfinite(ext_scores)]
@@ -125,6 +195,7 @@ def score_softmax_mean(
 	Pros: Highlights strong matches more, with a tunable alpha to control focus.
 	Cons: Needs alpha tuning.
 	"""
+	import torch
 	def softmax(x: torch.Tensor, alpha : float) -> torch.Tensor:
 		exp_x = torch.exp(alpha * x)
 		return exp_x / torch.sum(exp_x)
@@ -147,11 +218,29 @@ def score_harmonic_mean(
 			score alone won't dominate the final score.
 	Cons: Can underestimate relevance if there’s only one excellent match.
 	"""
+	import torch
 	get_extreme = torch.min if sim_mode == "distance" else torch.max
 	ext_scores  = get_extreme(similarity_matrix, dim=1).values
 	result      = len(ext_scores) / torch.sum(1.0 / (ext_scores + epsilon))
 	return result.item()
 
+def score_upper_bound(
+	similarity_matrix : torch.Tensor,
+	mean_mode         : MeanMode_Literal,
+	epsilon           : float = DEFAULT_EPSILON,
+) -> float:
+	"""
+	Upper bound of the cosine score of a similarity matrix under `mean_mode`: no mean of
+	the best similarities of the user sentences exceeds the largest one. The harmonic
+	mean (of the similarities shifted by `epsilon`) is only bounded when they are positive.
+	"""
+	import torch
+	ext_scores = torch.max(similarity_matrix, dim=1).values
+	best       = ext_scores.max().item()
+	if mean_mode == "harmonic":
+		return best + epsilon if ext_scores.min().item() + epsilon > 0 else inf
+	return best
+
 def compute_distance_similarity_matrix_by_lexicon(
 	user_words  : InputText,
 	match_words : DocumentContent,
@@ -160,6 +249,7 @@ def compute_distance_similarity_matrix_by_lexicon(
 	"""
 	Computes a similarity matrix based on WordNet distance between words.
 	"""
+	import torch
 	distance_fn = {
 		"path"             : wordnet.path_similarity,
 		"leacock-chodorow" : wordnet.lch_similarity,
@@ -193,15 +283,31 @@ def compute_cosine_similarity_matrix(
 ) -> torch.Tensor:
 	"""
 	Compute cosine similarity between a prompt and a list of sentences.
-	Note that the user_input is a list so that this can work with word lists as well.
+	Note that the user_input is a list so that this can work with word lists as well;
+	both lists are encoded as they are (already split into sentences or words).
 	"""
-	user_sentences   = sum([nltk.sent_tokenize(user_str)  for user_str  in user_input  ], cast(list[str], []))
-	match_sentences  = sum([nltk.sent_tokenize(match_str) for match_str in match_strs  ], cast(list[str], []))
-	user_embeddings  = encoder(user_sentences)
-	match_embeddings = encoder(match_sentences)
-	cosine_scores    = util.pytorch_cos_sim(user_embeddings, match_embeddings)
+	ENCODE_BATCH_SIZE.observe(len(user_input))
+	ENCODE_BATCH_SIZE.observe(len(match_strs))
+	with ENCODE_SECONDS.time():
+		user_embeddings  = encoder(user_input)
+		match_embeddings = encoder(match_strs)
+	cosine_scores    = cosine_similarity(user_embeddings, match_embeddings)
 	return cosine_scores
 
+def cosine_similarity(a, b) -> torch.Tensor:
+	"""
+	Pairwise cosine similarities between the rows of `a` and `b` (tensors or arrays),
+	as `sentence_transformers.util.cos_sim`, without importing sentence_transformers.
+	"""
+	import torch
+	a = torch.as_tensor(a, dtype=torch.float32)
+	b = torch.as_tensor(b, dtype=torch.float32)
+	if a.dim() == 1: a = a.unsqueeze(0)
+	if b.dim() == 1: b = b.unsqueeze(0)
+	a_norm = torch.nn.functional.normalize(a, p=2, dim=1)
+	b_norm = torch.nn.functional.normalize(b, p=2, dim=1)
+	return a_norm @ b_norm.T
+
 
 
 #######################################################################
@@ -235,6 +341,8 @@ def get_tfidf_brown_vectorizer() -> TfidfVectorizer:
 	"""
 	Train a TF-IDF vectorizer on the Brown corpus.
 	"""
+	from sklearn.feature_extraction.text import TfidfVectorizer
+	ensure_nltk_data("brown")
 	brown_sentences = [' '.join(sent) for sent in brown.sents()]
 	vectorizer = TfidfVectorizer(smooth_idf=True)
 	vectorizer.fit(brown_sentences)
@@ -280,8 +388,8 @@ def get_rare_words(
 #######################################################################
 
 def compute_distance_scores_by_lexicon(
-	user_input  : InputText,
-	documents   : DocumentDict,
+	user_input  : TokenizedText,
+	documents   : TokenIndex,
 	distance    : WNDistanceMode_Literal,
 	mean_mode   : MeanMode_Literal,
 	alpha       : float                     = DEFAULT_ALPHA,
@@ -296,12 +404,10 @@ def compute_distance_scores_by_lexicon(
 		"softmax"    : lambda x: score_softmax_mean  (x, "distance", alpha),
 		"harmonic"   : lambda x: score_harmonic_mean (x, "distance", epsilon),
 	}[mean_mode]
-	user_words = sum([nltk.word_tokenize(sentence.lower()) for sentence in user_input], cast(list[str], []))
-	user_words = [w for w in set(user_words) if wordnet.synsets(w) != []]
+	user_words = [w for w in user_input["words"] if wordnet.synsets(w) != []]
 	doc_scores = {}
-	for doc_id, doc_sentences in documents.items():
-		match_words        = sum([nltk.word_tokenize(sentence.lower()) for sentence in doc_sentences], cast(list[str], []))
-		match_words        = [w for w in set(match_words) if wordnet.synsets(w) != []]
+	for doc_id, doc_tokens in documents.items():
+		match_words        = [w for w in doc_tokens["words"] if wordnet.synsets(w) != []]
 		similarity_matrix  = compute_distance_similarity_matrix_by_lexicon(user_words, match_words, distance)
 		score              = mean_fn(similarity_matrix)
 		doc_scores[doc_id] = score
@@ -310,8 +416,8 @@ def compute_distance_scores_by_lexicon(
 	return result
 
 def compute_cosine_scores_by_lexicon(
-	user_input  : InputText,
-	documents   : DocumentDict,
+	user_input  : TokenizedText,
+	documents   : TokenIndex,
 	model       : LexiconModel,
 	mean_mode   : MeanMode_Literal,
 	alpha       : float                      = DEFAULT_ALPHA,
@@ -326,43 +432,83 @@ def compute_cosine_scores_by_lexicon(
 		"softmax"    : lambda x: score_softmax_mean  (x, "cosine", alpha),
 		"harmonic"   : lambda x: score_harmonic_mean (x, "cosine", epsilon),
 	}[mean_mode]
+	import torch
 	encoder    = lambda x: torch.tensor([model[word] for word in x if word in model])
-	user_words = sum([nltk.word_tokenize(sentence.lower()) for sentence in user_input], cast(list[str], []))
-	user_words = list(set(user_words))
+	user_words = user_input["words"]
 	doc_scores = {}
-	for doc_id, doc_sentences in documents.items():
-		match_words        = sum([nltk.word_tokenize(sentence.lower()) for sentence in doc_sentences], cast(list[str], []))
-		match_words        = list(set(match_words))
-		similarity_matrix  = compute_cosine_similarity_matrix(user_words, match_words, encoder)
+	for doc_id, doc_tokens in documents.items():
+		similarity_matrix  = compute_cosine_similarity_matrix(user_words, doc_tokens["words"], encoder)
 		score              = mean_fn(similarity_matrix)
 		doc_scores[doc_id] = score
 	doc_scores_sorted = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
 	result = {doc_id: score for doc_id, score in doc_scores_sorted}
 	return result
 
+def build_sentence_index(
+	model       : SentenceModel,
+	documents   : TokenIndex,
+) -> SentenceIndex:
+	"""
+	Encode the sentences of every document once, in a single batch, so that requests
+	against a fixed set of documents (the rAIson catalogue) only encode the user input.
+	"""
+	import torch
+	all_sentences = [sentence for doc_tokens in documents.values() for sentence in doc_tokens["sentences"]]
+	ENCODE_BATCH_SIZE.observe(len(all_sentences))
+	with ENCODE_SECONDS.time():
+		embeddings = torch.as_tensor(model.encode(all_sentences))
+	result : SentenceIndex = {}
+	offset = 0
+	for doc_id, doc_tokens in documents.items():
+		result[doc_id] = embeddings[offset : offset + len(doc_tokens["sentences"])]
+		offset += len(doc_tokens["sentences"])
+	return result
+
+def stack_sentence_index(
+	index   : SentenceIndex,
+	doc_ids : list[DocumentID],
+) -> tuple[torch.Tensor, list[int]]:
+	"""
+	All the sentence embeddings of the documents in one matrix, in the order of `doc_ids`,
+	and the number of sentences of each document (to split the similarity columns by document).
+	"""
+	import torch
+	matrix = torch.cat([torch.as_tensor(index[doc_id]) for doc_id in doc_ids])
+	sizes  = [len(index[doc_id]) for doc_id in doc_ids]
+	return matrix, sizes
+
 def compute_cosine_scores_by_sentences(
-	user_input  : InputText,
-	documents   : DocumentDict,
+	user_input  : TokenizedText,
+	documents   : TokenIndex,
 	model       : SentenceModel,
 	mean_mode   : MeanMode_Literal,
 	alpha       : float                   = DEFAULT_ALPHA,
 	epsilon     : float                   = DEFAULT_EPSILON,
+	index       : SentenceIndex | None    = None,
 ) -> ScoresDict:
 	"""
 	Compute similarity scores based on cosine similarity.
 	Optimal results are the maximal ones, which are given at the beginning of the results list.
+	With an `index` of the documents (see `build_sentence_index`), only the user input is encoded.
 	"""
 	mean_fn : Callable[[torch.Tensor], float] = {
 		"arithmetic" : lambda x: score_mean          (x, "cosine"),
 		"softmax"    : lambda x: score_softmax_mean  (x, "cosine", alpha),
 		"harmonic"   : lambda x: score_harmonic_mean (x, "cosine", epsilon),
 	}[mean_mode]
-	encoder    = lambda x: model.encode(x)
-	user_words = sum([nltk.sent_tokenize(sentence) for sentence in user_input], cast(list[str], []))
-	user_words = list(set(user_words))
+	encoder        = lambda x: model.encode(x)
+	user_sentences = list(dict.fromkeys(user_input["sentences"]))
+	user_embeddings = None
+	if index is not None:
+		ENCODE_BATCH_SIZE.observe(len(user_sentences))
+		with ENCODE_SECONDS.time():
+			user_embeddings = encoder(user_sentences)
 	doc_scores = {}
-	for doc_id, doc_sentences in documents.items():
-		similarity_matrix  = compute_cosine_similarity_matrix(user_words, doc_sentences, encoder)
+	for doc_id, doc_tokens in documents.items():
+		if user_embeddings is not None and index is not None and doc_id in index:
+			similarity_matrix = cosine_similarity(user_embeddings, index[doc_id])
+		else:
+			similarity_matrix = compute_cosine_similarity_matrix(user_sentences, doc_tokens["sentences"], encoder)
 		score              = mean_fn(similarity_matrix)
 		doc_scores[doc_id] = score
 	doc_scores_sorted = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
@@ -377,9 +523,36 @@ def compute_cosine_scores_by_sentences(
 #
 #######################################################################
 
+# NLTK data packages, by the path under which `nltk.data.find` looks for them.
+NLTK_RESOURCES = {
+	"punkt"     : "tokenizers/punkt",      # Punkt tokenizer; necessary for sentence tokenization
+	"punkt_tab" : "tokenizers/punkt_tab",  # Punkt_tab
+	"wordnet"   : "corpora/wordnet",
+	"omw-1.4"   : "corpora/omw-1.4",       # Open Multilingual WordNet; necessary for newer versions of wordnet
+	"brown"     : "corpora/brown",         # Brown corpus; necessary for a TF-IDF baseline
+}
+_nltk_checked : set[str] = set()
+
+def ensure_nltk_data(*names : str) -> None:
+	"""
+	Make sure the given NLTK data packages are installed: they are looked up locally,
+	and only downloaded when missing (once per process).
+	"""
+	for name in names:
+		if name in _nltk_checked:
+			continue
+		try:
+			nltk.data.find(NLTK_RESOURCES[name])
+		except LookupError:
+			print(f"INFO: Downloading NLTK data '{name}'")
+			nltk.download(name, quiet = True)
+		_nltk_checked.add(name)
+
 def load_sentence_model(model_literal : SentenceModel_Literal) -> SentenceModel:
 	result : SentenceModel
-	if   model_literal == "sbert"            : result = SentenceTransformer(SBERT_MODEL_STR)
+	if   model_literal == "sbert":
+		from sentence_transformers import SentenceTransformer
+		result = SentenceTransformer(SBERT_MODEL_STR)
 	# TODO fix
 	# elif model_literal == "google-use-lite"  : result = hub.load(GUSE_MODEL_STR_LITE ).signatures['default']
 	# elif model_literal == "google-use-large" : result = hub.load(GUSE_MODEL_STR_LARGE)
@@ -387,6 +560,8 @@ def load_sentence_model(model_literal : SentenceModel_Literal) -> SentenceModel:
 	return result
 
 def load_lexicon_model(model_literal : LexiconModel_Literal) -> LexiconModel:
+	import gensim.downloader as gensim_api
+	from gensim.models import KeyedVectors
 	addr_str = 'word2vec-google-news-300' if model_literal == "word2vec" else "glove-wiki-gigaword-100"
 	if   model_literal == "word2vec" : result = gensim_api.load(addr_str)
 	elif model_literal == "glove"    : result = gensim_api.load(addr_str)
@@ -394,25 +569,75 @@ def load_lexicon_model(model_literal : LexiconModel_Literal) -> LexiconModel:
 	assert isinstance(result, KeyedVectors)
 	return result
 
-def load_all_models() -> ModelsDict_Both:
-	nltk.download('wordnet')
-	nltk.download('omw-1.4')  # Open Multilingual WordNet; necessary for newer versions of wordnet
-	nltk.download('brown')	  # Brown corpus; necessary for a TF-IDF baseline
-	nltk.download('punkt')	  # Punkt tokenizer; necessary for sentence tokenization
-	nltk.download('punkt_tab')	# Punkt_tab
-	sentence_models : ModelsDict_Sentence = {
-		"sbert"           : load_sentence_model("sbert"),
-	#	"google-use-lite" : load_sentence_model("google-use-lite"),
-	#	"google-use-large": load_sentence_model("google-use-large"),
-	}
-	lexicon_models : ModelsDict_Lexicon = {
-		"word2vec": load_lexicon_model("word2vec"),
-		"glove"   : load_lexicon_model("glove"),
-	}
-	result : ModelsDict_Both = {
-		"sentence": sentence_models,
-		"lexicon" : lexicon_models,
-	}
+def load_wordnet():
+	"""
+	WordNet has no model to load, only its corpus (used through `nltk.corpus.wordnet`).
+	"""
+	ensure_nltk_data("wordnet", "omw-1.4")
+	wordnet.ensure_loaded()
+	return wordnet
+
+ModelLoaders = dict[ModelQueryKey, tuple[ModelKind_Literal, Callable[[], object]]]
+
+MODEL_LOADERS : ModelLoaders = {
+	"sbert"            : ("sentence", lambda: load_sentence_model("sbert")),
+#	"google-use-lite"  : ("sentence", lambda: load_sentence_model("google-use-lite")),
+#	"google-use-large" : ("sentence", lambda: load_sentence_model("google-use-large")),
+	"wordnet"          : ("lexicon",  load_wordnet),
+	"word2vec"         : ("lexicon",  lambda: load_lexicon_model("word2vec")),
+	"glove"            : ("lexicon",  lambda: load_lexicon_model("glove")),
+}
+
+class ModelRegistry:
+	"""
+	The models of the sentence matcher, by key. Each model (and the libraries it needs)
+	is only imported and loaded on first use, or by `preload`, then kept for the life of
+	the process. Concurrent first uses of a model load it only once.
+	"""
+
+	def __init__(self, loaders : ModelLoaders | None = None):
+		self.loaders      = loaders if loaders is not None else MODEL_LOADERS
+		self.models       : dict[ModelQueryKey, object] = {}
+		self.load_seconds : dict[ModelQueryKey, float]  = {}
+		self._locks       = {key: threading.Lock() for key in self.loaders}
+
+	def kind(self, key : ModelQueryKey) -> ModelKind_Literal:
+		if key not in self.loaders:
+			raise ValueError(f"Invalid model key {key}")
+		return self.loaders[key][0]
+
+	def is_loaded(self, key : ModelQueryKey) -> bool:
+		return key in self.models
+
+	def get(self, key : ModelQueryKey) -> object:
+		"""
+		Returns the model called `key`, loading it first if needed.
+		"""
+		model = self.models.get(key)
+		if model is not None:
+			return model
+		self.kind(key)  # raises on unknown keys
+		with self._locks[key]:
+			if key not in self.models:
+				start = perf_counter()
+				self.models[key] = self.loaders[key][1]()
+				self.load_seconds[key] = perf_counter() - start
+				MODEL_LOAD_SECONDS.labels(model = key).set(self.load_seconds[key])
+				print(f"INFO: Loaded model '{key}' in {self.load_seconds[key]:.2f}s")
+		return self.models[key]
+
+	def preload(self, keys : list[ModelQueryKey]) -> None:
+		for key in keys:
+			self.get(key)
+
+def create_model_registry(preload : list[ModelQueryKey] | None = None) -> ModelRegistry:
+	"""
+	Checks the NLTK data used by every request (sentence tokenization), then returns
+	a registry with the `preload` models (default: PRELOAD_MODELS) already loaded.
+	"""
+	ensure_nltk_data("punkt", "punkt_tab")
+	result = ModelRegistry()
+	result.preload(preload if preload is not None else cast(list[ModelQueryKey], PRELOAD_MODELS))
 	return result
 
 
@@ -424,7 +649,7 @@ def load_all_models() -> ModelsDict_Both:
 #######################################################################
 
 def get_sentence_matching_scores(
-	models      : ModelsDict_Both,
+	models      : ModelRegistry,
 	documents   : DocumentDict,
 	user_input  : InputText,
 	model_key   : SentenceModel_Literal | LexiconModel_Literal | None = None,
@@ -432,27 +657,181 @@ def get_sentence_matching_scores(
 	dist_mode   : WNDistanceMode_Literal                       | None = None,
 	alpha       : float                                        | None = None,
 	epsilon     : float                                        | None = None,
+	index       : SentenceIndex                                | None = None,
+	tokens      : TokenIndex                                   | None = None,
 ) -> ScoresDict:
 	"""
 	Compute similarity scores based on the chosen model.
+	`index` holds precomputed embeddings of `documents` for the chosen sentence model,
+	and `tokens` the precomputed tokens of `documents` (see `build_document_indexes`).
+	The user input is tokenized once, whatever the model.
 	"""
 	safe_model_key = model_key if model_key is not None else DEFAULT_MODEL_SENTENCE
 	safe_mean_mode = mean_mode if mean_mode is not None else DEFAULT_MODE_MEAN
 	safe_dist_mode = dist_mode if dist_mode is not None else DEFAULT_MODE_WN
 	safe_alpha     = alpha     if alpha     is not None else DEFAULT_ALPHA
 	safe_epsilon   = epsilon   if epsilon   is not None else DEFAULT_EPSILON
+	kind           = models.kind(safe_model_key)
+	user_tokens    = tokenize_text(user_input)
+	doc_tokens     = tokenize_documents(documents, tokens)
 	if   safe_model_key == "wordnet":
-		scores = compute_distance_scores_by_lexicon(user_input , documents, safe_dist_mode, safe_mean_mode, safe_alpha, safe_epsilon)
-	elif safe_model_key in models["lexicon"]:
-		model = models["lexicon"][cast(LexiconModel_Literal, safe_model_key)]
-		scores = compute_cosine_scores_by_lexicon(user_input , documents, model, safe_mean_mode, safe_alpha, safe_epsilon)
-	elif safe_model_key in models["sentence"]:
-		model = models["sentence"][cast(SentenceModel_Literal, safe_model_key)]
-		scores = compute_cosine_scores_by_sentences(user_input , documents, model, safe_mean_mode, safe_alpha, safe_epsilon)
+		models.get(safe_model_key)
+		scores = compute_distance_scores_by_lexicon(user_tokens, doc_tokens, safe_dist_mode, safe_mean_mode, safe_alpha, safe_epsilon)
+	elif kind == "lexicon":
+		model = cast(LexiconModel, models.get(safe_model_key))
+		scores = compute_cosine_scores_by_lexicon(user_tokens, doc_tokens, model, safe_mean_mode, safe_alpha, safe_epsilon)
 	else:
-		raise ValueError(f"Invalid model key {safe_model_key}")
+		model = cast(SentenceModel, models.get(safe_model_key))
+		scores = compute_cosine_scores_by_sentences(user_tokens, doc_tokens, model, safe_mean_mode, safe_alpha, safe_epsilon, index)
 	return scores
 
+def iter_batch_matching_scores(
+	models      : ModelRegistry,
+	documents   : DocumentDict,
+	user_inputs : list[str],
+	model_key   : SentenceModel_Literal | LexiconModel_Literal | None = None,
+	mean_mode   : MeanMode_Literal                             | None = None,
+	dist_mode   : WNDistanceMode_Literal                       | None = None,
+	alpha       : float                                        | None = None,
+	epsilon     : float                                        | None = None,
+	index       : SentenceIndex                                | None = None,
+	tokens      : TokenIndex                                   | None = None,
+	chunk_size  : int                                                 = BATCH_CHUNK_SIZE,
+) -> Iterator[ScoresDict]:
+	"""
+	Yield the scores of each user input (in order), as `get_sentence_matching_scores` would.
+	With a sentence model, the distinct sentences of `chunk_size` inputs at a time are encoded
+	in one batch, and compared to all the document sentences in one similarity computation.
+	Lexicon models score the inputs one at a time. Inputs without any sentence get no scores.
+	"""
+	safe_model_key = model_key if model_key is not None else DEFAULT_MODEL_SENTENCE
+	safe_mean_mode = mean_mode if mean_mode is not None else DEFAULT_MODE_MEAN
+	safe_alpha     = alpha     if alpha     is not None else DEFAULT_ALPHA
+	safe_epsilon   = epsilon   if epsilon   is not None else DEFAULT_EPSILON
+	doc_tokens     = tokenize_documents(documents, tokens)
+	if models.kind(safe_model_key) != "sentence":
+		for user_input in user_inputs:
+			yield get_sentence_matching_scores(
+				models, documents, [user_input], safe_model_key, mean_mode, dist_mode, alpha, epsilon, None, doc_tokens,
+			)
+		return
+	mean_fn : Callable[[torch.Tensor], float] = {
+		"arithmetic" : lambda x: score_mean          (x, "cosine"),
+		"softmax"    : lambda x: score_softmax_mean  (x, "cosine", safe_alpha),
+		"harmonic"   : lambda x: score_harmonic_mean (x, "cosine", safe_epsilon),
+	}[safe_mean_mode]
+	model = cast(SentenceModel, models.get(safe_model_key))
+	if index is None or any(doc_id not in index for doc_id in doc_tokens):
+		index = build_sentence_index(model, doc_tokens)
+	doc_ids                = list(doc_tokens)
+	doc_matrix, doc_sizes  = stack_sentence_index(index, doc_ids)
+	for start in range(0, len(user_inputs), chunk_size):
+		rows       : dict[str, int] = {}  # row of each distinct sentence of the chunk
+		input_rows = [
+			[rows.setdefault(sentence, len(rows)) for sentence in dict.fromkeys(tokenize_text([user_input])["sentences"])]
+			for user_input in user_inputs[start : start + chunk_size]
+		]
+		if rows:
+			ENCODE_BATCH_SIZE.observe(len(rows))
+			with ENCODE_SECONDS.time():
+				user_embeddings = model.encode(list(rows))
+			similarity = cosine_similarity(user_embeddings, doc_matrix)
+		for input_row in input_rows:
+			if not input_row:
+				yield {}
+				continue
+			input_similarity = similarity[input_row]
+			doc_scores = {
+				doc_id: mean_fn(doc_similarity)
+				for doc_id, doc_similarity in zip(doc_ids, input_similarity.split(doc_sizes, dim=1))
+			}
+			doc_scores_sorted = sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)
+			result = {doc_id: score for doc_id, score in doc_scores_sorted}
+			yield result
+
+def get_top_k_matching_scores(
+	models      : ModelRegistry,
+	documents   : DocumentDict,
+	user_input  : InputText,
+	k           : int,
+	model_key   : SentenceModel_Literal | LexiconModel_Literal | None = None,
+	mean_mode   : MeanMode_Literal                             | None = None,
+	dist_mode   : WNDistanceMode_Literal                       | None = None,
+	alpha       : float                                        | None = None,
+	epsilon     : float                                        | None = None,
+	index       : SentenceIndex                                | None = None,
+	tokens      : TokenIndex                                   | None = None,
+) -> ScoresDict:
+	"""
+	The `k` best documents with their scores, best first: the first `k` entries of
+	`get_sentence_matching_scores`. With a sentence model, the user input is compared to
+	all the document sentences at once, then the documents are scored in decreasing order
+	of an upper bound of their score (see `score_upper_bound`), keeping the `k` best in a
+	heap, until no remaining document can enter the top `k`.
+	"""
+	safe_model_key = model_key if model_key is not None else DEFAULT_MODEL_SENTENCE
+	safe_mean_mode = mean_mode if mean_mode is not None else DEFAULT_MODE_MEAN
+	safe_alpha     = alpha     if alpha     is not None else DEFAULT_ALPHA
+	safe_epsilon   = epsilon   if epsilon   is not None else DEFAULT_EPSILON
+	doc_tokens     = tokenize_documents(documents, tokens)
+	if models.kind(safe_model_key) != "sentence":
+		scores = get_sentence_matching_scores(
+			models, documents, user_input, safe_model_key, mean_mode, dist_mode, alpha, epsilon, None, doc_tokens,
+		)
+		return dict(islice(scores.items(), max(k, 0)))
+	mean_fn : Callable[[torch.Tensor], float] = {
+		"arithmetic" : lambda x: score_mean          (x, "cosine"),
+		"softmax"    : lambda x: score_softmax_mean  (x, "cosine", safe_alpha),
+		"harmonic"   : lambda x: score_harmonic_mean (x, "cosine", safe_epsilon),
+	}[safe_mean_mode]
+	user_sentences = list(dict.fromkeys(tokenize_text(user_input)["sentences"]))
+	if k <= 0 or not user_sentences or not doc_tokens:
+		return {}
+	model = cast(SentenceModel, models.get(safe_model_key))
+	if index is None or any(doc_id not in index for doc_id in doc_tokens):
+		index = build_sentence_index(model, doc_tokens)
+	doc_ids               = list(doc_tokens)
+	doc_matrix, doc_sizes = stack_sentence_index(index, doc_ids)
+	ENCODE_BATCH_SIZE.observe(len(user_sentences))
+	with ENCODE_SECONDS.time():
+		user_embeddings = model.encode(user_sentences)
+	similarity       = cosine_similarity(user_embeddings, doc_matrix)
+	doc_similarities = dict(zip(doc_ids, similarity.split(doc_sizes, dim=1)))
+	candidates       = sorted(
+		((score_upper_bound(doc_similarity, safe_mean_mode, safe_epsilon), doc_id) for doc_id, doc_similarity in doc_similarities.items()),
+		reverse = True,
+	)
+	top    : list[tuple[float, DocumentID]] = []  # min-heap of the k best (score, document) so far
+	scored = 0
+	for bound, doc_id in candidates:
+		if len(top) == k and bound <= top[0][0]:
+			break  # neither this document nor the next ones can beat the k-th best score
+		score   = mean_fn(doc_similarities[doc_id])
+		scored += 1
+		if len(top) < k:
+			heapq.heappush(top, (score, doc_id))
+		elif score > top[0][0]:
+			heapq.heapreplace(top, (score, doc_id))
+	TOP_K_SCORED.observe(scored)
+	result = {doc_id: score for score, doc_id in sorted(top, reverse=True)}
+	return result
+
+def build_document_indexes(
+	models      : ModelRegistry,
+	documents   : DocumentDict,
+) -> dict[str, object]:
+	"""
+	Precompute what requests against a fixed set of documents (the rAIson catalogue)
+	can share: the tokens of each document, and its sentence embeddings for the
+	default sentence model.
+	"""
+	tokens = tokenize_documents(documents)
+	result : dict[str, object] = {
+		TOKEN_INDEX_KEY        : tokens,
+		DEFAULT_MODEL_SENTENCE : build_sentence_index(cast(SentenceModel, models.get(DEFAULT_MODEL_SENTENCE)), tokens),
+	}
+	return result
+
 
 
 #######################################################################
@@ -462,11 +841,7 @@ def get_sentence_matching_scores(
 #######################################################################
 
 if __name__ == '__main__':
-	nltk.download('wordnet')
-	nltk.download('omw-1.4')  # Open Multilingual WordNet; necessary for newer versions of wordnet
-	nltk.download('brown')	# Brown corpus; necessary for a TF-IDF baseline
-	nltk.download('punkt')	# Punkt tokenizer; necessary for sentence tokenization
-	nltk.download('punkt_tab')	# Punkt_tab
+	ensure_nltk_data("punkt", "punkt_tab", "wordnet", "omw-1.4", "brown")
 	model_sentence : SentenceModel = load_sentence_model (DEFAULT_MODEL_SENTENCE)
 	model_lexicon  : LexiconModel  = load_lexicon_model  (DEFAULT_MODEL_LEXICON)
 
@@ -477,10 +852,12 @@ if __name__ == '__main__':
 		'doc4': ["I like tilling the earth.", "Planting seeds into the soil is nice too."],
 	}
 	prompt = 'Find and carry the minerals.'
+	prompt_tokens   = tokenize_text([prompt])
+	document_tokens = tokenize_documents(documents)
 
-	dist_scores = compute_distance_scores_by_lexicon ([prompt], documents, DEFAULT_MODE_WN, DEFAULT_MODE_MEAN)
-	cosl_scores = compute_cosine_scores_by_lexicon   ([prompt], documents, model_lexicon,   DEFAULT_MODE_MEAN)
-	coss_scores = compute_cosine_scores_by_sentences ([prompt], documents, model_sentence,  DEFAULT_MODE_MEAN)
+	dist_scores = compute_distance_scores_by_lexicon (prompt_tokens, document_tokens, DEFAULT_MODE_WN, DEFAULT_MODE_MEAN)
+	cosl_scores = compute_cosine_scores_by_lexicon   (prompt_tokens, document_tokens, model_lexicon,   DEFAULT_MODE_MEAN)
+	coss_scores = compute_cosine_scores_by_sentences (prompt_tokens, document_tokens, model_sentence,  DEFAULT_MODE_MEAN)
 
 	print("Distance scores:",          dist_scores)
 	print("Cosine scores (lexicon):",  cosl_scores)  # Threshold seems to around 0.75
@@ -1,4 +1,7 @@
 #!/bin/bash
 
+# The shared "common" package (tracing, instrumentation) lives at the repository root.
+export PYTHONPATH="$(cd "$(dirname "$0")/.." && pwd):$PYTHONPATH"
+
 echo "[INFO] Starting FastAPI application..."
 python3.10 role4_service.py
@@ -4,11 +4,16 @@ import logging
 import requests
 import uvicorn
 from fastapi import FastAPI, Body, Depends, HTTPException
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy import create_engine, inspect, Column, Index, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
 from pydantic import BaseModel
 
+from common import transport
+from common.deadline import install_deadline
+from common.metrics import install_metrics
+from common.tracing import install_tracing, outgoing_headers, span
+
 # ---------------------------
 # Logging Setup
 # ---------------------------
@@ -31,14 +36,22 @@ Base = declarative_base()
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Same index as R1 (the table may be shared): newest messages of a session.
+        Index("ix_messages_session_id_created_at", "session_id", "created_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String, index=True)
+    session_id = Column(String)
     role = Column(String)  # 'user' or 'assistant'
     text = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
-# Create tables if they don't exist
+# Create tables if they don't exist, and the indexes missing from older databases
 Base.metadata.create_all(bind=engine)
+existing_indexes = {index["name"] for index in inspect(engine).get_indexes(Message.__tablename__)}
+for index in Message.__table__.indexes:
+    if index.name not in existing_indexes:
+        index.create(bind=engine)
 
 # Dependency to get a database session
 def get_db():
@@ -48,20 +61,24 @@ def get_db():
     finally:
         db.close()
 
-def get_session_history(db: Session, session_id: str):
-    """Retrieve the conversation history for the given session_id."""
+def get_session_history(db: Session, session_id: str, limit: int = 50):
+    """Retrieve the newest `limit` messages of the given session_id, oldest first."""
     messages = (
         db.query(Message)
         .filter(Message.session_id == session_id)
-        .order_by(Message.created_at)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(limit)
         .all()
     )
-    return [(msg.role, msg.text) for msg in messages]
+    return [(msg.role, msg.text) for msg in reversed(messages)]
 
 # ---------------------------
 # FastAPI Application Setup
 # ---------------------------
 app = FastAPI(title="R4 - Process User Input", description="Detects user input type: conversation or service request", version="1.0.0")
+install_tracing(app, "R4")
+install_metrics(app, "R4")
+install_deadline(app)
 
 # Pydantic model for the user input
 class UserInput(BaseModel):
@@ -98,8 +115,10 @@ def call_r1_api(session_id: str, user_message: str) -> str:
     payload = {
         "session_id": session_id,
         "user_message": user_message,
+        "priority": "critical",  # short classification prompt, on the critical path of every turn
     }
-    response = requests.post(R1_API_URL, json=payload, timeout=5)
+    with span("R1 /generate", session_id=session_id):
+        response = transport.post("R1", R1_API_URL, json=payload, headers=outgoing_headers(), timeout=5)
     if response.status_code == 200:
         return response.json()["response"]
     else:
@@ -109,7 +128,8 @@ def call_broker_api(user_input: str) -> str:
     payload = {
         "user_input": user_input,
     }
-    response = requests.post(BROKER_API_URL, json=payload, timeout=5)
+    with span("broker /process_request"):
+        response = requests.post(BROKER_API_URL, json=payload, headers=outgoing_headers(), timeout=5)
     if response.status_code == 200:
         return response.json()["response"]
     else:
@@ -160,6 +180,9 @@ def classify_user_input(user_input: UserInput) -> bool:
     input_type = classify_input(user_input.user_message)
     return input_type == "decision"
 
+# In-process version of the route called by the broker (co-located deployment)
+transport.register_endpoint("R4", "POST", "/classify_input", classify_user_input, UserInput)
+
 if __name__ == "__main__":
     
     uvicorn.run("role4_service:app", host="0.0.0.0", port=8004, reload=False)
@@ -1,4 +1,7 @@
 #!/bin/bash
 
+# The shared "common" package (tracing, instrumentation) lives at the repository root.
+export PYTHONPATH="$(cd "$(dirname "$0")/.." && pwd):$PYTHONPATH"
+
 echo "[INFO] Starting FastAPI application..."
 uvicorn role5_service:app --host 0.0.0.0 --port 8005
\ No newline at end of file
@@ -4,9 +4,27 @@ from pydantic import BaseModel
 import json
 import requests
 import re
+import os
 import logging
+import threading
+from collections import OrderedDict
 from config import api_key
 
+from common import deadline, transport
+from common.deadline import install_deadline, is_deadline_failure
+from common.metrics import install_metrics
+from common.tracing import install_tracing, outgoing_headers, span
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # the embedding fast path is optional
+    np = None
+    SentenceTransformer = None
+
+# Base URL of the Ai-Raison API (can point to a local stub for offline benchmarks)
+RAISON_API_URL = os.getenv("RAISON_API_URL", "https://api.ai-raison.com")
+
 # Logging Configuration
 logging.basicConfig(
     level=logging.DEBUG,
@@ -15,6 +33,9 @@ logging.basicConfig(
 )
 
 app = FastAPI(title="Role 5 - Matching Scenarios Service")
+install_tracing(app, "R5")
+install_metrics(app, "R5")
+install_deadline(app)
 
 # Pydantic models for request/response
 class MatchRequest(BaseModel):
@@ -26,6 +47,7 @@ class MatchResponse(BaseModel):
     user_input: list[str]
     matched_scenarios: list[str]
     info: str
+    matched_by: str = "llm"  # "embedding" (fast path), "llm" or "fallback" (no time left for the LLM)
 
 @app.get("/health")
 def health_check():
@@ -34,14 +56,14 @@ def health_check():
 @app.post("/match", response_model=MatchResponse)
 def match_endpoint(request: MatchRequest):
     """
-    Receives a project_id and user_input, processes the matching using the LLM,
-    and returns the matching result as JSON.
+    Receives a project_id and user_input, processes the matching (embedding fast
+    path first, LLM for ambiguous cases), and returns the matching result as JSON.
     """
     # Request Logging
     logging.info("Received request for project_id: %s with user_input: %s", request.project_id, request.user_input)
     
     try:
-        result = match_scenarios_with_llm(request.project_id, request.user_input)
+        result = match_scenarios(request.project_id, request.user_input)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
@@ -49,6 +71,9 @@ def match_endpoint(request: MatchRequest):
     logging.info("Forwarding response: %s", result)
     return result
 
+# In-process version of the route called by the broker (co-located deployment)
+transport.register_endpoint("R5", "POST", "/match", match_endpoint, MatchRequest)
+
 
 # --- Pipeline functions ---
 
@@ -95,7 +120,8 @@ def get_data_api(url, api_key):
     headers = {"x-api-key": api_key}
     metadata = {}
     try:
-        response = requests.get(url, headers=headers)
+        with span("rAIson GET", url=url):
+            response = requests.get(url, headers=headers, timeout=deadline.timeout())
         if response.status_code == 200:
             metadata = response.json()
         elif response.status_code == 400:
@@ -118,7 +144,7 @@ def get_project_scenarios(project_id):
     Returns:
         list: A list of scenario labels (strings) associated with the project.
     """
-    base_url = "https://api.ai-raison.com/executions"
+    base_url = f"{RAISON_API_URL}/executions"
     url = f"{base_url}/{project_id}/latest"
 
     metadata = get_data_api(url, api_key)
@@ -164,7 +190,31 @@ def build_prompt(scenarios, user_input):
 
     return full_prompt.strip()
 
-def call_llm(session_id, prompt, host="http://localhost:8000"):
+def build_output_schema(scenarios):
+    """
+    Builds the output schema sent to the LLM API for constrained decoding: the
+    answer can only be the JSON object announced in the prompt, and its list can
+    only contain labels taken from the given scenarios (each at most once).
+
+    Args:
+        scenarios (list of str): List of possible scenarios.
+
+    Returns:
+        dict: The JSON schema of the expected answer.
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "matched_scenarios": {
+                "type": "array",
+                "items": {"enum": scenarios},
+                "uniqueItems": True,
+            }
+        },
+        "required": ["matched_scenarios"],
+    }
+
+def call_llm(session_id, prompt, host="http://localhost:8000", max_new_tokens=100, output_schema=None):
     """
     Sends the constructed prompt to the locally hosted LLM API (FastAPI) at /generate.
 
@@ -172,6 +222,8 @@ def call_llm(session_id, prompt, host="http://localhost:8000"):
         session_id (str): A unique identifier for the conversation.
         prompt (str): The text to be processed by the LLM.
         host (str): The base URL of the LLM API (default: http://localhost:8000).
+        max_new_tokens (int): Maximum number of tokens the LLM may generate.
+        output_schema (dict, optional): JSON schema restricting the LLM's answer (constrained decoding).
 
     Returns:
         str: The raw response text generated by the LLM.
@@ -180,15 +232,19 @@ def call_llm(session_id, prompt, host="http://localhost:8000"):
     payload = {
         "session_id": session_id,
         "user_message": prompt,
-        "max_new_tokens": 100,
+        "max_new_tokens": max_new_tokens,
         "temperature": 0.7,
-        "repetition_penalty": 1.1
+        "repetition_penalty": 1.1,
+        "priority": "critical",  # short constrained answer, scheduled ahead of long generations
     }
+    if output_schema is not None:
+        payload["output_schema"] = output_schema
     
     # Log API call details
     logging.debug("Calling LLM API with session_id: %s and payload: %s", session_id, payload)
     
-    resp = requests.post(url, json=payload)
+    with span("R1 /generate", session_id=session_id, max_new_tokens=max_new_tokens):
+        resp = transport.post("R1", url, json=payload, headers=outgoing_headers())
     resp.raise_for_status()
 
     data = resp.json()
@@ -199,17 +255,19 @@ def call_llm(session_id, prompt, host="http://localhost:8000"):
 
     return llm_text
 
-def match_scenarios_with_llm(project_id, user_input):
+def match_scenarios_with_llm(project_id, user_input, scenarios=None):
     """
     Orchestrates the entire pipeline:
       1) Retrieves scenarios for the given project from Ai-Raison.
       2) Builds a prompt with those scenarios and the user's request.
-      3) Calls the LLM API to get a matching result.
+      3) Calls the LLM API in constrained mode, so that the answer can only be the
+         expected JSON object listing known scenarios.
       4) Attempts to parse the LLM's answer as JSON.
 
     Args:
         project_id (str): The project's identifier (e.g. "PRJ15875").
         user_input (list of str): The user's input request.
+        scenarios (list of str, optional): The project's scenarios, if already retrieved.
 
     Returns:
         dict: A dictionary containing the matched scenarios, for example:
@@ -221,14 +279,28 @@ def match_scenarios_with_llm(project_id, user_input):
         }
     """
     # 1) Retrieve scenarios from Ai-Raison
-    scenarios = get_project_scenarios(project_id)
+    if scenarios is None:
+        scenarios = get_project_scenarios(project_id)
+    if not scenarios:
+        logging.error("No scenarios available for project_id: %s", project_id)
+        return {
+            "project_id": project_id,
+            "user_input": user_input,
+            "matched_scenarios": [],
+            "info": "No scenarios available for this project."
+        }
 
     # 2) Build the LLM prompt
     prompt = build_prompt(scenarios, user_input)
     logging.debug("Constructed prompt: %s", prompt)
 
-    # 3) Call the LLM
-    llm_output = call_llm(session_id="matching_scenarios_session", prompt=prompt)
+    # 3) Call the LLM, constrained to the expected JSON structure (R1 also caps the
+    #    number of generated tokens to the longest answer the schema allows)
+    llm_output = call_llm(
+        session_id="matching_scenarios_session",
+        prompt=prompt,
+        output_schema=build_output_schema(scenarios),
+    )
     
     # 4) Preprocess with regex to extract only the JSON block
     extracted_json = None
@@ -266,6 +338,213 @@ def match_scenarios_with_llm(project_id, user_input):
     result_json["matched_scenarios"] = [scenario for scenario in result_json["matched_scenarios"] if scenario in scenarios]
     return result_json
 
+# --- Embedding fast path ---
+
+# Same sentence encoder as the R2 sentence matcher.
+SBERT_MODEL_STR = "all-MiniLM-L6-v2"
+EMBEDDING_FAST_PATH = os.getenv("R5_EMBEDDING_FAST_PATH", "1") == "1"
+EMBEDDING_TOP_K = 3
+# Minimum cosine similarity for a scenario to be returned.
+EMBEDDING_ACCEPT_THRESHOLD = float(os.getenv("R5_EMBEDDING_ACCEPT_THRESHOLD", "0.6"))
+# Required gap between the last returned and the best rejected scenario.
+EMBEDDING_MARGIN = float(os.getenv("R5_EMBEDDING_MARGIN", "0.1"))
+# Minimum similarity of the extra scenarios returned without the LLM.
+EMBEDDING_FALLBACK_THRESHOLD = float(os.getenv("R5_EMBEDDING_FALLBACK_THRESHOLD", "0.3"))
+# Projects whose label embeddings are kept (least recently used first out).
+LABEL_EMBEDDINGS_CACHE_SIZE = int(os.getenv("R5_LABEL_EMBEDDINGS_CACHE_SIZE", "256"))
+# Below this many seconds left before the caller's deadline, the LLM is not called at all.
+LLM_MIN_BUDGET_S = float(os.getenv("R5_LLM_MIN_BUDGET_S", "2"))
+
+_sbert_model = None
+_sbert_lock = threading.Lock()
+_label_embeddings = OrderedDict()  # {project_id: (tuple of labels, normalized embedding matrix)}, under _sbert_lock
+
+@app.on_event("startup")
+def preload_embedding_model():
+    if EMBEDDING_FAST_PATH:
+        get_sentence_model()
+
+def get_sentence_model():
+    """
+    Loads the SBERT model on first use.
+
+    Returns:
+        SentenceTransformer or None: The model, or None if the fast path is disabled or unavailable.
+    """
+    global _sbert_model
+    if not EMBEDDING_FAST_PATH or SentenceTransformer is None:
+        return None
+    if _sbert_model is None:
+        with _sbert_lock:
+            if _sbert_model is None:
+                logging.info("Loading sentence model %s for the embedding fast path", SBERT_MODEL_STR)
+                _sbert_model = SentenceTransformer(SBERT_MODEL_STR)
+    return _sbert_model
+
+def get_label_embeddings(model, project_id, scenarios):
+    """
+    Returns the normalized embeddings of a project's scenario labels, computed once
+    per project and recomputed only if the scenario list changes. The embeddings of the
+    LABEL_EMBEDDINGS_CACHE_SIZE most recently used projects are kept.
+
+    Args:
+        model (SentenceTransformer): The sentence encoder.
+        project_id (str): The project's identifier.
+        scenarios (list of str): The project's scenario labels.
+
+    Returns:
+        numpy.ndarray: A (number of scenarios, dimension) matrix.
+    """
+    labels = tuple(scenarios)
+    with _sbert_lock:
+        cached = _label_embeddings.get(project_id)
+        if cached is not None and cached[0] == labels:
+            _label_embeddings.move_to_end(project_id)
+            return cached[1]
+    embeddings = model.encode(list(labels), convert_to_numpy=True, normalize_embeddings=True)
+    with _sbert_lock:
+        _label_embeddings[project_id] = (labels, embeddings)
+        _label_embeddings.move_to_end(project_id)
+        while len(_label_embeddings) > LABEL_EMBEDDINGS_CACHE_SIZE:
+            _label_embeddings.popitem(last=False)
+    return embeddings
+
+def embedding_scores(project_id, scenarios, user_input):
+    """
+    Scores every scenario label against the user's sentences: a scenario's score is its
+    best cosine similarity with any of the sentences.
+
+    Returns:
+        numpy.ndarray or None: One score per scenario, or None if the embedding model is unavailable.
+    """
+    model = get_sentence_model()
+    if model is None or not scenarios or not user_input:
+        return None
+    label_embeddings = get_label_embeddings(model, project_id, scenarios)
+    input_embeddings = model.encode(user_input, convert_to_numpy=True, normalize_embeddings=True)
+    return (input_embeddings @ label_embeddings.T).max(axis=0)
+
+def match_scenarios_with_embeddings(project_id, scenarios, user_input):
+    """
+    Scores every scenario label against the user's sentences with SBERT and returns
+    the top-k scenarios only when the decision is clear-cut.
+
+    A scenario's score is its best cosine similarity with any of the user's sentences.
+    The answer is confident when at least one scenario reaches EMBEDDING_ACCEPT_THRESHOLD
+    and the best scenario left out is at least EMBEDDING_MARGIN below the last one kept.
+
+    Args:
+        project_id (str): The project's identifier.
+        scenarios (list of str): The project's scenario labels.
+        user_input (list of str): The user's sentences.
+
+    Returns:
+        list or None: The matched scenarios, or None if the case is ambiguous (or the
+        fast path is unavailable) and should be forwarded to the LLM.
+    """
+    scores = embedding_scores(project_id, scenarios, user_input)
+    if scores is None:
+        return None
+
+    ranking = np.argsort(-scores)
+    selected = [i for i in ranking[:EMBEDDING_TOP_K] if scores[i] >= EMBEDDING_ACCEPT_THRESHOLD]
+    logging.debug("Embedding scores: %s", {scenarios[i]: round(float(scores[i]), 3) for i in ranking})
+    if not selected:
+        return None
+    best_rejected = scores[ranking[len(selected)]] if len(selected) < len(ranking) else -1.0
+    if best_rejected > scores[selected[-1]] - EMBEDDING_MARGIN:
+        return None
+    return [scenarios[i] for i in selected]
+
+def lexical_scores(scenarios, user_input):
+    """Share of each scenario label's words found in the user's sentences."""
+    user_words = set(re.findall(r"\w+", " ".join(user_input).lower()))
+    scores = []
+    for scenario in scenarios:
+        words = set(re.findall(r"\w+", scenario.lower()))
+        scores.append(len(words & user_words) / len(words) if words else 0.0)
+    return scores
+
+def match_scenarios_without_llm(project_id, scenarios, user_input):
+    """
+    Best-effort match used when there is no time left for the LLM: the best scenario
+    by embedding similarity (or by shared words if the embedding model is unavailable),
+    with the other top-k scenarios that are similar enough.
+
+    Args:
+        project_id (str): The project's identifier.
+        scenarios (list of str): The project's scenario labels.
+        user_input (list of str): The user's sentences.
+
+    Returns:
+        list: The matched scenarios (empty if nothing is related to the request at all).
+    """
+    if not scenarios:
+        return []
+    scores = embedding_scores(project_id, scenarios, user_input)
+    threshold = EMBEDDING_FALLBACK_THRESHOLD
+    if scores is None:
+        scores = lexical_scores(scenarios, user_input)
+        threshold = 0.5
+    ranking = sorted(range(len(scenarios)), key=lambda i: -scores[i])[:EMBEDDING_TOP_K]
+    if scores[ranking[0]] <= 0:
+        return []
+    return [scenarios[i] for i in ranking[:1]] + [scenarios[i] for i in ranking[1:] if scores[i] >= threshold]
+
+def match_scenarios(project_id, user_input):
+    """
+    Matches the user's request with the project's scenarios, trying the embedding
+    fast path first and only calling the LLM for ambiguous cases. When the caller's
+    deadline (X-Deadline-Ms) leaves no time for the LLM, or the LLM call runs out of
+    time, a best-effort match without the LLM is returned instead.
+
+    Args:
+        project_id (str): The project's identifier (e.g. "PRJ15875").
+        user_input (list of str): The user's input request.
+
+    Returns:
+        dict: Same structure as match_scenarios_with_llm, with "matched_by" telling
+        which path produced the answer.
+    """
+    scenarios = get_project_scenarios(project_id)
+    with span("embedding match", scenarios=len(scenarios)) as match_span:
+        matched = match_scenarios_with_embeddings(project_id, scenarios, user_input)
+        match_span.attributes["confident"] = matched is not None
+    if matched is not None:
+        logging.info("Embedding fast path matched scenarios: %s", matched)
+        return {
+            "project_id": project_id,
+            "user_input": user_input,
+            "matched_scenarios": matched,
+            "info": "",
+            "matched_by": "embedding",
+        }
+    left = deadline.remaining()
+    if left is not None and left < LLM_MIN_BUDGET_S:
+        logging.info("%.2fs left before the deadline, matching without the LLM", left)
+        return fallback_result(project_id, scenarios, user_input)
+    try:
+        result = match_scenarios_with_llm(project_id, user_input, scenarios=scenarios)
+    except Exception as e:
+        if not is_deadline_failure(e):
+            raise
+        logging.warning("LLM matching did not finish before the deadline (%s), matching without the LLM", e)
+        return fallback_result(project_id, scenarios, user_input)
+    result["matched_by"] = "llm"
+    return result
+
+def fallback_result(project_id, scenarios, user_input):
+    """Result of match_scenarios_without_llm, in the structure of match_scenarios."""
+    with span("fallback match", scenarios=len(scenarios)):
+        matched = match_scenarios_without_llm(project_id, scenarios, user_input)
+    return {
+        "project_id": project_id,
+        "user_input": user_input,
+        "matched_scenarios": matched,
+        "info": "Matched without the LLM (deadline).",
+        "matched_by": "fallback",
+    }
+
 # --- Main block to run the service ---
 if __name__ == "__main__":
     import uvicorn
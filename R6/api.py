@@ -1,6 +1,13 @@
+import os
 import requests
 from private_information import *
 
+from common import deadline
+from common.tracing import span
+
+# Base URL of the Ai-Raison API (can point to a local stub for offline benchmarks)
+RAISON_API_URL = os.getenv("RAISON_API_URL", "https://api.ai-raison.com")
+
 # API headers
 headers = {
     "x-api-key": api_key
@@ -77,7 +84,8 @@ def get_data_api(url, api_key):
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        with span("rAIson GET", url=url):
+            response = requests.get(url, headers=headers, timeout=deadline.timeout())
         if response.status_code == 200:
             metadata = response.json()
         elif response.status_code == 400:
@@ -98,7 +106,7 @@ def call_api(project_id,scenario):
     Returns:
         list: Valid solutions or None if none.
     """
-    base_url = "https://api.ai-raison.com/executions"
+    base_url = f"{RAISON_API_URL}/executions"
     url = f"{base_url}/{project_id}/latest"
 
     metadata = get_data_api(url, api_key)
@@ -126,7 +134,8 @@ def call_api(project_id,scenario):
 
     try:
         # Send the POST request with the JSON payload
-        response = requests.post(url, headers=headers, json=payload)
+        with span("rAIson POST", url=url, elements=len(ids)):
+            response = requests.post(url, headers=headers, json=payload, timeout=deadline.timeout())
 
         if response.status_code == 200:
             metadata = response.json()
@@ -1,4 +1,7 @@
 #!/bin/bash
 
+# The shared "common" package (tracing, instrumentation) lives at the repository root.
+export PYTHONPATH="$(cd "$(dirname "$0")/.." && pwd):$PYTHONPATH"
+
 echo "[INFO] Starting FastAPI application..."
 uvicorn role6_service:app --host 0.0.0.0 --port 8006 --reload
\ No newline at end of file
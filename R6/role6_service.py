@@ -1,12 +1,24 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 import json
-import requests
+import os
 import re
 from api import *
 import uvicorn
 
+from common import deadline, transport
+from common.deadline import install_deadline, is_deadline_failure
+from common.metrics import install_metrics
+from common.tracing import install_tracing, outgoing_headers, span
+
 app = FastAPI(title="Role 6 - Solving Problems")
+install_tracing(app, "R6")
+install_metrics(app, "R6")
+install_deadline(app)
+
+# Below this many seconds left before the caller's deadline, the solution is returned
+# as the raw rAIson labels instead of being phrased by the LLM.
+LLM_MIN_BUDGET_S = float(os.getenv("R6_LLM_MIN_BUDGET_S", "2"))
 
 # Pydantic models for request/response
 class MatchRequest(BaseModel):
@@ -34,6 +46,9 @@ def match_endpoint(request: MatchRequest):
     print("Result to be sent to user (not sent):", result)
     return MatchResponse(text=result)
 
+# In-process version of the route called by the broker (co-located deployment)
+transport.register_endpoint("R6", "POST", "/find_solution", match_endpoint, MatchRequest)
+
 
 def call_llm(session_id, prompt, host="http://localhost:8000"):
     """
@@ -53,10 +68,12 @@ def call_llm(session_id, prompt, host="http://localhost:8000"):
         "user_message": prompt,
         "max_new_tokens": 200,
         "temperature": 0.7,
-        "repetition_penalty": 1.1
+        "repetition_penalty": 1.1,
+        "priority": "bulk",  # long explanation, must not delay the short prompts of R4 and R5
     }
 
-    resp = requests.post(url, json=payload)
+    with span("R1 /generate", session_id=session_id):
+        resp = transport.post("R1", url, json=payload, headers=outgoing_headers())
     resp.raise_for_status()
 
     data = resp.json()
@@ -100,15 +117,37 @@ def build_prompt(options, user_input):
     
     return full_prompt
 
+def format_raw_solution(options):
+    """
+    Phrases the solution without the LLM, when the caller's deadline leaves no time for it.
+
+    Args:
+        options (list of str): Labels of the options rAIson selected.
+
+    Returns:
+        str: The labels as a bullet list.
+    """
+    return "Here is what we can offer for your request:\n" + "\n".join(f"- {o}" for o in options)
+
 def find_solution_llm(project_id, matched_scenarios, user_input):
 
     solution = call_api(project_id, matched_scenarios)
     print(f"{solution=}")
     if solution is None:
         return "Sorry. We cannot handle your request."
+    left = deadline.remaining()
+    if left is not None and left < LLM_MIN_BUDGET_S:
+        print(f"[INFO] {left:.2f}s left before the deadline, returning the raw solution")
+        return format_raw_solution(solution)
     prompt = build_prompt(solution, user_input) 
     print(f"PROMPT {prompt}")
-    llm_output = call_llm(session_id="explain_solutions_session", prompt=prompt)
+    try:
+        llm_output = call_llm(session_id="explain_solutions_session", prompt=prompt)
+    except Exception as e:
+        if not is_deadline_failure(e):
+            raise
+        print(f"[INFO] LLM phrasing did not finish before the deadline ({e}), returning the raw solution")
+        return format_raw_solution(solution)
 
     return llm_output
 
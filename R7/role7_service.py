@@ -3,6 +3,8 @@ from pydantic import BaseModel
 import requests
 import json
 
+from common.metrics import install_metrics
+
 #  Vérification de la clé API
 try:
     from config import api_key
@@ -10,6 +12,7 @@ except ImportError:
     raise RuntimeError(" ERREUR : Impossible de charger `config.py`. Vérifie que ce fichier existe et contient ta clé API.")
 
 app = FastAPI(title="Role 7 - Argumentation Agent Initialization")
+install_metrics(app, "R7")
 
 #  Modèle pour recevoir une requête
 class InitRequest(BaseModel):
@@ -2,8 +2,11 @@ from fastapi import FastAPI, HTTPException
 import requests
 from pydantic import BaseModel
 
+from common.metrics import install_metrics
+
 # Initialisation de l'application FastAPI
 app = FastAPI(title="Role 8 - Argumentation Agent")
+install_metrics(app, "R8")
 
 # Définition des URLs des autres services
 ROLE5_API_URL = "http://localhost:8005/match"
@@ -6,11 +6,14 @@ from api import fetch_advertisements
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 
+from common.metrics import install_metrics
+
 # Configuration des logs
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
+install_metrics(app, "R9")
 
 # Modèle Pydantic pour la structure des données reçues
 class UserRequest(BaseModel):
@@ -0,0 +1,3 @@
+"""
+Offline load generation and latency benchmarks for the agent pipeline.
+"""
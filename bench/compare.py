@@ -0,0 +1,80 @@
+"""
+Compare two benchmark reports written by `pipeline_bench.py`.
+
+Prints the p50/p95/p99 change of every state, turn kind and hop present in both
+reports, and exits with status 1 if any p95 got worse by more than the allowed
+percentage (useful to catch regressions in CI).
+
+Usage:
+    python -m bench.compare baseline.json candidate.json --fail-above 10
+"""
+import argparse
+import json
+import sys
+
+SECTIONS = ("latency_overall", "latency_by_state", "latency_by_kind", "latency_by_hop")
+QUANTILES = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def relative_change(old, new):
+    if old is None or new is None or old == 0:
+        return None
+    return 100.0 * (new - old) / old
+
+
+def compare_reports(baseline, candidate):
+    """
+    Returns:
+    - list of tuple: (section, key, quantile, baseline ms, candidate ms, change in %)
+    """
+    rows = []
+    for section in SECTIONS:
+        old_section = baseline.get(section, {})
+        new_section = candidate.get(section, {})
+        if section == "latency_overall":
+            old_section, new_section = {"all": old_section}, {"all": new_section}
+        for key in sorted(set(old_section) & set(new_section)):
+            old_stats, new_stats = old_section[key], new_section[key]
+            if not old_stats.get("count") or not new_stats.get("count"):
+                continue
+            for quantile in QUANTILES:
+                old, new = old_stats[quantile], new_stats[quantile]
+                rows.append((section, key, quantile, old, new, relative_change(old, new)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two pipeline benchmark reports.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--fail-above", type=float, default=None,
+                        help="Exit with status 1 if a p95 regresses by more than this percentage.")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    rows = compare_reports(baseline, candidate)
+    regressions = []
+    for section, key, quantile, old, new, change in rows:
+        change_str = "   n/a" if change is None else f"{change:+6.1f}%"
+        print(f"{section:<17} {key:<55} {quantile:<7} {old:9.1f}ms -> {new:9.1f}ms {change_str}")
+        if args.fail_above is not None and quantile == "p95_ms" and change is not None and change > args.fail_above:
+            regressions.append((section, key, change))
+
+    old_tp = baseline.get("throughput_turns_per_s")
+    new_tp = candidate.get("throughput_turns_per_s")
+    if old_tp and new_tp:
+        print(f"\nthroughput {old_tp:.2f} -> {new_tp:.2f} turns/s ({relative_change(old_tp, new_tp):+.1f}%)")
+
+    if regressions:
+        print(f"\n[ERROR] {len(regressions)} p95 regression(s) above {args.fail_above}%:")
+        for section, key, change in regressions:
+            print(f"  {section} {key}: {change:+.1f}%")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
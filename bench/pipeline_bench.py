@@ -0,0 +1,221 @@
+"""
+Load generator and latency benchmark for the broker's /pipeline endpoint.
+
+Replays scripted multi-turn sessions (see `sessions.py`) at a configurable concurrency
+and session arrival rate, then reports p50/p95/p99 latencies per final pipeline state,
+per turn kind and per downstream hop (from the broker's X-Pipeline-Timings header),
+along with the throughput. Results are stored as JSON so that runs can be compared
+with `bench/compare.py`.
+
+Usage (from the repository root, with the pipeline running against the stubs):
+    python -m bench.pipeline_bench --sessions 200 --concurrency 16 --arrival-rate 4 --output results.json
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from .sessions import SESSION_TEMPLATES, build_sessions
+
+DEFAULT_PIPELINE_URL = "http://localhost:8010/pipeline"
+
+
+def percentile(values, q):
+    """Linear-interpolated percentile of `values` (q between 0 and 100)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100.0
+    low = math.floor(position)
+    high = math.ceil(position)
+    if low == high:
+        return ordered[low]
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(values):
+    """Latency statistics (in milliseconds) of a list of durations in seconds."""
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": 1000 * sum(values) / len(values),
+        "p50_ms": 1000 * percentile(values, 50),
+        "p95_ms": 1000 * percentile(values, 95),
+        "p99_ms": 1000 * percentile(values, 99),
+        "max_ms": 1000 * max(values),
+    }
+
+
+def run_session(url, session, timeout, scheduled_at):
+    """
+    Play every turn of a session in order and record what happened.
+
+    Returns:
+    - list of dict: one record per turn.
+    """
+    records = []
+    http = requests.Session()
+    for index, (kind, text) in enumerate(session["turns"]):
+        record = {
+            "session_id": session["session_id"],
+            "template": session["template"],
+            "turn": index,
+            "kind": kind,
+            "status": None,
+            "hops": [],
+            "error": None,
+        }
+        if index == 0:
+            record["queue_delay_s"] = time.perf_counter() - scheduled_at
+        start = time.perf_counter()
+        try:
+            response = http.post(
+                url,
+                json={"session_id": session["session_id"], "user_input": text},
+                timeout=timeout,
+            )
+            record["latency_s"] = time.perf_counter() - start
+            response.raise_for_status()
+            record["status"] = response.headers.get("X-Pipeline-Status")
+            record["trace_id"] = response.headers.get("X-Trace-Id")
+            record["hops"] = json.loads(response.headers.get("X-Pipeline-Timings", "[]"))
+        except Exception as e:
+            record.setdefault("latency_s", time.perf_counter() - start)
+            record["error"] = str(e)
+        records.append(record)
+        if record["error"] is not None:
+            # The broker's session state is unknown after a failure, stop this session.
+            break
+    return records
+
+
+def run_benchmark(url, sessions, concurrency, arrival_rate, timeout, seed=0):
+    """
+    Replay the sessions against the pipeline.
+
+    Parameters:
+    - url (str): URL of the /pipeline endpoint.
+    - sessions (list of dict): Sessions built by `build_sessions`.
+    - concurrency (int): Maximum number of sessions in flight.
+    - arrival_rate (float): Mean session arrivals per second (Poisson process);
+      0 starts every session immediately (closed loop, bounded by the concurrency).
+    - timeout (float): Per-request timeout in seconds.
+
+    Returns:
+    - tuple: (list of turn records, wall-clock duration in seconds)
+    """
+    rng = random.Random(seed)
+    records = []
+    lock = threading.Lock()
+
+    def task(session, scheduled_at):
+        session_records = run_session(url, session, timeout, scheduled_at)
+        with lock:
+            records.extend(session_records)
+
+    start = time.perf_counter()
+    next_arrival = start
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for session in sessions:
+            if arrival_rate > 0:
+                next_arrival += rng.expovariate(arrival_rate)
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            executor.submit(task, session, time.perf_counter())
+    duration = time.perf_counter() - start
+    return records, duration
+
+
+def build_report(records, duration, config):
+    """Aggregate the turn records into the JSON report."""
+    ok = [r for r in records if r["error"] is None]
+    by_state, by_kind, by_hop = {}, {}, {}
+    for record in ok:
+        by_state.setdefault(record["status"] or "unknown", []).append(record["latency_s"])
+        by_kind.setdefault(record["kind"], []).append(record["latency_s"])
+        for hop, seconds in record["hops"]:
+            by_hop.setdefault(hop, []).append(seconds)
+    queue_delays = [r["queue_delay_s"] for r in records if "queue_delay_s" in r]
+
+    return {
+        "config": config,
+        "duration_s": duration,
+        "turns": len(records),
+        "errors": len(records) - len(ok),
+        "sessions": len({r["session_id"] for r in records}),
+        "throughput_turns_per_s": len(ok) / duration if duration > 0 else None,
+        "latency_overall": summarize([r["latency_s"] for r in ok]),
+        "latency_by_state": {key: summarize(values) for key, values in sorted(by_state.items())},
+        "latency_by_kind": {key: summarize(values) for key, values in sorted(by_kind.items())},
+        "latency_by_hop": {key: summarize(values) for key, values in sorted(by_hop.items())},
+        "session_queue_delay": summarize(queue_delays),
+        "error_samples": [r["error"] for r in records if r["error"] is not None][:10],
+    }
+
+
+def print_report(report):
+    print(
+        f"[INFO] {report['turns']} turns ({report['errors']} errors) in {report['duration_s']:.1f}s, "
+        f"throughput {report['throughput_turns_per_s'] or 0:.2f} turns/s"
+    )
+    for section in ("latency_overall", "latency_by_state", "latency_by_kind", "latency_by_hop"):
+        stats = report[section]
+        rows = {"all": stats} if section == "latency_overall" else stats
+        print(f"\n{section}")
+        for key, row in rows.items():
+            if row["count"] == 0:
+                continue
+            print(
+                f"  {key:<55} n={row['count']:<5} p50={row['p50_ms']:8.1f}ms "
+                f"p95={row['p95_ms']:8.1f}ms p99={row['p99_ms']:8.1f}ms"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay multi-turn sessions against /pipeline.")
+    parser.add_argument("--url", default=DEFAULT_PIPELINE_URL)
+    parser.add_argument("--sessions", type=int, default=50, help="Number of sessions to replay.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum sessions in flight.")
+    parser.add_argument("--arrival-rate", type=float, default=0.0,
+                        help="Mean session arrivals per second (0: closed loop).")
+    parser.add_argument("--templates", nargs="*", choices=list(SESSION_TEMPLATES), default=None)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default="", help="Free-form label stored in the report.")
+    parser.add_argument("--output", default=None, help="Where to write the JSON report.")
+    parser.add_argument("--keep-raw", action="store_true", help="Store every turn record in the report.")
+    args = parser.parse_args()
+
+    sessions = build_sessions(args.sessions, seed=args.seed, templates=args.templates)
+    config = {
+        "url": args.url,
+        "sessions": args.sessions,
+        "concurrency": args.concurrency,
+        "arrival_rate": args.arrival_rate,
+        "templates": args.templates or list(SESSION_TEMPLATES),
+        "seed": args.seed,
+        "label": args.label,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    records, duration = run_benchmark(
+        args.url, sessions, args.concurrency, args.arrival_rate, args.timeout, seed=args.seed
+    )
+    report = build_report(records, duration, config)
+    if args.keep_raw:
+        report["raw"] = records
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[INFO] Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/bin/bash
+# Starts the stub R1/rAIson services and the real R2, R4, R5, R6 and R10 agents wired
+# to them, runs the pipeline benchmark, then stops everything.
+# Extra arguments are passed to bench.pipeline_bench, e.g.:
+#   bash bench/run_offline.sh --sessions 200 --concurrency 16 --output results.json
+
+ROOT="$(cd "$(dirname "$0")/.." && pwd)"
+LOG_DIR="${BENCH_LOG_DIR:-$ROOT/bench/logs}"
+mkdir -p "$LOG_DIR"
+
+export RAISON_API_URL="http://localhost:8020"
+export PYTHONPATH="$ROOT:$PYTHONPATH"
+export AOSE_TRACE_FILE="${AOSE_TRACE_FILE:-$LOG_DIR/traces.jsonl}"
+export DATABASE_URL="${BENCH_DATABASE_URL:-sqlite:///$LOG_DIR/bench.db}"
+
+PIDS=()
+cleanup() {
+    echo "[INFO] Stopping services..."
+    kill "${PIDS[@]}" 2>/dev/null
+    wait 2>/dev/null
+}
+trap cleanup EXIT
+
+start() {
+    local name="$1"; local dir="$2"; shift 2
+    echo "[INFO] Starting $name..."
+    (cd "$dir" && exec "$@") > "$LOG_DIR/$name.log" 2>&1 &
+    PIDS+=($!)
+}
+
+wait_for() {
+    local name="$1"; local port="$2"
+    for _ in $(seq 1 600); do
+        if curl -s -o /dev/null "http://localhost:$port/docs"; then
+            echo "[INFO] $name is up on port $port."
+            return 0
+        fi
+        sleep 1
+    done
+    echo "[ERROR] $name did not start, see $LOG_DIR/$name.log"
+    exit 1
+}
+
+if [ "$BENCH_R1" = "simulated" ] && [ "${BENCH_R1_REPLICAS:-1}" -gt 1 ]; then
+    # Several simulated R1 workers (ports 8100...) behind the replica router on port 8000.
+    start stub_r1 "$ROOT/R1" python3 -m app.router --spawn "$BENCH_R1_REPLICAS" --backend simulated --port 8000
+    for i in $(seq 0 $((BENCH_R1_REPLICAS - 1))); do
+        wait_for "R1 worker $i" $((8100 + i))
+    done
+elif [ "$BENCH_R1" = "simulated" ]; then
+    # Real R1 service (sessions, prompts, database) with the simulated generation backend.
+    start stub_r1 "$ROOT/R1" env R1_BACKEND=simulated uvicorn app.main:app --host 0.0.0.0 --port 8000
+else
+    # Answers as the simulated backend of R1 (imported from R1/app).
+    start stub_r1 "$ROOT" env PYTHONPATH="$ROOT/R1:$PYTHONPATH" python3 -m bench.stub_services r1 --port 8000 ${BENCH_R1_ARGS}
+fi
+start stub_raison "$ROOT" python3 -m bench.stub_services raison --port 8020 ${BENCH_RAISON_ARGS}
+wait_for stub_r1 8000
+wait_for stub_raison 8020
+
+if [ "$BENCH_MODE" = "colocated" ]; then
+    # R2, R4, R5, R6 and R10 in one process, calling each other in-process.
+    start colocated "$ROOT" python3 colocated.py --port 8010
+    wait_for colocated 8010
+else
+    start R2 "$ROOT/R2" python3 -m src.role2_service
+    start R4 "$ROOT/R4" python3 role4_service.py
+    start R5 "$ROOT/R5" uvicorn role5_service:app --host 0.0.0.0 --port 8005
+    start R6 "$ROOT/R6" uvicorn role6_service:app --host 0.0.0.0 --port 8006
+    wait_for R2 8002
+    wait_for R4 8004
+    wait_for R5 8005
+    wait_for R6 8006
+
+    start R10 "$ROOT/R10" python3 broker_middleware.py
+    wait_for R10 8010
+fi
+
+cd "$ROOT" && python3 -m bench.pipeline_bench "$@"
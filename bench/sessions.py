@@ -0,0 +1,80 @@
+"""
+Scripted multi-turn sessions replayed against the broker's /pipeline endpoint.
+
+Each turn has a kind that tells which branch of the broker pipeline it is meant to
+exercise:
+- "casual": R4 classifies it as small talk, R1 answers.
+- "query": R4 classifies it as a service request, R2 picks a project, the broker answers with an ad.
+- "follow_up": sent right after a query, goes through R5 (scenario matching) and R6 (rAIson + R1).
+
+The texts are written so that the stub R1 classifier (see `SERVICE_KEYWORDS` in R1/app/backends/simulated.py)
+puts them in the intended branch.
+"""
+import random
+
+CASUAL_TURNS = [
+    "Hello, how are you today?",
+    "Thanks a lot, have a nice day!",
+    "What is your name?",
+    "Nice weather today, isn't it?",
+    "Can you tell me a joke about cats?",
+    "I just came back from holidays, it was lovely.",
+]
+
+QUERY_TURNS = [
+    "Hello, I have a problem with my product, I need an intelligent customer service chatbot designed "
+    "to handle order tracking, returns, refunds, and claims. This is a service request.",
+    "I have a problem with a leave request, my manager refused my holidays. This is a service request.",
+    "There is a conflict with a seller on a compute-for-hire platform, I need a fair price. This is a service request.",
+    "I need to be reimbursed for my transportation tickets. This is a service request.",
+    "A message in my live chat stream contains insults and I need a moderation service. This is a service request.",
+]
+
+FOLLOW_UP_TURNS = [
+    "I have a repair request. Indeed, I'd like to have my computer repaired. The product is under warranty.",
+    "I would like a refund. I have a proof of purchase and the deadline is not exceeded.",
+    "The product arrived broken. I want a replacement, the item is in stock.",
+    "My claim was rejected but I sent the proof of purchase before the deadline.",
+]
+
+# Session templates: the sequence of turn kinds of a session, and their relative weight.
+SESSION_TEMPLATES = {
+    "casual_only"      : (["casual", "casual"], 0.3),
+    "query"            : (["casual", "query", "follow_up"], 0.4),
+    "query_then_chat"  : (["query", "follow_up", "casual"], 0.2),
+    "double_query"     : (["query", "follow_up", "query", "follow_up"], 0.1),
+}
+
+TURN_TEXTS = {
+    "casual"    : CASUAL_TURNS,
+    "query"     : QUERY_TURNS,
+    "follow_up" : FOLLOW_UP_TURNS,
+}
+
+
+def build_sessions(count, seed=0, templates=None):
+    """
+    Draw `count` sessions from the weighted templates.
+
+    Parameters:
+    - count (int): Number of sessions to generate.
+    - seed (int): Seed of the random generator, so that runs are comparable.
+    - templates (list of str or None): Restrict the draw to these template names.
+
+    Returns:
+    - list of dict: [{"session_id", "template", "turns": [(kind, text), ...]}, ...]
+    """
+    rng = random.Random(seed)
+    names = templates or list(SESSION_TEMPLATES)
+    weights = [SESSION_TEMPLATES[name][1] for name in names]
+    sessions = []
+    for index in range(count):
+        name = rng.choices(names, weights=weights)[0]
+        kinds = SESSION_TEMPLATES[name][0]
+        turns = [(kind, rng.choice(TURN_TEXTS[kind])) for kind in kinds]
+        sessions.append({
+            "session_id": f"bench-{seed}-{index}",
+            "template": name,
+            "turns": turns,
+        })
+    return sessions
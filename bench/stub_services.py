@@ -0,0 +1,133 @@
+"""
+Stub R1 (LLM) and rAIson services, so that the pipeline can be load tested fully offline.
+
+The stubs answer with the same shapes as the real services and with schema-correct
+contents for the R4 (classification), R5 (scenario matching) and R6 (explanation)
+prompts. The R1 stub answers as R1's simulated backend does (it reuses its answers,
+see R1/app/backends/simulated.py, so R1/ must be on the path), only without R1's
+sessions and prompt handling. Their latency is configurable, so that the cost of the
+broker, matchers and databases can be measured on their own.
+
+Usage (from the repository root):
+    PYTHONPATH=R1 python -m bench.stub_services r1 --port 8000 --base-ms 20 --per-token-ms 2
+    python -m bench.stub_services raison --port 8020 --base-ms 30
+"""
+import argparse
+import hashlib
+import json
+import time
+
+import uvicorn
+from fastapi import Body, FastAPI
+
+# Project ids queried by R2, R5 and R6 (see R2/src/project_data.py).
+STUB_PROJECT_IDS = [
+    "PRJ17225", "PRJ15875", "PRJ16725", "PRJ17575",
+    "PRJ17775", "PRJ15425", "PRJ12375", "PRJ17525",
+]
+STUB_ELEMENTS = [
+    "refund request",
+    "repair request",
+    "replacement request",
+    "product under warranty",
+    "proof of purchase provided",
+    "deadline exceeded",
+    "item in stock",
+]
+STUB_OPTIONS = ["refund", "repair", "replacement", "rejection"]
+
+
+def simulated_delay(base_ms, per_token_ms, tokens):
+    time.sleep((base_ms + per_token_ms * tokens) / 1000.0)
+
+
+# ---------------------------
+# Stub R1
+# ---------------------------
+def create_r1_app(base_ms=20.0, per_token_ms=2.0):
+    # Only the R1 stub needs R1/ on the path.
+    from app.backends.simulated import answer_prompt, pick_choices
+
+    app = FastAPI(title="Stub R1 LLM Service")
+
+    def answer(user_message, output_schema):
+        if output_schema is not None:
+            # R5 scenario matching: answer exactly in the requested structure.
+            properties = output_schema.get("properties")
+            array_schema = next(iter(properties.values())) if properties else output_schema
+            choices = array_schema.get("items", {}).get("enum", [])
+            matched = pick_choices(choices, user_message, array_schema.get("maxItems", len(choices)))
+            if properties:
+                return json.dumps({next(iter(properties)): matched})
+            return json.dumps(matched)
+        # R4 classification, R6 explanation of rAIson solutions, chat.
+        return answer_prompt(user_message)
+
+    @app.get("/health")
+    def health_check():
+        return {"status": "OK"}
+
+    @app.post("/generate")
+    def generate_text(
+        session_id: str = Body(...),
+        user_message: str = Body(...),
+        max_new_tokens: int = Body(200),
+        temperature: float = Body(0.7),
+        repetition_penalty: float = Body(1.1),
+        output_schema: dict | None = Body(None),
+    ):
+        response_text = answer(user_message, output_schema)
+        tokens = min(len(response_text.split()), max_new_tokens)
+        simulated_delay(base_ms, per_token_ms, tokens)
+        return {"response": response_text, "session_id": session_id}
+
+    return app
+
+
+# ---------------------------
+# Stub rAIson
+# ---------------------------
+def create_raison_app(base_ms=30.0):
+    app = FastAPI(title="Stub rAIson API")
+    elements = [{"id": f"E{index}", "label": label} for index, label in enumerate(STUB_ELEMENTS)]
+    options = [{"id": f"O{index}", "label": label} for index, label in enumerate(STUB_OPTIONS)]
+
+    @app.get("/executions/{project_id}/latest")
+    def get_project(project_id: str):
+        simulated_delay(base_ms, 0, 0)
+        return {"id": project_id, "elements": elements, "options": options}
+
+    @app.post("/executions/{project_id}/latest")
+    def run_project(project_id: str, payload: dict = Body(...)):
+        simulated_delay(base_ms, 0, 0)
+        element_ids = sorted(e["id"] for e in payload.get("elements", []))
+        digest = hashlib.sha1(f"{project_id}:{element_ids}".encode()).digest()
+        solution_index = digest[0] % len(options)
+        return [
+            {"option": option, "isSolution": index == solution_index}
+            for index, option in enumerate(options)
+        ]
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stub R1 or rAIson service.")
+    parser.add_argument("service", choices=["r1", "raison"])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--base-ms", type=float, default=None, help="Fixed latency per request.")
+    parser.add_argument("--per-token-ms", type=float, default=2.0, help="R1 only: latency per generated token.")
+    args = parser.parse_args()
+
+    if args.service == "r1":
+        app = create_r1_app(20.0 if args.base_ms is None else args.base_ms, args.per_token_ms)
+        port = args.port or 8000
+    else:
+        app = create_raison_app(30.0 if args.base_ms is None else args.base_ms)
+        port = args.port or 8020
+    uvicorn.run(app, host=args.host, port=port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Co-located deployment: serve the R2, R4, R5, R6 and R10 agents (and optionally R1)
+from a single process.
+
+The agents keep their HTTP APIs (R10 at the root, the others under /R2, /R4, ...),
+but the calls they make to each other go through the in-process transport of
+`common/transport.py`: the broker's `call_R*` helpers and the agents' R1 helpers
+call the endpoint functions directly instead of going through localhost sockets.
+For a small installation this removes most of the non-LLM latency of a turn, and
+the memory of one Python interpreter per agent.
+
+Without --with-r1, R1 is still reached over HTTP at http://localhost:8000 (the usual
+setup when the LLM runs on its own GPU host).
+
+Usage (from the repository root):
+    python3 colocated.py --port 8010
+    python3 colocated.py --with-r1      # R1 in the same process too
+"""
+import argparse
+import importlib
+import os
+import sys
+
+import uvicorn
+from fastapi import FastAPI
+
+from common import transport
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (service, directory containing its code, module defining its FastAPI app)
+SERVICES = [
+    ("R2", "R2", "src.role2_service"),
+    ("R4", "R4", "role4_service"),
+    ("R5", "R5", "role5_service"),
+    ("R6", "R6", "role6_service"),
+    ("R10", "R10", "broker_middleware"),
+]
+R1_SERVICE = ("R1", "R1", "app.main")
+
+
+def load_services(with_r1=False):
+    """
+    Import the agents' modules (each one registers its in-process handlers on import).
+
+    Returns:
+    - dict: {service name: module}
+    """
+    transport.set_mode("local")
+    services = ([R1_SERVICE] if with_r1 else []) + SERVICES
+    modules = {}
+    for name, directory, module_name in services:
+        sys.path.insert(0, os.path.join(ROOT, directory))
+        modules[name] = importlib.import_module(module_name)
+    return modules
+
+
+def create_app(with_r1=False):
+    """Build the single FastAPI app serving every co-located agent."""
+    modules = load_services(with_r1)
+    app = FastAPI(title="AOSE co-located agents")
+
+    @app.on_event("startup")
+    def startup():
+        # Mounted apps do not run their own startup code: run it here, in dependency order.
+        modules["R2"].startup()
+        modules["R5"].preload_embedding_model()
+        modules["R10"].startup()
+        if "R1" in modules:
+            modules["R1"].start_background_jobs()
+        print(f"[INFO] Co-located agents ready: {', '.join(modules)}")
+
+    for name, module in modules.items():
+        if name != "R10":
+            app.mount(f"/{name}", module.app)
+    app.mount("/", modules["R10"].app)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve R2, R4, R5, R6 and R10 from one process.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--with-r1", action="store_true", help="Also serve R1 from this process.")
+    args = parser.parse_args()
+    uvicorn.run(create_app(with_r1=args.with_r1), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""
+Code shared by the agent services (tracing, instrumentation).
+
+The services import it as the top-level `common` package: their launch scripts put the
+repository root on PYTHONPATH.
+"""
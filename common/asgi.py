@@ -0,0 +1,31 @@
+"""
+Helpers for the ASGI middlewares of the agent services (tracing.py, metrics.py,
+deadline.py).
+
+The middlewares are plain ASGI callables rather than `@app.middleware("http")`
+functions: those run each request in a task group of their own and wrap its response
+stream, once per layer, which is too much overhead for instrumentation that stays on
+in production. A plain layer only adds a function call, and sees the response through
+the `send` callable it passes down.
+"""
+
+
+def header(scope, name):
+    """Value of the request header `name` (case-insensitive), or None if it is missing."""
+    key = name.lower().encode("latin-1")
+    for header_name, value in scope.get("headers", ()):
+        if header_name == key:
+            return value.decode("latin-1")
+    return None
+
+
+def on_response_start(send, callback):
+    """
+    Wrap `send` so that `callback(message)` is called with the "http.response.start"
+    message (status and headers) before it is sent. The callback may return a new message.
+    """
+    async def wrapped(message):
+        if message["type"] == "http.response.start":
+            message = callback(message) or message
+        await send(message)
+    return wrapped
@@ -0,0 +1,137 @@
+"""
+End-to-end deadlines for the agent pipeline.
+
+The broker gives each /pipeline turn a time budget. The budget travels with every
+call made while handling the turn, in the X-Deadline-Ms header: the number of
+milliseconds left when the request was sent (a duration rather than a timestamp,
+so that the hosts' clocks do not need to agree). Each service turns it back into a
+local deadline, and:
+- `common/transport.py` forwards the remaining budget on every call to another agent
+  and uses it as the call's timeout;
+- the agents check `remaining()` before expensive steps (R1 caps the number of
+  generated tokens, R5 and R6 skip the LLM when it cannot answer in time).
+
+Usage in a service:
+
+    from common.deadline import install_deadline, remaining, deadline
+
+    install_deadline(app)  # read X-Deadline-Ms on incoming requests
+    with deadline(30):     # start a budget (or shrink the current one)
+        if remaining() is not None and remaining() < 2:
+            ...            # too late for the slow path
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .asgi import header
+
+DEADLINE_HEADER = "X-Deadline-Ms"
+
+# time.monotonic() value after which the current request is useless to its caller.
+_deadline = ContextVar("aose_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting a call whose deadline has already passed."""
+    status_code = 504
+
+
+def is_deadline_failure(error):
+    """Whether a failed call to another service failed because the caller's deadline was reached."""
+    import requests  # only the services making outgoing calls need it
+
+    if isinstance(error, (DeadlineExceeded, requests.Timeout)):
+        return True
+    response = getattr(error, "response", None)
+    return isinstance(error, requests.HTTPError) and getattr(response, "status_code", None) == 504
+
+
+def remaining():
+    """Seconds left before the current deadline (at least 0), or None without deadline."""
+    current = _deadline.get()
+    if current is None:
+        return None
+    return max(current - time.monotonic(), 0.0)
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check(what="call"):
+    """Raise DeadlineExceeded if the current deadline has passed."""
+    if expired():
+        raise DeadlineExceeded(f"Deadline exceeded before {what}")
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Run the block with a deadline `seconds` from now, or with the current deadline if
+    it is earlier (a callee never gets more time than its caller). `None` keeps the
+    current deadline.
+    """
+    current = _deadline.get()
+    new = current
+    if seconds is not None:
+        new = time.monotonic() + seconds
+        if current is not None:
+            new = min(new, current)
+    token = _deadline.set(new)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def timeout(default=None):
+    """
+    Timeout for an outgoing call: the time left before the deadline, capped by
+    `default`. Raises DeadlineExceeded if no time is left.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    check()
+    return left if default is None else min(left, default)
+
+
+def outgoing_headers(headers=None):
+    """Return a copy of `headers` with the remaining budget, if there is a deadline."""
+    result = dict(headers or {})
+    left = remaining()
+    if left is not None:
+        result[DEADLINE_HEADER] = str(int(left * 1000))
+    return result
+
+
+def parse_header(value):
+    """Budget in seconds from an X-Deadline-Ms header value (None if missing or invalid)."""
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0) / 1000
+    except ValueError:
+        return None
+
+
+class DeadlineMiddleware:
+    """ASGI middleware running every HTTP request under the deadline sent by its caller."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        budget = parse_header(header(scope, DEADLINE_HEADER)) if scope["type"] == "http" else None
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+        with deadline(budget):
+            await self.app(scope, receive, send)
+
+
+def install_deadline(app):
+    """Run every request of a FastAPI app under the deadline sent by its caller, if any."""
+    app.add_middleware(DeadlineMiddleware)
@@ -0,0 +1,357 @@
+"""
+Low-overhead operational metrics for the agent services, exposed in the Prometheus
+text format on GET /metrics.
+
+Recording a value only takes a dictionary lookup, a bisect and an addition under a
+per-metric lock, so it can stay enabled in production.
+
+Usage in a service:
+
+    from common.metrics import Histogram, install_metrics
+
+    install_metrics(app, "R5")
+    MATCH_SECONDS = Histogram("r5_match_seconds", "Time spent matching scenarios.", ["path"])
+    MATCH_SECONDS.labels(path="llm").observe(0.42)
+
+`install_metrics` records, for every route: the number of requests (by method and
+status code), the requests in flight, and a latency histogram.
+
+A service running in several processes can report the metrics of all of them: each
+process exports its values with `REGISTRY.snapshot()`, and `REGISTRY.set_collector`
+makes /metrics render the snapshots merged with `merge_snapshots` (see R2/src/prefork.py).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from .asgi import on_response_start
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+TOKEN_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500, 1000, 2000, 4000, 8000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def merge_snapshots(snapshots):
+    """
+    Sum the values of several snapshots (see `Registry.snapshot`), e.g. of processes
+    running the same service.
+    """
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif metric["kind"] == "histogram":
+                    counts = [a + b for a, b in zip(current[0], value[0])]
+                    target["values"][key] = [counts, current[1] + value[1], current[2] + value[2]]
+                else:
+                    target["values"][key] = current + value
+    for metric in merged.values():
+        metric["values"] = [[list(key), value] for key, value in metric["values"].items()]
+    return merged
+
+
+def render_snapshot(snapshot):
+    """Prometheus text format of a snapshot."""
+    lines = []
+    for name, metric in snapshot.items():
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        labelnames = metric["labelnames"]
+        for key, value in metric["values"]:
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_format_labels(labelnames, key)} {_format_number(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(metric["buckets"] + [float("inf")], counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(f"{name}_bucket{_format_labels(labelnames, key, le)} {cumulative}")
+            labels = _format_labels(labelnames, key)
+            lines.append(f"{name}_sum{labels} {_format_number(total)}")
+            lines.append(f"{name}_count{labels} {count}")
+    return "\n".join(lines) + "\n"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._collector = None
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def _all(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self):
+        """Values of every metric of this process, as JSON-serializable data."""
+        return {metric.name: metric.snapshot() for metric in self._all()}
+
+    def reset(self):
+        """Set every value back to zero, e.g. in a forked process (its parent reports its own values)."""
+        for metric in self._all():
+            metric.reset()
+
+    def set_collector(self, collector):
+        """Render the snapshot returned by `collector()` instead of the values of this process."""
+        self._collector = collector
+
+    def render(self):
+        snapshot = self._collector() if self._collector is not None else self.snapshot()
+        return render_snapshot(snapshot)
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __new__(cls, name, help_text, labelnames=(), registry=REGISTRY, **kwargs):
+        # Metrics are process-wide: declaring the same name twice (e.g. when several
+        # services share a process) returns the already registered metric.
+        existing = registry._metrics.get(name)
+        if existing is not None:
+            return existing
+        return super().__new__(cls)
+
+    def __init__(self, name, help_text, labelnames=(), registry=REGISTRY):
+        if getattr(self, "_initialized", False):
+            return
+        self._initialized = True
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _default_child(self):
+        return self.labels()
+
+    def snapshot(self):
+        with self._lock:
+            children = list(self._children.items())
+        return {
+            "kind": self.kind,
+            "help": self.help_text,
+            "labelnames": list(self.labelnames),
+            "values": [[list(key), child.snapshot()] for key, child in children],
+        }
+
+    def reset(self):
+        # Children are reset in place: callers may hold them (e.g. `HTTP_IN_FLIGHT.labels(...)`).
+        with self._lock:
+            children = list(self._children.values())
+        for child in children:
+            child.reset()
+
+
+class _Value:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1.0):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def reset(self):
+        self.value = 0.0
+
+    def snapshot(self):
+        return self.value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1.0):
+        self._default_child().inc(amount)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1.0):
+        self._default_child().dec(amount)
+
+    def set(self, value):
+        self._default_child().set(value)
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+    def snapshot(self):
+        with self.lock:
+            return [list(self.counts), self.sum, self.count]
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), registry=REGISTRY, buckets=DEFAULT_LATENCY_BUCKETS):
+        if getattr(self, "_initialized", False):
+            return  # already registered: keep the buckets its values were counted in
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+    def time(self):
+        return self._default_child().time()
+
+    def snapshot(self):
+        result = super().snapshot()
+        result["buckets"] = list(self.buckets)
+        return result
+
+
+# ---------------------------
+# HTTP instrumentation
+# ---------------------------
+UNMATCHED_ROUTE = "<unmatched>"
+
+HTTP_REQUESTS = Counter(
+    "aose_http_requests_total", "HTTP requests handled, by route and status code.",
+    ["service", "route", "method", "status"],
+)
+HTTP_IN_FLIGHT = Gauge(
+    "aose_http_requests_in_flight", "HTTP requests currently being handled.", ["service"],
+)
+HTTP_LATENCY = Histogram(
+    "aose_http_request_duration_seconds", "Time spent handling HTTP requests, by route.",
+    ["service", "route", "method"],
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the count, in-flight requests and latency per route (see `install_metrics`)."""
+
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+        self.in_flight = HTTP_IN_FLIGHT.labels(service=service)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        def record_status(message):
+            nonlocal status
+            status = message["status"]
+
+        self.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, on_response_start(send, record_status))
+        finally:
+            elapsed = time.perf_counter() - start
+            self.in_flight.dec()
+            # Unmatched paths (404s, scanners) share one label, to keep the number of series bounded.
+            route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            method = scope["method"]
+            HTTP_REQUESTS.labels(service=self.service, route=route, method=method, status=status).inc()
+            HTTP_LATENCY.labels(service=self.service, route=route, method=method).observe(elapsed)
+
+
+def install_metrics(app, service):
+    """
+    Record request count, in-flight requests and latency per route for a FastAPI app,
+    and expose every metric of the process on GET /metrics.
+    """
+    from fastapi.responses import PlainTextResponse
+
+    app.add_middleware(MetricsMiddleware, service=service)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics_endpoint():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,204 @@
+"""
+Lightweight distributed tracing for the agent services.
+
+A trace id is attached to every /pipeline turn and propagated to downstream agents
+through the X-Trace-Id and X-Parent-Span-Id headers. Each service records spans
+(name, start, duration, parent) for the requests it serves and the calls it makes:
+- in memory, exposed on GET /traces and GET /traces/{trace_id};
+- optionally appended as JSON lines to the collector file named by AOSE_TRACE_FILE
+  (all services can share the same file).
+
+`trace_viewer.py` at the repository root rebuilds each turn's span tree and its
+critical path from those files or endpoints.
+
+Usage in a service:
+
+    from common.tracing import install_tracing, span, outgoing_headers
+
+    install_tracing(app, "R5")
+    with span("R1 /generate"):
+        requests.post(url, json=payload, headers=outgoing_headers())
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import wraps
+
+from .asgi import header, on_response_start
+
+TRACE_HEADER = "X-Trace-Id"
+PARENT_SPAN_HEADER = "X-Parent-Span-Id"
+
+# (trace_id, span_id) of the span currently open in this context.
+_current_span = ContextVar("aose_current_span", default=None)
+# Name of the service handling the current request (several services may share a process).
+_current_service = ContextVar("aose_current_service", default=None)
+
+
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+
+@dataclass
+class Span:
+    trace_id: str
+    span_id: str
+    parent_id: str | None
+    service: str
+    name: str
+    start: float  # unix time, seconds
+    duration_ms: float = 0.0
+    error: str | None = None
+    attributes: dict = field(default_factory=dict)
+
+
+class TraceCollector:
+    """
+    Keeps the spans of the most recent traces in memory and, if a path is given,
+    appends every finished span to a JSON-lines file.
+    """
+
+    def __init__(self, max_traces=1000, path=None):
+        self.max_traces = max_traces
+        self.path = path
+        self._traces = OrderedDict()  # {trace_id: [span dict, ...]}
+        self._lock = threading.Lock()
+
+    def record(self, span_obj):
+        data = asdict(span_obj)
+        with self._lock:
+            spans = self._traces.get(span_obj.trace_id)
+            if spans is None:
+                spans = self._traces[span_obj.trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            spans.append(data)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(data) + "\n")
+
+    def get_trace(self, trace_id):
+        with self._lock:
+            return list(self._traces.get(trace_id, []))
+
+    def recent_trace_ids(self, limit=50):
+        with self._lock:
+            return list(self._traces)[-limit:][::-1]
+
+
+COLLECTOR = TraceCollector(path=os.getenv("AOSE_TRACE_FILE"))
+SERVICE_NAME = os.getenv("AOSE_SERVICE_NAME", "unknown")
+
+
+def current_trace_id():
+    current = _current_span.get()
+    return current[0] if current else None
+
+
+@contextmanager
+def span(name, service=None, trace_id=None, parent_id=None, **attributes):
+    """
+    Open a span as a child of the current one (or of the given trace/parent ids, or as
+    the root of a new trace). Yields the `Span`, whose attributes can be completed
+    before it closes.
+    """
+    current = _current_span.get()
+    if trace_id is None:
+        trace_id = current[0] if current else new_id()
+        if parent_id is None and current:
+            parent_id = current[1]
+    span_obj = Span(
+        trace_id=trace_id,
+        span_id=new_id(),
+        parent_id=parent_id,
+        service=service or _current_service.get() or SERVICE_NAME,
+        name=name,
+        start=time.time(),
+        attributes=dict(attributes),
+    )
+    token = _current_span.set((trace_id, span_obj.span_id))
+    started = time.perf_counter()
+    try:
+        yield span_obj
+    except BaseException as e:
+        span_obj.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span_obj.duration_ms = 1000 * (time.perf_counter() - started)
+        _current_span.reset(token)
+        COLLECTOR.record(span_obj)
+
+
+def traced(name):
+    """Decorator version of `span`."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def outgoing_headers(headers=None):
+    """
+    Return a copy of `headers` with the trace headers of the current span, to be sent
+    along with a request to another agent.
+    """
+    result = dict(headers or {})
+    current = _current_span.get()
+    if current:
+        result[TRACE_HEADER] = current[0]
+        result[PARENT_SPAN_HEADER] = current[1]
+    return result
+
+
+class TracingMiddleware:
+    """ASGI middleware recording a server span for every HTTP request (see `install_tracing`)."""
+
+    def __init__(self, app, service):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/traces"):
+            await self.app(scope, receive, send)
+            return
+        _current_service.set(self.service)
+        with span(
+            f"{scope['method']} {scope['path']}",
+            service=self.service,
+            trace_id=header(scope, TRACE_HEADER),
+            parent_id=header(scope, PARENT_SPAN_HEADER),
+        ) as server_span:
+            def add_trace_header(message):
+                server_span.attributes["status_code"] = message["status"]
+                trace_header = (TRACE_HEADER.lower().encode("latin-1"), server_span.trace_id.encode("latin-1"))
+                return {**message, "headers": [*message.get("headers", ()), trace_header]}
+
+            await self.app(scope, receive, on_response_start(send, add_trace_header))
+
+
+def install_tracing(app, service):
+    """
+    Record a server span for every request handled by a FastAPI app (continuing the
+    caller's trace when the headers are present), return the trace id in the
+    X-Trace-Id response header, and expose the recorded spans on /traces.
+    """
+    global SERVICE_NAME
+    SERVICE_NAME = service
+    app.add_middleware(TracingMiddleware, service=service)
+
+    @app.get("/traces", include_in_schema=False)
+    def list_traces(limit: int = 50):
+        return COLLECTOR.recent_trace_ids(limit)
+
+    @app.get("/traces/{trace_id}", include_in_schema=False)
+    def get_trace(trace_id: str):
+        return COLLECTOR.get_trace(trace_id)
@@ -0,0 +1,178 @@
+"""
+Transport used by the agents to call each other.
+
+In the default "http" mode every call goes through `requests`, as when each agent
+runs in its own process. In the "local" mode (AOSE_TRANSPORT=local, set by the
+co-located launcher `colocated.py`), a call to an agent that registered a local
+handler for the route is dispatched as a direct function call in the same process:
+no socket, no JSON (de)serialization. Calls to routes without a local handler (e.g.
+R1 when it runs on its own GPU host) still go over HTTP.
+
+Both transports carry the deadline of the current request (see `common/deadline.py`):
+over HTTP as the X-Deadline-Ms header and the call's timeout, in-process through the
+context. A call is not started once the deadline has passed.
+
+Usage in a service:
+
+    from common import transport
+
+    # callee: make an endpoint callable in-process
+    transport.register_endpoint("R5", "POST", "/match", match_endpoint, MatchRequest)
+
+    # caller: same interface as `requests`
+    response = transport.post("R5", "http://localhost:8005/match", json=body, headers=headers)
+    response.raise_for_status()
+    data = response.json()
+"""
+import json
+import logging
+import os
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from . import deadline
+from .metrics import Histogram
+from .tracing import _current_service, span
+
+TRANSPORT_MODES = ("http", "local")
+
+_mode = os.getenv("AOSE_TRANSPORT", "http")
+if _mode not in TRANSPORT_MODES:
+    raise ValueError(f"AOSE_TRANSPORT must be one of {TRANSPORT_MODES}, got {_mode!r}")
+
+_local_handlers = {}  # {(service, method, path): handler}
+
+CALL_SECONDS = Histogram(
+    "aose_transport_call_seconds", "Duration of calls between agents, by transport.",
+    ["service", "path", "transport"],
+)
+
+logger = logging.getLogger(__name__)
+
+
+def get_mode():
+    return _mode
+
+
+def set_mode(mode):
+    """Select the transport for the whole process ("http" or "local")."""
+    global _mode
+    if mode not in TRANSPORT_MODES:
+        raise ValueError(f"transport mode must be one of {TRANSPORT_MODES}, got {mode!r}")
+    _mode = mode
+
+
+def register_local(service, method, path, handler):
+    """
+    Register `handler(data)` as the in-process implementation of `method path` on
+    `service`. `data` is the JSON body (POST) or the query parameters (GET) as a dict;
+    the handler returns what the endpoint would return.
+    """
+    _local_handlers[(service, method.upper(), path)] = handler
+
+
+def register_endpoint(service, method, path, endpoint, model=None):
+    """
+    Register a FastAPI endpoint function taking a single Pydantic body (`model`), or no
+    argument at all, as the local handler of its route.
+    """
+    if model is None:
+        register_local(service, method, path, lambda data: endpoint())
+    else:
+        register_local(service, method, path, lambda data: endpoint(_validate(model, data)))
+
+
+class LocalValidationError(Exception):
+    pass
+
+
+def _validate(model, data):
+    try:
+        return model(**data)
+    except Exception as e:
+        raise LocalValidationError(str(e)) from e
+
+
+class LocalResponse:
+    """The subset of `requests.Response` used by the agents, for in-process calls."""
+
+    def __init__(self, status_code, data, url):
+        self.status_code = status_code
+        self.url = url
+        self._data = data
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return json.dumps(self._data)
+
+    def json(self):
+        return self._data
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f"{self.status_code} Error for local call {self.url}: {self._data}", response=self)
+
+
+def _call_local(service, method, path, url, handler, data):
+    from fastapi.encoders import jsonable_encoder
+
+    token = _current_service.set(service)
+    try:
+        with span(f"{method} {path}", service=service, transport="local") as server_span:
+            try:
+                status, result = 200, jsonable_encoder(handler(data))
+            except LocalValidationError as e:
+                status, result = 422, {"detail": str(e)}
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if status is None:
+                    logger.exception("Local call to %s %s failed", service, path)
+                    status, result = 500, {"detail": "Internal Server Error"}
+                else:  # HTTPException raised by the endpoint
+                    result = {"detail": getattr(e, "detail", str(e))}
+            server_span.attributes["status_code"] = status
+    finally:
+        _current_service.reset(token)
+    return LocalResponse(status, result, url)
+
+
+def request(method, service, url, json=None, params=None, headers=None, timeout=None):
+    """
+    Call `url` on `service`, in-process if the local transport is selected and the
+    service registered a handler for the route, over HTTP otherwise.
+    """
+    method = method.upper()
+    path = urlsplit(url).path or "/"
+    handler = _local_handlers.get((service, method, path)) if _mode == "local" else None
+    timeout = deadline.timeout(timeout)  # raises DeadlineExceeded if no time is left
+    start = time.perf_counter()
+    try:
+        if handler is not None:
+            data = json if method != "GET" else params
+            return _call_local(service, method, path, url, handler, data or {})
+        try:
+            return requests.request(
+                method, url, json=json, params=params, headers=deadline.outgoing_headers(headers), timeout=timeout
+            )
+        except requests.Timeout as e:
+            if deadline.expired():
+                raise deadline.DeadlineExceeded(f"Deadline exceeded during call to {service} {path}") from e
+            raise
+    finally:
+        CALL_SECONDS.labels(
+            service=service, path=path, transport="local" if handler is not None else "http"
+        ).observe(time.perf_counter() - start)
+
+
+def post(service, url, **kwargs):
+    return request("POST", service, url, **kwargs)
+
+
+def get(service, url, **kwargs):
+    return request("GET", service, url, **kwargs)
@@ -0,0 +1,132 @@
+"""
+Rebuild pipeline turns from the spans recorded by `common.tracing`, and show where
+each turn spent its time.
+
+Spans are read from collector files (AOSE_TRACE_FILE of the services) and/or fetched
+from the /traces/{trace_id} endpoints of running services.
+
+Examples:
+    python3 trace_viewer.py --file /tmp/aose_traces.jsonl               # latest turns
+    python3 trace_viewer.py --file /tmp/aose_traces.jsonl --trace 1a2b3c  # one turn
+    python3 trace_viewer.py --url http://localhost:8010 --url http://localhost:8005 --trace 1a2b3c
+"""
+import argparse
+import json
+from urllib.request import urlopen
+
+
+def load_spans(files, urls, trace_id=None):
+    """Collect span dicts from files and service endpoints, without duplicates."""
+    spans = {}
+    for path in files:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    data = json.loads(line)
+                    spans[data["span_id"]] = data
+    for url in urls:
+        base = url.rstrip("/")
+        trace_ids = [trace_id] if trace_id else json.load(urlopen(f"{base}/traces"))
+        for tid in trace_ids:
+            for data in json.load(urlopen(f"{base}/traces/{tid}")):
+                spans[data["span_id"]] = data
+    result = list(spans.values())
+    if trace_id:
+        result = [s for s in result if s["trace_id"] == trace_id]
+    return result
+
+
+def group_by_trace(spans):
+    traces = {}
+    for s in spans:
+        traces.setdefault(s["trace_id"], []).append(s)
+    return traces
+
+
+def build_tree(spans):
+    """Return (roots, children) where children maps a span id to its sorted child spans."""
+    by_id = {s["span_id"]: s for s in spans}
+    children = {}
+    roots = []
+    for s in spans:
+        parent = s.get("parent_id")
+        if parent and parent in by_id:
+            children.setdefault(parent, []).append(s)
+        else:
+            roots.append(s)
+    for values in children.values():
+        values.sort(key=lambda s: s["start"])
+    roots.sort(key=lambda s: s["start"])
+    return roots, children
+
+
+def end_of(s):
+    return s["start"] + s["duration_ms"] / 1000.0
+
+
+def critical_path(span_obj, children):
+    """
+    The chain of spans that determined the end time of `span_obj`: walking back from
+    its end, repeatedly pick the child that finished last before the current point.
+
+    Returns:
+    - list of (span, self time in ms) where self time is the time of the span not
+      covered by its children on the path.
+    """
+    path = []
+    kids = children.get(span_obj["span_id"], [])
+    cursor = end_of(span_obj)
+    chosen = []
+    for kid in sorted(kids, key=end_of, reverse=True):
+        if end_of(kid) <= cursor + 1e-6:
+            chosen.append(kid)
+            cursor = kid["start"]
+    covered = sum(kid["duration_ms"] for kid in chosen)
+    path.append((span_obj, max(span_obj["duration_ms"] - covered, 0.0)))
+    for kid in reversed(chosen):
+        path.extend(critical_path(kid, children))
+    return path
+
+
+def print_tree(span_obj, children, t0, depth=0):
+    offset = 1000 * (span_obj["start"] - t0)
+    error = f"  !! {span_obj['error']}" if span_obj.get("error") else ""
+    print(f"{'  ' * depth}{span_obj['service']:<5} {span_obj['name']:<45} "
+          f"+{offset:8.1f}ms {span_obj['duration_ms']:9.1f}ms{error}")
+    for kid in children.get(span_obj["span_id"], []):
+        print_tree(kid, children, t0, depth + 1)
+
+
+def show_trace(trace_id, spans):
+    roots, children = build_tree(spans)
+    t0 = min(s["start"] for s in spans)
+    print(f"=== trace {trace_id} ({len(spans)} spans)")
+    for root in roots:
+        print_tree(root, children, t0)
+    print("--- critical path (self time)")
+    for root in roots:
+        for s, self_ms in sorted(critical_path(root, children), key=lambda item: -item[1]):
+            share = 100 * self_ms / root["duration_ms"] if root["duration_ms"] else 0
+            print(f"  {s['service']:<5} {s['name']:<45} {self_ms:9.1f}ms {share:5.1f}%")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the span tree and critical path of pipeline turns.")
+    parser.add_argument("--file", action="append", default=[], help="Collector file (repeatable).")
+    parser.add_argument("--url", action="append", default=[], help="Base URL of a traced service (repeatable).")
+    parser.add_argument("--trace", default=None, help="Only show this trace id.")
+    parser.add_argument("--last", type=int, default=5, help="Number of latest traces to show.")
+    args = parser.parse_args()
+    if not args.file and not args.url:
+        parser.error("give at least one --file or --url")
+
+    traces = group_by_trace(load_spans(args.file, args.url, args.trace))
+    ordered = sorted(traces.items(), key=lambda item: min(s["start"] for s in item[1]))
+    for trace_id, spans in ordered[-args.last:]:
+        show_trace(trace_id, spans)
+
+
+if __name__ == "__main__":
+    main()